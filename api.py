@@ -1,15 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 import os
-import random
 import json
+import queue
+import threading
+import time
 import dotenv
-import requests
-from rocketapi import InstagramAPI
+import cache
+from downloader import MediaDownloader, MediaQuality, MediaTooLargeException, user_agent
+from storage import LoadedIndex, CursorLog, Manifest, SyncedIds, BlobStore, FailureLog, MetadataIndex, extensions, open_snapshot, publish, read_log, temp_name, zstandard
+from scheduler import get_scheduler, get_calls_left
+from metrics import Metrics
+from urllib.parse import urlparse
 
 dotenv.load_dotenv()
 
 tokens = str(os.getenv('tokens')).split(',')
 
+# Number of highlights whose stories are requested in one API call by the syncs
+highlights_per_request = 10
+
+def page_limit(key: str, limit: int):
+    """
+    Get an until function for paginate that ends the crawl once the pages hold limit items
+    
+    Parameters:
+    key (str): Key of the items in a page, e.g. 'items' or 'users'
+    limit (int): Maximum number of items to get"""
+    count = [0]
+    def until(data):
+        count[0] += len(data[key])
+        return count[0] >= limit
+    return until
+
+class CacheMissException(Exception):
+    """
+    Raised in offline mode when data isn't in the local cache"""
+    pass
+
 class UserScraper():
     """
     Class to scrape Instagram data of a certain user
@@ -18,70 +47,136 @@ class UserScraper():
     user (str): Username or user ID of the user to scrape
     save (bool): Whether to save the data to disk
     debug (bool): Whether to print debug messages
-    parent_path (str): Path to save the data to. If not provided, saves to current directory"""
-    def __init__(self, user: str | int, save=True, debug=False, parent_path=None) -> None:
-        # Creating multiple API instances to avoid rate limits
-        self.tokens = tokens
-        left = self.get_calls_left()
-        self.apis = [InstagramAPI(token) for n, token in enumerate(self.tokens) if left[n] > 5]
+    parent_path (str): Path to save the data to. If not provided, saves to current directory
+    workers (int): Number of media files to download at the same time
+    downloader (MediaDownloader): Download engine to use. If not provided, creates a new one
+    scheduler (TokenScheduler): Token scheduler to use. If not provided, uses the one shared by 
+    every scraper in the process
+    compression (str): Compression of the raw API snapshots: None, 'gzip' or 'zstd'
+    keep (int): Number of snapshots to keep for every raw API response. If not provided, keeps 
+    every snapshot
+    metrics (Metrics): Hook receiving timings and counters of API calls, downloads and cache 
+    lookups
+    blobs (bool): Whether to store media once in the content-addressed store shared by every 
+    user under parent_path and hardlink it into the user's directory
+    quality (MediaQuality): Policy choosing which rendition of every image and video to 
+    download. If not provided, downloads the largest one
+    index (str): Where to keep the SQLite index of the metadata: 'user' for 
+    [parent_path]/[username]/index.db, 'global' for [parent_path]/index.db shared by every 
+    user, or None to not index the metadata
+    offline (bool): Whether to build every result from the snapshots saved under raw/ without 
+    any network call. Needs no tokens, ignores update, doesn't download media, and raises 
+    CacheMissException when data isn't cached. Paginated data is replayed up to where the 
+    latest crawl ended
+    responses (ResponseCache): In-memory cache of API responses in front of get_data. If not 
+    provided, uses the one shared by every scraper in the process"""
+    def __init__(self, user: str | int, save=True, debug=False, parent_path=None, workers=8, 
+                 downloader=None, scheduler=None, compression=None, keep=None, metrics=None,
+                 blobs=False, quality=None, index='user', offline=False, responses=None) -> None:
+        if compression not in extensions:
+            raise ValueError(f"Unknown compression {compression}. Use one of {list(extensions)}")
+        if compression == 'zstd' and not zstandard:
+            raise ImportError("zstandard is required for zstd snapshots: pip install zstandard")
+        if index not in ('user', 'global', None):
+            raise ValueError(f"Unknown index {index}. Use 'user', 'global' or None")
 
         # Setting up the scraper
         self.parent_path = parent_path if parent_path else "."
+
+        # Spreading the API calls over multiple tokens to avoid rate limits
+        self.tokens = tokens
+        self.scheduler = scheduler
+
         self.save = save
         self.debug = debug
+        self.compression = compression
+        self.keep = keep
+        self.metrics = metrics if metrics else Metrics()
+        self.blobs = BlobStore(f'{self.parent_path}/.blobs') if blobs else None
+        self.quality = quality if quality else MediaQuality()
+        self.index_scope = index
+        self.offline = offline
+        self.responses = responses if responses else cache.responses
 
         self.is_private = False
+        self.workers = workers
+
+        self.headers = {
+            'User-Agent': user_agent
+        }
+        self.downloader = downloader if downloader else MediaDownloader(workers, self.headers)
+        self.setup(user)
+
+    def setup(self, user: str | int) -> None:
+        """
+        Get the user's ID and username and set up their directory
+        
+        Parameters:
+        user (str): Username or user ID of the user to scrape"""
+        if not self.scheduler and not self.offline:
+            self.scheduler = get_scheduler(self.tokens, f'{self.parent_path}/.usage.json')
 
         # Getting user ID and username
         if type(user) == str and not user.isdigit():
             self.username = user
             self.setup_directories()
+            self.manifest = Manifest(f'{self.parent_path}/{self.username}')
+            self.failures = FailureLog(f'{self.parent_path}/{self.username}/failures.jsonl')
             self.user_id = self.get_user_id(self.username)
         else:
             self.user_id = int(user)
             self.username = self.get_username(self.user_id)
             self.setup_directories()
+            self.manifest = Manifest(f'{self.parent_path}/{self.username}')
+            self.failures = FailureLog(f'{self.parent_path}/{self.username}/failures.jsonl')
 
         # Additional setup
-        self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
-        }
-
         self.loaded = self.load_loaded()
+        self.index = self.open_index()
 
-    def random_api(self) -> InstagramAPI:
+    def open_index(self) -> MetadataIndex | None:
         """
-        Return a random API instance to avoid rate limits"""
-        return random.choice(self.apis)
+        Open the metadata index, if enabled. Offline, only an existing index is opened"""
+        if not self.save or not self.index_scope:
+            return None
+        path = f'{self.parent_path}/index.db' if self.index_scope == 'global' else f'{self.parent_path}/{self.username}/index.db'
+        if self.offline and not os.path.exists(path):
+            return None
+        return MetadataIndex(path)
+
+    def call_api(self, method: str, *args, **kwargs) -> dict:
+        """
+        Call an API method on the token picked by the scheduler
+        
+        Parameters:
+        method (str): Name of the InstagramAPI method to call"""
+        if self.offline:
+            raise CacheMissException(f"Can't call {method} in offline mode")
+        return self.scheduler.call(method, *args, metrics=self.metrics, **kwargs)
 
     def get_calls_left(self) -> list:
         """
-        Get the number of calls left for each API instance"""
-        left = []
-        for token in self.tokens:
-            r = requests.get("https://v1.rocketapi.io/usage", headers={"Content-Type": "application/json", "Authorization": f"Token {token}"})
-            calls_left = r.json()['limit'] - r.json()['requests']
-            if calls_left < 5:
-                print(f"Token {token} has {calls_left} call(s) left. Replace it.")
-            left.append(calls_left)
-
-        return left
-
-    def load_loaded(self) -> dict:
+        Get the number of calls left for each API instance. The tokens are queried concurrently 
+        and the results are cached in .usage.json for a few minutes. None for a token whose usage 
+        can't be read. Empty in offline mode"""
+        if self.offline:
+            return []
+        return get_calls_left(self.tokens, f'{self.parent_path}/.usage.json')
+
+    def load_loaded(self) -> LoadedIndex:
         """
         Load the data that was already loaded to avoid loading the same images/videos multiple 
-        times"""
-        if not os.path.exists(f'{self.parent_path}/{self.username}/loaded.json'): 
-            return {'posts': [], 'stories': [], 'highlights': []}
-        with open(f'{self.parent_path}/{self.username}/loaded.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+        times. Migrates a legacy loaded.json file if there is one, except offline"""
+        loaded = LoadedIndex(f'{self.parent_path}/{self.username}/loaded.jsonl')
+        if not self.offline and os.path.exists(f'{self.parent_path}/{self.username}/loaded.json'):
+            loaded.migrate(f'{self.parent_path}/{self.username}/loaded.json')
+        return loaded
 
     def save_loaded(self) -> None:
         """
         Save the data that was already loaded to avoid loading the same images/videos multiple 
         times"""
-        with open(f'{self.parent_path}/{self.username}/loaded.json', 'w', encoding='utf-8') as f:
-            json.dump(self.loaded, f)
+        self.loaded.flush()
 
     def setup_directories(self) -> None:
         """
@@ -96,7 +191,9 @@ class UserScraper():
 
     def save_json(self, data: dict, filename: str) -> None:
         """
-        Save JSON data to a file
+        Save JSON data to a file. The file is written to a temporary path first and then given
+        a name that no other writer took, so snapshots saved in the same second by other 
+        processes or hosts are kept side by side
         
         Parameters:
         data (dict): Data to save
@@ -104,52 +201,333 @@ class UserScraper():
         now = datetime.now().strftime('%Y-%m-%d %Hh%Mm%Ss')
         parent_path = os.path.dirname(f"{self.parent_path}/{self.username}/{filename}")
         os.makedirs(parent_path, exist_ok=True)
-        with open(f"{self.parent_path}/{self.username}/{filename}_{now}.json", 'w', encoding='utf-8') as f:
-            json.dump(data, f)
+
+        # Raw API responses can be compressed
+        raw = filename.startswith('raw/')
+        path = f"{self.parent_path}/{self.username}/{filename}_{now}{extensions[self.compression if raw else None]}"
+        temp_path = temp_name(path)
+        try:
+            with open_snapshot(temp_path, 'w', path) as f:
+                json.dump(data, f)
+        except BaseException:
+            # The file isn't created if the snapshot can't be opened
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        path = publish(temp_path, path)
+        self.manifest.add(filename, os.path.relpath(path, f"{self.parent_path}/{self.username}").replace(os.sep, '/'))
+
+        # Removing the oldest raw snapshots
+        if raw and self.keep:
+            for old in self.manifest.prune(filename, self.keep):
+                if os.path.exists(f"{self.parent_path}/{self.username}/{old}"):
+                    os.remove(f"{self.parent_path}/{self.username}/{old}")
+
+    @contextmanager
+    def open_jsonl(self, filename: str, aliases=()):
+        """
+        Open a new JSON Lines file for writing data incrementally. The file is written to a 
+        temporary path and gets its final name, and is added to the manifest, once it was 
+        written completely
+        
+        Parameters:
+        filename (str): Name of the file to save the data to
+        aliases (list): Other names to add the file to the manifest under, e.g. 
+        followers/followers_complete for a complete list"""
+        now = datetime.now().strftime('%Y-%m-%d %Hh%Mm%Ss')
+        os.makedirs(os.path.dirname(f"{self.parent_path}/{self.username}/{filename}"), exist_ok=True)
+        path = f"{self.parent_path}/{self.username}/{filename}_{now}.jsonl"
+        temp_path = temp_name(path)
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                yield f
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        path = publish(temp_path, path)
+        for name in [filename, *aliases]:
+            self.manifest.add(name, os.path.relpath(path, f"{self.parent_path}/{self.username}").replace(os.sep, '/'))
 
     def find_latest_json(self, filename: str) -> str | None:
         """
-        Find the latest JSON file in a directory
+        Find the latest JSON file of a name, using the manifest
         
         Parameters:
         filename (str): Name of the file to search for"""
-        files = os.listdir(f"{self.parent_path}/{self.username}/{'/'.join(filename.split('/')[:-1])}")
-        files = [f for f in files if f.startswith(filename.split('/')[-1])]
-        files.sort()
-        if not files: return None
-        if len(filename.split('/')) == 1: return files[-1].replace('.json', '')
-        return os.path.join(*filename.split('/')[:-1], files[-1]).replace('.json', '')
+        latest = self.manifest.latest(filename)
+        return latest[:latest.rindex('.json')] if latest else None
 
     def load_json(self, filename: str) -> dict:
         """
         Load JSON data from a file"""
-        with open(f"{self.parent_path}/{self.username}/{self.find_latest_json(filename)}.json", 'r', encoding='utf-8') as f:
+        with open_snapshot(f"{self.parent_path}/{self.username}/{self.manifest.latest(filename)}", 'r') as f:
             return json.load(f)
 
-    def download_media(self, url: str, filename: str) -> None:
+    def download_media(self, url: str, filename: str, media_id=None, fallbacks=(), blob_id=None) -> None:
         """
-        Download media from a URL
+        Download media from a URL. With the blob store, media that is already stored is linked 
+        without downloading it. Media bigger than the max_bytes of the quality policy is skipped
         
         Parameters:
         url (str): URL of the media
-        filename (str): Name of the file to save the media to"""
-        r = requests.get(url, headers=self.headers, timeout=1000)
-        with open(f"{self.parent_path}/{self.username}/{filename}", 'wb') as f:
-            f.write(r.content)
+        filename (str): Name of the file to save the media to
+        media_id (str): Instagram media ID
+        fallbacks (list): URLs of smaller renditions to try if the media is too big
+        blob_id (str): ID of the chosen rendition in the blob store (see MediaQuality.blob_id)"""
+        if self.offline:
+            return
+        path = f"{self.parent_path}/{self.username}/{filename}"
+        if self.blobs and blob_id is not None and self.blobs.get(blob_id, os.path.splitext(path)[1]):
+            self.blobs.link(self.blobs.get(blob_id, os.path.splitext(path)[1]), path)
+            return
+
+        size, seconds, error = self.downloader.timed_fetch(url, path, fallbacks, self.quality.max_bytes)
+        self.metrics.download(urlparse(url).hostname, size, seconds, error is None)
+        if isinstance(error, MediaTooLargeException):
+            return
+        if error:
+            self.record_failures([{'kind': 'media', 'key': None, 'id': media_id, 'blob_id': blob_id, 'url': url, 'fallbacks': list(fallbacks), 'filename': filename, 'error': repr(error)}])
+            raise error
+        if self.blobs:
+            self.blobs.add(path, blob_id)
+
+    def media_job(self, item: dict, filename: str) -> dict:
+        """
+        Create a download job for an image or video
+        
+        Parameters:
+        item (dict): Image or video data from the API
+        filename (str): Name of the file to save the media to, without the extension"""
+        extension, urls = self.quality.select(item)
+        return {'id': item['id'], 'blob_id': self.quality.blob_id(item), 'url': urls[0], 'fallbacks': urls[1:], 'filename': f'{filename}{extension}'}
+
+    def profile_pic_urls(self, user_info: dict) -> list:
+        """
+        Get the URLs of the profile picture renditions to try, following the quality policy
+        
+        Parameters:
+        user_info (dict): User info data from the API"""
+        renditions = [user_info['hd_profile_pic_url_info'], *user_info.get('hd_profile_pic_versions', [])]
+        return [r['url'] for r in self.quality.order(renditions)]
+
+    def user_info_data(self, user_info: dict) -> dict:
+        """
+        Get the user info that is saved to user_info.json
+        
+        Parameters:
+        user_info (dict): User info data from the API"""
+        return {
+            'username': user_info['username'],
+            'user_id': user_info['pk'],
+            'full_name': user_info['full_name'],
+            'biography': user_info['biography'],
+            'followers': user_info['follower_count'],
+            'following': user_info['following_count'],
+            'posts': user_info['media_count']
+        }
+
+    def post_data(self, post: dict) -> dict:
+        """
+        Get the post data that is saved next to the post's media
+        
+        Parameters:
+        post (dict): Post data from the API"""
+        return {
+            'taken_at': post['taken_at'],
+            'id': post['id'],
+            'caption': post['caption']['text'] if 'caption' in post and 'text' in post['caption'] else None,
+            'like_count': post['like_count'],
+            'reshare_count': post['comment_count'],
+            'comment_count': post['comment_count'],
+            'media_count': len(post['carousel_media']) if 'carousel_media' in post else 1,
+            'media_type': 'carousel' if 'carousel_media' in post else 'video' if 'video_versions' in post else 'photo'
+        }
+
+    def story_data(self, story: dict) -> dict:
+        """
+        Get the story data that is saved next to the story's media
+        
+        Parameters:
+        story (dict): Story data from the API"""
+        return {
+            'taken_at': story['taken_at'],
+            'id': story['id'],
+            'media_type': 'video' if 'video_versions' in story else 'photo'
+        }
+
+    def highlight_data(self, highlight: dict) -> dict:
+        """
+        Get the highlight data that is saved next to the highlight's stories
+        
+        Parameters:
+        highlight (dict): Highlight with its title, ID and items"""
+        return {
+            'title': highlight['title'],
+            'id': highlight['id'],
+            'items': [self.story_data(item) for item in highlight['items']]
+        }
+
+    def short_user(self, user: dict) -> dict:
+        """
+        Get the fields of a follower or followed user saved to the short list
+        
+        Parameters:
+        user (dict): User data from the API"""
+        return {
+            'username': user['username'],
+            'id': user['pk']
+        }
+
+    def download_media_batch(self, jobs: list, key: str) -> list:
+        """
+        Download media concurrently, skipping media that was already loaded. Returns one result 
+        per downloaded job with 'ok' and 'error' keys. With the blob store, media that is already 
+        stored is linked instead of downloaded, and its result has 'cached' set to True
+        
+        Parameters:
+        jobs (list): Jobs created with media_job
+        key (str): Loaded list the media belongs to ('posts', 'stories' or 'highlights')"""
+        pending = self.pending_jobs(jobs, key)
+
+        results = []
+        try:
+            # Linking the media that is already in the blob store
+            if self.blobs:
+                stored = [(job, self.find_blob(job)) for job in pending]
+                pending = [job for job, blob in stored if not blob]
+                results += [self.link_blob(job, blob, key) for job, blob in stored if blob]
+
+            for result in self.downloader.run(pending):
+                results.append(result)
+                self.record_result(result, key)
+        finally:
+            self.save_loaded()
+            self.record_failures(self.media_failures(results, key))
+        return results
+
+    def pending_jobs(self, jobs: list, key: str) -> list:
+        """
+        Get the jobs whose media wasn't loaded yet, without duplicates, with the 'path' to save 
+        the media to and the 'max_bytes' of the quality policy. Always empty in offline mode
+        
+        Parameters:
+        jobs (list): Jobs created with media_job
+        key (str): Loaded list the media belongs to"""
+        if self.offline:
+            return []
+        pending, seen = [], set()
+        for job in jobs:
+            # Skipping if the media was already loaded
+            if job['id'] in self.loaded[key] or job['id'] in seen:
+                continue
+            seen.add(job['id'])
+            pending.append({**job, 'path': f"{self.parent_path}/{self.username}/{job['filename']}", 'max_bytes': self.quality.max_bytes})
+        return pending
+
+    def find_blob(self, job: dict) -> str | None:
+        """
+        Get the path of a job's media in the blob store, if it's stored
+        
+        Parameters:
+        job (dict): Pending job"""
+        return self.blobs.get(job['blob_id'], os.path.splitext(job['filename'])[1]) if self.blobs and job.get('blob_id') else None
+
+    def link_blob(self, job: dict, blob: str, key: str) -> dict:
+        """
+        Link a job's media from the blob store and mark it as loaded. Returns the job's result
+        
+        Parameters:
+        job (dict): Pending job
+        blob (str): Path of the media in the blob store
+        key (str): Loaded list the media belongs to"""
+        self.blobs.link(blob, job['path'])
+        self.loaded.add(key, job['id'])
+        return {**job, 'ok': True, 'error': None, 'skipped': False, 'bytes': 0, 'seconds': 0, 'cached': True}
+
+    def record_result(self, result: dict, key: str) -> None:
+        """
+        Report a download to the metrics and, if it succeeded, add the media to the blob store 
+        and mark it as loaded
+        
+        Parameters:
+        result (dict): Result of the download
+        key (str): Loaded list the media belongs to"""
+        self.metrics.download(urlparse(result['url']).hostname, result['bytes'], result['seconds'], result['ok'])
+        if not result['ok']:
+            if self.debug:
+                print(f"Failed to download {result['filename']}: {result['error']}")
+            return
+        if self.blobs:
+            self.blobs.add(result['path'], result.get('blob_id'))
+
+        # Adding the media to the loaded list
+        self.loaded.add(key, result['id'])
+
+    def media_failures(self, results: list, key: str) -> list:
+        """
+        Get the failure log entries of the downloads that failed
+        
+        Parameters:
+        results (list): Results of the downloads
+        key (str): Loaded list the media belongs to"""
+        return [{'kind': 'media', 'key': key, 'id': r['id'], 'blob_id': r.get('blob_id'), 'url': r['url'], 'fallbacks': r.get('fallbacks', []), 'filename': r['filename'], 'error': r['error']}
+                for r in results if not r['ok'] and not r['skipped']]
+
+    def record_failures(self, entries: list) -> None:
+        """
+        Record API calls or downloads that failed after every retry in failures.jsonl, so that 
+        retry_failures can retry them later
+        
+        Parameters:
+        entries (list): Failed API calls ('kind': 'api') or downloads ('kind': 'media')"""
+        if self.save:
+            self.failures.add([{**entry, 'time': datetime.now().timestamp()} for entry in entries])
+
+    def retry_failures(self) -> list:
+        """
+        Retry the API calls and media downloads recorded in failures.jsonl. The entries that fail 
+        again are recorded again. Media URLs expire after a while, so failed downloads should be 
+        retried soon after the crawl
+        
+        Returns one result per entry with 'ok' and 'error' keys"""
+        if self.offline:
+            raise CacheMissException("Can't retry failures in offline mode")
+        entries = self.failures.take()
+
+        if self.debug:
+            print(f"Retrying {len(entries)} failure(s) for user {self.username}")
+
+        # Retrying the API calls and saving their responses
+        results = []
+        for entry in [e for e in entries if e['kind'] == 'api']:
+            try:
+                self.get_data(entry['filename'][len('raw/'):], True, entry['method'], *entry['args'], **entry['kwargs'])
+                results.append({**entry, 'ok': True, 'error': None})
+            except Exception as e:
+                results.append({**entry, 'ok': False, 'error': repr(e)})
+
+        # Retrying the downloads, grouped by loaded list
+        media = [e for e in entries if e['kind'] == 'media']
+        for key in dict.fromkeys(e['key'] for e in media):
+            jobs = [{'id': e['id'], 'blob_id': e.get('blob_id'), 'url': e['url'], 'fallbacks': e.get('fallbacks', []), 'filename': e['filename']} for e in media if e['key'] == key]
+            if key:
+                results += self.download_media_batch(jobs, key)
+                continue
+            for job in jobs:
+                try:
+                    self.download_media(job['url'], job['filename'], job['id'], job['fallbacks'], job['blob_id'])
+                    results.append({**job, 'ok': True, 'error': None})
+                except Exception as e:
+                    results.append({**job, 'ok': False, 'error': repr(e)})
+        return results
 
     def data_exists(self, filename) -> bool:
         """
-        Check if data exists on disk
+        Check if data exists on disk, using the manifest
         
         Parameters:
         filename (str): Name of the file to check"""
-        directory = f"{self.parent_path}/{self.username}/{'/'.join(filename.split('/')[:-1])}"
-        if not os.path.exists(directory): 
-            os.makedirs(directory, exist_ok=True)
-            return False
-        files = os.listdir(directory)
-        files = [f for f in files if f.startswith(filename.split('/')[-1])]
-        return any(files)
+        return self.manifest.latest(filename) is not None
 
     def add_directory(self, path) -> None:
         """
@@ -159,16 +537,128 @@ class UserScraper():
         path (str): Path to add"""
         os.makedirs(f"{self.parent_path}/{self.username}/{path}", exist_ok=True)
 
+    def read_cache(self, filename: str, method: str) -> dict:
+        """
+        Load the latest snapshot of an API response in offline mode. Raises CacheMissException 
+        if there is none
+        
+        Parameters:
+        filename (str): Name of the snapshot, e.g. raw/user_info
+        method (str): Name of the API method the response came from"""
+        if not self.data_exists(filename):
+            raise CacheMissException(f"{filename} of {self.username} isn't cached")
+        self.metrics.cache(method, True)
+        return self.load_json(filename)
+
     def get_data(self, filename: str, update: bool, method: str, *args, **kwargs) -> dict:
         filename = 'raw/'+filename
+        if self.offline:
+            load = lambda: self.read_cache(filename, method)
+        else:
+            load = lambda: self.fetch_data(filename, update, method, *args, **kwargs)
+        data, loaded = self.responses.get(method, args, kwargs, load, update and not self.offline)
+
+        # The response was loaded by another call, possibly by another scraper
+        if not loaded:
+            self.metrics.cache(method, True)
+            if self.save and not self.offline and not self.data_exists(filename):
+                self.save_json(data, filename)
+        return data
+
+    def fetch_data(self, filename: str, update: bool, method: str, *args, **kwargs) -> dict:
+        """
+        Load an API response from disk, or call the API and save the response
+        
+        Parameters:
+        filename (str): Name of the snapshot, e.g. raw/user_info
+        update (bool): Whether to call the API even if the response is on disk
+        method (str): Name of the API method to call"""
         if update or not self.data_exists(filename):
-            data = getattr(self.random_api(), method)(*args, **kwargs)
+            if not update:
+                self.metrics.cache(method, False)
+            try:
+                data = self.call_api(method, *args, **kwargs)
+            except Exception as e:
+                self.record_failures([{'kind': 'api', 'filename': filename, 'method': method, 'args': list(args), 'kwargs': kwargs, 'error': repr(e)}])
+                raise
             if self.save:
                 self.save_json(data, filename)
         else:
+            self.metrics.cache(method, True)
             data = self.load_json(filename)
         return data
 
+    def paginate(self, name: str, update: bool, method: str, count: int, has_more, until=None):
+        """
+        Yield every page of a paginated API method, either from the API or from disk. The cursor 
+        chain is saved next to the pages, so a crawl that was interrupted or closed resumes after 
+        the last completed page, and the pages that are already on disk are read in parallel. 
+        Only a crawl that until ends is recorded as stopped, so the next update starts a new one
+        
+        Parameters:
+        name (str): Name of the pages, e.g. 'followers/followers' for raw/followers/followers_N
+        update (bool): Whether to update the data if it already exists. If False, loads the data 
+        from disk
+        method (str): Name of the API method to call
+        count (int): Number of items to request per page
+        has_more (function): Returns whether there is another page after the given page
+        until (function): Returns whether the crawl ends on purpose after the given page, e.g. 
+        at a limit. If not provided, the crawl goes on until the last page"""
+        # Offline, the cached crawl is replayed as it is
+        update = update and not self.offline
+        until = until or (lambda data: False)
+
+        if not self.save:
+            # Nothing is saved to disk, so there is nothing to resume from
+            cursor, page = None, 0
+            while True:
+                data = self.get_data(f'{name}_{page}', update, method, self.user_id, count, cursor)
+                yield data
+                if not has_more(data) or until(data): return
+                cursor, page = data['next_max_id'], page + 1
+
+        directory = os.path.dirname(f'raw/{name}')
+        self.add_directory(directory)
+        cursors = CursorLog(f"{self.parent_path}/{self.username}/{directory}/cursors.jsonl")
+
+        # Starting a new crawl unless the previous one was interrupted
+        if update and (cursors.complete or cursors.stopped or not cursors.pages):
+            cursors.start()
+
+        def ends(data):
+            # Closing the generator (e.g. on an error) isn't recorded, so the crawl can resume
+            if not until(data):
+                return False
+            if update and not cursors.complete:
+                cursors.stop()
+            return True
+
+        # Reading the pages completed in the latest crawl from disk in parallel
+        filenames = [f'raw/{name}_{page}' for page in range(cursors.pages)]
+        window = self.workers * 4
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for start in range(0, len(filenames), window):
+                for data in executor.map(self.load_json, filenames[start:start + window]):
+                    end = ends(data)
+                    yield data
+                    if end: return
+        if cursors.complete:
+            return
+
+        # Offline, an unfinished crawl ends at the last page it completed
+        if self.offline:
+            return
+
+        # Getting the remaining pages from the API or from disk
+        page = cursors.pages
+        while True:
+            data = self.get_data(f'{name}_{page}', update, method, self.user_id, count, cursors.cursors[page])
+            cursors.add(data['next_max_id'] if has_more(data) else None)
+            end = ends(data)
+            yield data
+            if cursors.complete or end: return
+            page += 1
+
     def get_user_id(self, username: str, update=False) -> int:
         """
         Get the user ID of a user by their username
@@ -197,13 +687,42 @@ class UserScraper():
         if self.debug:
             print(f"Getting username for user with id {user_id}")
 
-        data = self.random_api().get_user_info_by_id(user_id)
+        if self.offline:
+            return self.find_username(user_id)
+
+        # Sharing the response with get_user_info through the response cache
+        data, _ = self.responses.get('get_user_info_by_id', (user_id,), {}, lambda: self.call_api('get_user_info_by_id', user_id))
 
         self.username = data['user']['username']
         self.is_private = data['user']['is_private']
 
         return data['user']['username']
 
+    def find_username(self, user_id: int) -> str:
+        """
+        Find the username of a user ID among the users saved under the parent path, from their 
+        cached user info. Used instead of the API in offline mode
+        
+        Parameters:
+        user_id (int): User ID of the user"""
+        for entry in os.scandir(self.parent_path):
+            if not entry.is_dir() or not os.path.exists(f'{entry.path}/manifest.jsonl'):
+                continue
+            manifest = Manifest(entry.path)
+            for filename in ('raw/user_info', 'raw/basic_user_info'):
+                latest = manifest.latest(filename)
+                if not latest:
+                    continue
+                with open_snapshot(f'{entry.path}/{latest}', 'r') as f:
+                    data = json.load(f)
+                user = data['user'] if filename == 'raw/user_info' else data['data']['user']
+                if str(user.get('pk', user.get('id'))) == str(user_id):
+                    self.username = entry.name
+                    self.is_private = user['is_private']
+                    return entry.name
+                break
+        raise CacheMissException(f"No cached user has the ID {user_id}")
+
     def get_user_info(self, user_id: int, update=False) -> dict:
         """
         Get the user info of a user by their user ID
@@ -246,22 +765,15 @@ class UserScraper():
         #     f.write(f"Following: {user_info['following_count']}\n")
         #     f.write(f"Posts: {user_info['media_count']}\n")
 
-        if update: self.save_json({
-            'username': user_info['username'],
-            'user_id': user_info['pk'],
-            'full_name': user_info['full_name'],
-            'biography': user_info['biography'],
-            'followers': user_info['follower_count'],
-            'following': user_info['following_count'],
-            'posts': user_info['media_count']
-        }, 'user_info')
+        if update: self.save_json(self.user_info_data(user_info), 'user_info')
 
         # Saving profile picture
-        self.download_media(user_info['hd_profile_pic_url_info']['url'], 'propic.jpg')
+        urls = self.profile_pic_urls(user_info)
+        self.download_media(urls[0], 'propic.jpg', fallbacks=urls[1:])
 
-    def get_user_posts(self, limit=None, update=False) -> list:
+    def iter_user_posts(self, limit=None, update=False):
         """
-        Get user posts
+        Get user posts page by page. Yields a list of posts for every page
         
         Parameters:
         limit (int): Maximum number of posts to get. If not provided, gets all posts
@@ -275,25 +787,27 @@ class UserScraper():
         if not limit:
             limit = 999999
 
-        # Loading data for the first page from the API or from disk
-        filename = 'posts/posts_0'
-        data = self.get_data(filename, update, 'get_user_media', self.user_id, 50)
-
-        posts = data['items']
+        # Loading every page from the API or from disk
+        for data in self.paginate('posts/posts', update, 'get_user_media', 50, lambda data: data['more_available'], page_limit('items', limit)):
+            yield data['items']
 
-        # Getting all the other posts
-        page = 1
-        while data['more_available'] and len(posts) < limit:
-            # Loading data for the next page from the API or from disk
-            filename = f'posts/posts_{page}'
-            data = self.get_data(filename, update, 'get_user_media', self.user_id, 50, data['next_max_id'])
-            posts += data['items']
-            page += 1
-        return posts
+    def get_user_posts(self, limit=None, update=False) -> list:
+        """
+        Get user posts
+        
+        Parameters:
+        limit (int): Maximum number of posts to get. If not provided, gets all posts
+        update (bool): Whether to update the data if it already exists. If False, loads 
+        the data from disk"""
+        return [post for page in self.iter_user_posts(limit, update=update) for post in page]
 
-    def download_user_posts(self, posts=None, limit=None, update=False) -> None:
+    def download_user_posts(self, posts=None, limit=None, update=False) -> list:
         """
-        Download user posts to disk
+        Download user posts to disk. Runs as a pipeline of three stages connected by bounded 
+        queues, so that the API, the downloads and the disk are busy at the same time: a thread 
+        fetches the pages, this thread turns every page into media jobs for the downloader, and 
+        a single writer thread saves the post data, the index and the loaded list. A stage that 
+        falls behind blocks the one before it, so memory use stays bounded
         
         Parameters:
         posts (list): User posts data. If not provided, gets the data from the API
@@ -301,9 +815,8 @@ class UserScraper():
         update (bool): Whether to update the data if it already exists. If False, loads 
         the data from disk"""
 
-        # Getting user posts if not provided
-        if not posts:
-            posts = self.get_user_posts(limit, update=update)
+        # Getting user posts page by page if not provided
+        pages = [posts] if posts else self.iter_user_posts(limit, update=update)
 
         if self.debug:
             print(f"Downloading user posts for user {self.username}")
@@ -311,53 +824,149 @@ class UserScraper():
         if not limit:
             limit = 999_999_999_999
 
-        # Downloading every post
-        for n, post in enumerate(posts):
-            if n >= limit:
-                break
-            date = datetime.fromtimestamp(post['taken_at']).strftime('%Y-%m-%d %Hh%Mm%Ss')
-            self.add_directory(f'posts/post_{date}')
-
-            # Loading every image/video in the post
-            if 'carousel_media' in post:
-                images = [im for im in post['carousel_media']]
-            else: images = [post]
-            for i, image in enumerate(images):
-                # Skipping if the media was already loaded
-                if image['id'] in self.loaded['posts']:
+        # Queues between the stages
+        page_queue = queue.Queue(maxsize=2)
+        write_queue = queue.Queue(maxsize=self.downloader.workers * 4)
+        capacity = self.downloader.workers * 2
+        in_flight = threading.BoundedSemaphore(capacity)
+        stop = threading.Event()
+        results, errors = [], []
+        fetcher = threading.Thread(target=self.fetch_pages, args=(pages, page_queue, stop), daemon=True)
+        writer = threading.Thread(target=self.write_posts, args=(write_queue, results, errors), daemon=True)
+        fetcher.start()
+        writer.start()
+
+        def done(future):
+            write_queue.put(('result', future.result()))
+            in_flight.release()
+
+        try:
+            n = 0
+            # Stopping early if the writer failed, since nothing else would be saved
+            while n < limit and not errors:
+                page = page_queue.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+
+                # Collecting the media of every post on the page
+                jobs, data, records = [], [], []
+                for post in page:
+                    if n >= limit:
+                        break
+                    n += 1
+                    date = datetime.fromtimestamp(post['taken_at']).strftime('%Y-%m-%d %Hh%Mm%Ss')
+                    self.add_directory(f'posts/post_{date}')
+
+                    # Loading every image/video in the post
+                    if 'carousel_media' in post:
+                        images = [im for im in post['carousel_media']]
+                    else: images = [post]
+                    jobs += [self.media_job(image, f'posts/post_{date}/{i}') for i, image in enumerate(images)]
+                    data.append((self.post_data(post), f'posts/post_{date}/data'))
+                    records.append({**self.post_data(post), 'path': f'posts/post_{date}'})
+
+                    # Loading the caption if it exists
+                    # if not 'caption' in post:
+                    #     continue
+                    # if not post['caption']:
+                    #     continue
+                    # if not 'text' in post['caption']:
+                    #     continue
+                    # with open(f'{self.parent_path}/{self.username}/posts/post_{date}/caption.txt', 'w', encoding='utf-8') as f:
+                    #     f.write(post['caption']['text'])
+                write_queue.put(('data', data, records, update))
+
+                # Downloading every image/video on the page
+                for job in self.pending_jobs(jobs, 'posts'):
+                    if errors:
+                        break
+                    blob = self.find_blob(job)
+                    if blob:
+                        write_queue.put(('blob', job, blob))
+                        continue
+                    in_flight.acquire()
+                    self.downloader.submit(job).add_done_callback(done)
+        finally:
+            # Letting the downloads finish, which release their slot once their result is queued
+            stop.set()
+            for _ in range(capacity):
+                in_flight.acquire()
+            write_queue.put(None)
+            writer.join()
+            fetcher.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def fetch_pages(self, pages, page_queue: queue.Queue, stop: threading.Event) -> None:
+        """
+        First stage of download_user_posts: put every page in a queue, then None. An error is 
+        put in the queue instead of being raised
+        
+        Parameters:
+        pages (iterable): Pages of posts
+        page_queue (Queue): Queue to put the pages in
+        stop (Event): Set when the pages aren't needed anymore"""
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    page_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
                     continue
-                if 'video_versions' in image:
-                    self.download_media(image['video_versions'][0]['url'], f'posts/post_{date}/{i}.mp4')
+            return False
+
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+        finally:
+            # Closing the pagination so that the cursor log knows where it stopped
+            if hasattr(pages, 'close'):
+                pages.close()
+
+    def write_posts(self, write_queue: queue.Queue, results: list, errors: list) -> None:
+        """
+        Last stage of download_user_posts: the only thread writing the post data, the index and 
+        the loaded list, until None is taken from the queue. The queue is always drained, even 
+        after an error, so the other stages never block on it, and the downloads that finish 
+        after an error are still marked as loaded since their files are on disk
+        
+        Parameters:
+        write_queue (Queue): Queue of ('data', post data, index records, update), ('blob', job, 
+        blob) and ('result', download result)
+        results (list): List to add the download results to
+        errors (list): List to add an error to"""
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            if errors and item[0] != 'result':
+                continue
+            try:
+                if item[0] == 'data':
+                    _, data, records, update = item
+                    for post, filename in data:
+                        # Saving additional data
+                        if update or not self.data_exists(filename):
+                            self.save_json(post, filename)
+                    if self.index:
+                        self.index.add_posts(self.username, records)
+                elif item[0] == 'blob':
+                    results.append(self.link_blob(item[1], item[2], 'posts'))
                 else:
-                    self.download_media(image['image_versions2']['candidates'][0]['url'], f'posts/post_{date}/{i}.jpg')
-
-                # Adding the media to the loaded list
-                self.loaded['posts'].append(image['id'])
-                self.save_loaded()
-
-            if not (update or not self.data_exists(f'posts/post_{date}/data')): continue
-
-            # Saving additional data
-            if update or not self.data_exists(f'posts/post_{date}/data'): self.save_json({
-                'taken_at': post['taken_at'],
-                'id': post['id'],
-                'caption': post['caption']['text'] if 'caption' in post and 'text' in post['caption'] else None,
-                'like_count': post['like_count'],
-                'reshare_count': post['comment_count'],
-                'comment_count': post['comment_count'],
-                'media_count': len(images),
-                'media_type': 'carousel' if 'carousel_media' in post else 'video' if 'video_versions' in post else 'photo'
-            }, f'posts/post_{date}/data')
-
-            # Loading the caption if it exists
-            # if not 'caption' in post:
-            #     continue
-            # if not post['caption']:
-            #     continue
-            # if not 'text' in post['caption']:
-            #     continue
-            # with open(f'{self.parent_path}/{self.username}/posts/post_{date}/caption.txt', 'w', encoding='utf-8') as f:
-            #     f.write(post['caption']['text'])
+                    results.append(item[1])
+                    self.record_result(item[1], 'posts')
+            except Exception as e:
+                errors.append(e)
+
+        self.save_loaded()
+        self.record_failures(self.media_failures(results, 'posts'))
 
     def get_user_stories(self) -> list:
         """
@@ -366,12 +975,17 @@ class UserScraper():
         if self.debug:
             print(f"Getting user stories for user {self.username}")
 
+        # Replaying the latest stories snapshot
+        if self.offline:
+            reel = self.read_cache('raw/stories', 'get_user_stories')['reels'].get(str(self.user_id))
+            return reel['items'] if reel else []
+
         # Getting stories data from the API
-        data = self.random_api().get_user_stories(self.user_id)
+        data = self.call_api('get_user_stories', self.user_id)
         self.save_json(data, 'raw/stories')
         return data['reels'][str(self.user_id)]['items']
 
-    def download_user_stories(self, stories=None) -> None:
+    def download_user_stories(self, stories=None) -> list:
         """
         Download user stories to disk
         
@@ -385,6 +999,13 @@ class UserScraper():
         if self.debug:
             print(f"Downloading user stories for user {self.username}")
 
+        if self.index:
+            self.index.add_stories(self.username, [{
+                **self.story_data(story),
+                'path': f"stories/story_{datetime.fromtimestamp(story['taken_at']).strftime('%Y-%m-%d %Hh%Mm%Ss')}"
+            } for story in stories])
+
+        jobs = []
         for story in stories:
             # Skipping if the story was already loaded
             if story['id'] in self.loaded['stories']:
@@ -392,21 +1013,12 @@ class UserScraper():
 
             date = datetime.fromtimestamp(story['taken_at']).strftime('%Y-%m-%d %Hh%Mm%Ss')
 
-            self.save_json({
-                'taken_at': story['taken_at'],
-                'id': story['id'],
-                'media_type': 'video' if 'video_versions' in story else 'photo'
-            }, f'stories/story_{date}')
+            self.save_json(self.story_data(story), f'stories/story_{date}')
 
-            # Downloading the story
-            if 'video_versions' in story:
-                self.download_media(story['video_versions'][0]['url'], f'stories/story_{date}.mp4')
-            else:
-                self.download_media(story['image_versions2']['candidates'][0]['url'], f'stories/story_{date}.jpg')
+            jobs.append(self.media_job(story, f'stories/story_{date}'))
 
-            # Adding the story to the loaded list
-            self.loaded['stories'].append(story['id'])
-            self.save_loaded()
+        # Downloading every story
+        return self.download_media_batch(jobs, 'stories')
 
     def get_user_highlights(self, update=False) -> list:
         """
@@ -431,7 +1043,7 @@ class UserScraper():
             highlight['items'] = data['reels'][f'highlight:{highlight["id"]}']['items']
         return highlights
 
-    def download_user_highlights(self, highlights=None, update=False) -> None:
+    def download_user_highlights(self, highlights=None, update=False) -> list:
         """
         Download user highlights to disk
         
@@ -447,39 +1059,29 @@ class UserScraper():
         if self.debug:
             print(f"Downloading user highlights for user {self.username}")
 
-        # Downloading every story in every highlight
+        # Collecting every story in every highlight
+        jobs = []
         for highlight in highlights:
             self.add_directory(f'highlights/{highlight["title"]}')
             if self.save and (update or not self.data_exists(f'highlights/{highlight["title"]}/data')):
-                self.save_json({
-                    'title': highlight['title'],
-                    'id': highlight['id'],
-                    'items': [{
-                        'taken_at': item['taken_at'],
-                        'id': item['id'],
-                        'media_type': 'video' if 'video_versions' in item else 'photo'
-                    } for item in highlight['items']]
-                }, f'highlights/{highlight["title"]}/data')
+                self.save_json(self.highlight_data(highlight), f'highlights/{highlight["title"]}/data')
+            records = []
             for story in highlight['items']:
-                # Skipping if the story was already loaded
-                if story['id'] in self.loaded['highlights']:
-                    continue
-
-                # Downloading the story
                 date = datetime.fromtimestamp(story['taken_at']).strftime('%Y-%m-%d %Hh%MMmSs')
-                if 'video_versions' in story:
-                    self.download_media(story['video_versions'][0]['url'], f'highlights/{highlight["title"]}/story_{date}.mp4')
-                else:
-                    self.download_media(story['image_versions2']['candidates'][0]['url'], f'highlights/{highlight["title"]}/story_{date}.jpg')
+                jobs.append(self.media_job(story, f'highlights/{highlight["title"]}/story_{date}'))
+                records.append({**self.story_data(story), 'path': f'highlights/{highlight["title"]}/story_{date}'})
+            if self.index:
+                self.index.add_stories(self.username, records, highlight['title'])
 
-                # Adding the story to the loaded list
-                self.loaded['highlights'].append(story['id'])
+        # Downloading every story
+        return self.download_media_batch(jobs, 'highlights')
 
-    def get_user_followers(self, limit=None, update=False) -> dict:
+    def iter_user_followers(self, limit=None, update=False):
         """
-        Get user followers
+        Get user followers page by page. Yields a list of users for every page
         
         Parameters:
+        limit (int): Maximum number of users to get. If not provided, gets all of them
         update (bool): Whether to update the data if it already exists. If False, 
         loads the data from disk"""
 
@@ -489,47 +1091,47 @@ class UserScraper():
         if not limit:
             limit = 999_999_999_999
 
-        filename = 'followers/followers_0'
-        data = self.get_data(filename, update, 'get_user_followers', self.user_id, 100)
+        for data in self.paginate('followers/followers', update, 'get_user_followers', 100, lambda data: 'next_max_id' in data, page_limit('users', limit)):
+            yield data['users']
 
-        users = data['users']
-        page = 1
-        while 'next_max_id' in data and len(users) < limit:
-            filename = f'followers/followers_{page}'
-            data = self.get_data(filename, update, 'get_user_followers', self.user_id, 100, data['next_max_id'])
-
-            users += data['users']
-            page += 1
-        return users
+    def get_user_followers(self, limit=None, update=False) -> list:
+        """
+        Get user followers
+        
+        Parameters:
+        limit (int): Maximum number of users to get. If not provided, gets all of them
+        update (bool): Whether to update the data if it already exists. If False, 
+        loads the data from disk"""
+        return [user for page in self.iter_user_followers(limit, update=update) for user in page]
     
-    def download_user_followers(self, followers=None, limit=None, update=False) -> None:
+    def download_user_followers(self, followers=None, limit=None, update=False) -> int:
         """
-        Download user followers to disk
+        Download user followers to disk. Users are streamed to disk page by page, so memory use 
+        doesn't depend on the number of users
         
         Parameters:
         followers (list): User followers data. If not provided, gets the data from the API
         limit (int): Maximum number of followers to download. If not provided, downloads all followers
         update (bool): Whether to update the data if it already exists. If False, 
-        loads the data from disk"""
+        loads the data from disk
+        
+        Returns the number of followers"""
 
-        if not followers:
-            followers = self.get_user_followers(limit, update=update)
+        # Getting user followers page by page if not provided
+        pages = [followers] if followers else self.iter_user_followers(limit, update=update)
 
         if self.debug:
             print(f"Downloading user followers for user {self.username}")
 
-        if self.save and (update or not self.data_exists('followers/followers_full')):
-            self.save_json({'users': followers}, 'followers/followers_full')
-            self.save_json({'users': [{
-                'username': user['username'],
-                'id': user['pk']
-            } for user in followers]}, 'followers/followers_short')
+        write = self.save and (update or not self.data_exists('followers/followers_full'))
+        return self.save_users(pages, 'followers/followers', write, complete=not (followers or limit))
 
-    def get_user_following(self, limit=None, update=False) -> dict:
+    def iter_user_following(self, limit=None, update=False):
         """
-        Get user following
+        Get user following page by page. Yields a list of users for every page
         
         Parameters:
+        limit (int): Maximum number of users to get. If not provided, gets all of them
         update (bool): Whether to update the data if it already exists. If False, 
         loads the data from disk"""
 
@@ -539,41 +1141,351 @@ class UserScraper():
         if not limit:
             limit = 999_999_999_999
 
-        filename = 'following/following_0'
-        data = self.get_data(filename, update, 'get_user_following', self.user_id, 200)
-
-        users = data['users']
-        page = 1
-        while 'next_max_id' in data and len(users) < limit:
-            filename = f'following/following_{page}'
-            data = self.get_data(filename, update, 'get_user_following', self.user_id, 200, data['next_max_id'])
+        for data in self.paginate('following/following', update, 'get_user_following', 200, lambda data: 'next_max_id' in data, page_limit('users', limit)):
+            yield data['users']
 
-            users += data['users']
-            page += 1
-        return users
+    def get_user_following(self, limit=None, update=False) -> list:
+        """
+        Get user following
+        
+        Parameters:
+        limit (int): Maximum number of users to get. If not provided, gets all of them
+        update (bool): Whether to update the data if it already exists. If False, 
+        loads the data from disk"""
+        return [user for page in self.iter_user_following(limit, update=update) for user in page]
     
-    def download_user_following(self, following=None, limit=None, update=False) -> None:
+    def download_user_following(self, following=None, limit=None, update=False) -> int:
         """
-        Download user following to disk
+        Download user following to disk. Users are streamed to disk page by page, so memory use 
+        doesn't depend on the number of users
         
         Parameters:
         following (list): User following data. If not provided, gets the data from the API
         limit (int): Maximum number of following to download. If not provided, downloads all following
         update (bool): Whether to update the data if it already exists. If False, 
-        loads the data from disk"""
+        loads the data from disk
+        
+        Returns the number of users followed"""
 
-        if not following:
-            following = self.get_user_following(limit, update=update)
+        # Getting user following page by page if not provided
+        pages = [following] if following else self.iter_user_following(limit, update=update)
 
         if self.debug:
             print(f"Downloading user following for user {self.username}")
 
-        if self.save and (update or not self.data_exists('following/following_full')):
-            self.save_json({'users': following}, 'following/following_full')
-            self.save_json({'users': [{
-                'username': user['username'],
-                'id': user['pk']
-            } for user in following]}, 'following/following_short')
+        write = self.save and (update or not self.data_exists('following/following_full'))
+        return self.save_users(pages, 'following/following', write, complete=not (following or limit))
+
+    def save_users(self, pages, filename: str, write=True, complete=False) -> int:
+        """
+        Stream lists of users to a full and a short JSON Lines file, one user per line, and to 
+        the metadata index. Returns the number of users
+        
+        Parameters:
+        pages (iterable): Lists of users
+        filename (str): Name of the files without the suffix, e.g. followers/followers
+        write (bool): Whether to write the files. If False, only counts and indexes the users
+        complete (bool): Whether the pages contain every user, in which case the users that 
+        aren't in them are removed from the index and the full list is also saved as 
+        [filename]_complete in the manifest"""
+        kind, updated = filename.split('/')[0], time.time()
+        count = 0
+        if not write:
+            for users in pages:
+                if self.index:
+                    self.index.add_users(self.username, kind, users, updated)
+                count += len(users)
+        else:
+            aliases = [f'{filename}_complete'] if complete else []
+            with self.open_jsonl(f'{filename}_full', aliases) as full, self.open_jsonl(f'{filename}_short') as short:
+                for users in pages:
+                    full.write(''.join(json.dumps(user) + '\n' for user in users))
+                    short.write(''.join(json.dumps(self.short_user(user)) + '\n' for user in users))
+                    if self.index:
+                        self.index.add_users(self.username, kind, users, updated)
+                    count += len(users)
+
+        if self.index and complete:
+            self.index.remove_users_before(self.username, kind, updated)
+        return count
+
+    def load_sync_state(self) -> dict:
+        """
+        Load what the previous syncs have seen: the newest post and the latest_reel_media of 
+        every highlight, by ID"""
+        if not os.path.exists(f'{self.parent_path}/{self.username}/sync.json'):
+            return {'posts': None, 'highlights': {}}
+        with open(f'{self.parent_path}/{self.username}/sync.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_sync_state(self, state: dict) -> None:
+        """
+        Save what the syncs have seen
+        
+        Parameters:
+        state (dict): State returned by load_sync_state"""
+        temp_path = temp_name(f'{self.parent_path}/{self.username}/sync.json')
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(temp_path, f'{self.parent_path}/{self.username}/sync.json')
+
+    def sync_user_posts(self) -> list:
+        """
+        Download only the posts published since the previous sync. Stops paginating as soon as 
+        a page reaches the newest post seen before, so a daily sync costs a page or two instead 
+        of the whole history. The first sync downloads every post
+        
+        Returns one result per downloaded media file, like download_user_posts"""
+
+        if self.debug:
+            print(f"Syncing user posts for user {self.username}")
+
+        state = self.load_sync_state()
+        newest = state['posts']['taken_at'] if state['posts'] else 0
+
+        # Paging through separate pages and cursors, so the pages of the latest crawl stay intact
+        # Pinned posts can be older than the newest post, so they don't end the sync
+        caught_up = lambda data: any(post['taken_at'] <= newest and not post.get('timeline_pinned_user_ids') for post in data['items'])
+        new = []
+        for data in self.paginate('posts/sync/posts', True, 'get_user_media', 50, lambda data: data['more_available'], caught_up):
+            new += [post for post in data['items'] if post['taken_at'] > newest]
+        if not new:
+            return []
+
+        results = self.download_user_posts(posts=new)
+        latest = max(new, key=lambda post: post['taken_at'])
+        state['posts'] = {'taken_at': latest['taken_at'], 'id': latest['id']}
+        self.save_sync_state(state)
+        return results
+
+    def due_highlights(self, data: dict, state: dict) -> list:
+        """
+        Get the highlights whose stories a sync has to request: new highlights, and highlights 
+        whose latest_reel_media changed since the previous sync. If the list of highlights 
+        doesn't have latest_reel_media, every highlight is due
+        
+        Parameters:
+        data (dict): List of highlights from the API
+        state (dict): Sync state, see load_sync_state"""
+        seen = state['highlights'] if isinstance(state['highlights'], dict) else {}
+        nodes = [edge['node'] for edge in data['data']['user']['edge_highlight_reels']['edges']]
+        return [{'title': node['title'], 'id': node['id']} for node in nodes
+                if node.get('latest_reel_media') is None or seen.get(node['id']) != node['latest_reel_media']]
+
+    def sync_user_highlights(self) -> list:
+        """
+        Download only the highlight stories that weren't downloaded before, both in new 
+        highlights and added to existing ones. Only the stories of the highlights that are 
+        new or changed (see due_highlights) are requested, highlights_per_request highlights 
+        per API call, and only the highlights with new stories are saved and downloaded
+        
+        Returns one result per downloaded media file, like download_user_highlights"""
+
+        if self.debug:
+            print(f"Syncing user highlights for user {self.username}")
+
+        state = self.load_sync_state()
+        data = self.get_data('highlights', True, 'get_user_highlights', self.user_id)
+        highlights = self.due_highlights(data, state)
+
+        # Getting the stories of the due highlights in bulk
+        for start in range(0, len(highlights), highlights_per_request):
+            chunk = highlights[start:start + highlights_per_request]
+            stories = self.get_data(f'highlights/sync/stories_{start // highlights_per_request}', True, 'get_highlight_stories_bulk', [h['id'] for h in chunk])
+            for highlight in chunk:
+                highlight['items'] = stories['reels'].get(f'highlight:{highlight["id"]}', {}).get('items', [])
+
+        changed = [h for h in highlights if any(item['id'] not in self.loaded['highlights'] for item in h['items'])]
+        results = self.download_user_highlights(highlights=changed, update=True) if changed else []
+        state['highlights'] = {edge['node']['id']: edge['node'].get('latest_reel_media') for edge in data['data']['user']['edge_highlight_reels']['edges']}
+        self.save_sync_state(state)
+        return results
+
+    def sync_users(self, kind: str, full=False) -> dict:
+        """
+        Sync the followers or following of the user. Stops paginating once a whole page 
+        contains only users seen before, and saves the difference to [kind]/[kind]_diff. 
+        Removed users can only be detected when every page was read, i.e. on the first sync or 
+        when full is True
+        
+        Parameters:
+        kind (str): 'followers' or 'following'
+        full (bool): Whether to read every page to detect removed users
+        
+        Returns a dict with the 'added' users and the 'removed' user IDs"""
+
+        if self.debug:
+            print(f"Syncing user {kind} for user {self.username}")
+
+        self.add_directory(kind)
+        known = SyncedIds(f'{self.parent_path}/{self.username}/{kind}/sync.jsonl')
+        added, seen, complete = [], set(), True
+
+        # Paging through separate pages and cursors, so the pages of the latest crawl stay intact
+        count = {'followers': 100, 'following': 200}[kind]
+        caught_up = lambda data: bool(known.ids) and not full and all(user['pk'] in known.ids for user in data['users'])
+        for data in self.paginate(f'{kind}/sync/{kind}', True, f'get_user_{kind}', count, lambda data: 'next_max_id' in data, caught_up):
+            users = data['users']
+            added += [user for user in users if user['pk'] not in known.ids]
+            seen.update(user['pk'] for user in users)
+            if caught_up(data):
+                complete = False
+
+        removed = [user_id for user_id in known.ids if user_id not in seen] if complete else []
+        known.update([user['pk'] for user in added], removed)
+        if self.index:
+            self.index.add_users(self.username, kind, added, time.time())
+            self.index.remove_users(self.username, kind, removed)
+        if self.save:
+            self.save_json({'added': added, 'removed': removed, 'complete': complete}, f'{kind}/{kind}_diff')
+        return {'added': added, 'removed': removed}
+
+    def sync_user_followers(self, full=False) -> dict:
+        """
+        Sync the followers of the user, getting only the new ones. See sync_users
+        
+        Parameters:
+        full (bool): Whether to read every page to detect removed followers"""
+        return self.sync_users('followers', full)
+
+    def sync_user_following(self, full=False) -> dict:
+        """
+        Sync the users followed by the user, getting only the new ones. See sync_users
+        
+        Parameters:
+        full (bool): Whether to read every page to detect unfollowed users"""
+        return self.sync_users('following', full)
+
+    def rebuild_index(self) -> None:
+        """
+        Fill the metadata index from the data already on disk, e.g. data downloaded before the 
+        index was enabled. The followers and following come from their latest full list"""
+        if not self.index:
+            raise ValueError("The metadata index is disabled")
+
+        posts, stories = [], []
+        for name in list(self.manifest.snapshots):
+            if name.startswith('posts/post_') and name.endswith('/data'):
+                posts.append({**self.load_json(name), 'path': name[:-len('/data')]})
+            elif name.startswith('stories/story_'):
+                stories.append({**self.load_json(name), 'path': name})
+            elif name.startswith('highlights/') and name.endswith('/data'):
+                highlight = self.load_json(name)
+                self.index.add_stories(self.username, [{
+                    **story,
+                    'path': f"highlights/{highlight['title']}/story_{datetime.fromtimestamp(story['taken_at']).strftime('%Y-%m-%d %Hh%MMmSs')}"
+                } for story in highlight['items']], highlight['title'])
+        self.index.add_posts(self.username, posts)
+        self.index.add_stories(self.username, stories)
+
+        # Replacing the users with the latest full lists
+        for kind in ['followers', 'following']:
+            latest = self.manifest.latest(f'{kind}/{kind}_full')
+            if latest:
+                updated = time.time()
+                self.index.add_users(self.username, kind, read_log(f'{self.parent_path}/{self.username}/{latest}'), updated)
+                self.index.remove_users_before(self.username, kind, updated)
+
+    def query_posts(self, min_likes=None, min_comments=None, since=None, until=None, media_type=None, 
+                    search=None, order_by='taken_at', descending=True, limit=None) -> list:
+        """
+        Query the posts in the metadata index without loading them from disk. Returns dicts 
+        with the post data and the 'path' of the post's directory
+        
+        Parameters:
+        min_likes (int): Minimum number of likes
+        min_comments (int): Minimum number of comments
+        since (datetime | float): Earliest date the post was published, or a timestamp
+        until (datetime | float): Latest date the post was published, or a timestamp
+        media_type (str): 'photo', 'video' or 'carousel'
+        search (str): Text the caption contains, case insensitive
+        order_by (str): 'taken_at', 'like_count' or 'comment_count'
+        descending (bool): Whether to sort in descending order
+        limit (int): Maximum number of posts to return"""
+        if order_by not in ('taken_at', 'like_count', 'comment_count'):
+            raise ValueError(f"Can't order posts by {order_by}")
+        conditions, params = self.time_conditions(since, until)
+        if min_likes is not None:
+            conditions.append('like_count >= ?')
+            params.append(min_likes)
+        if min_comments is not None:
+            conditions.append('comment_count >= ?')
+            params.append(min_comments)
+        if media_type:
+            conditions.append('media_type = ?')
+            params.append(media_type)
+        if search:
+            conditions.append('caption LIKE ?')
+            params.append(f'%{search}%')
+        sql = f"SELECT * FROM posts WHERE {' AND '.join(conditions)} ORDER BY {order_by} {'DESC' if descending else 'ASC'}"
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        return self.index_query(sql, params)
+
+    def query_stories(self, since=None, until=None, highlight=None) -> list:
+        """
+        Query the stories and highlight stories in the metadata index. Returns dicts with the 
+        story data, the 'highlight' title ('' for stories) and the 'path' of the media file 
+        without its extension, newest first
+        
+        Parameters:
+        since (datetime | float): Earliest date the story was published, or a timestamp
+        until (datetime | float): Latest date the story was published, or a timestamp
+        highlight (str): Title of the highlight, or '' for stories only. If not provided, 
+        returns both"""
+        conditions, params = self.time_conditions(since, until)
+        if highlight is not None:
+            conditions.append('highlight = ?')
+            params.append(highlight)
+        return self.index_query(f"SELECT * FROM stories WHERE {' AND '.join(conditions)} ORDER BY taken_at DESC", params)
+
+    def query_users(self, kind='followers', search=None, is_private=None, is_verified=None) -> list:
+        """
+        Query the followers or followed users in the metadata index
+        
+        Parameters:
+        kind (str): 'followers' or 'following'
+        search (str): Text the username or full name contains, case insensitive
+        is_private (bool): Whether the users are private
+        is_verified (bool): Whether the users are verified"""
+        conditions, params = ['username = ?', 'kind = ?'], [self.username, kind]
+        if search:
+            conditions.append('(name LIKE ? OR full_name LIKE ?)')
+            params += [f'%{search}%', f'%{search}%']
+        if is_private is not None:
+            conditions.append('is_private = ?')
+            params.append(int(is_private))
+        if is_verified is not None:
+            conditions.append('is_verified = ?')
+            params.append(int(is_verified))
+        return self.index_query(f"SELECT * FROM users WHERE {' AND '.join(conditions)} ORDER BY name", params)
+
+    def time_conditions(self, since=None, until=None) -> tuple:
+        """
+        Build the SQL conditions selecting the user's rows published in a time range
+        
+        Parameters:
+        since (datetime | float): Earliest date, or a timestamp
+        until (datetime | float): Latest date, or a timestamp"""
+        conditions, params = ['username = ?'], [self.username]
+        if since is not None:
+            conditions.append('taken_at >= ?')
+            params.append(since.timestamp() if isinstance(since, datetime) else since)
+        if until is not None:
+            conditions.append('taken_at <= ?')
+            params.append(until.timestamp() if isinstance(until, datetime) else until)
+        return conditions, params
+
+    def index_query(self, sql: str, params: list) -> list:
+        """
+        Run a query on the metadata index
+        
+        Parameters:
+        sql (str): SQL query
+        params (list): Parameters of the query"""
+        if not self.index:
+            raise ValueError("The metadata index is disabled")
+        return self.index.query(sql, params)
 
 if __name__ == '__main__':
     scraper = UserScraper('starthackclub', True, True)
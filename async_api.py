@@ -0,0 +1,1181 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager
+from datetime import datetime
+from urllib.parse import urlparse
+import asyncio
+import json
+import os
+import time
+from rocketapi import InstagramAPI
+from rocketapi.exceptions import NotFoundException, BadResponseException
+from api import UserScraper, CacheMissException, highlights_per_request, page_limit
+from client import RateLimitedException
+from downloader import MediaTooLargeException, user_agent
+from metrics import mask_token
+from resilience import RetryPolicy, CircuitBreaker, is_transient
+from scheduler import TokenScheduler, get_calls_left
+from storage import CursorLog, Manifest, SyncedIds, FailureLog, temp_name
+import client
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Async schedulers shared by every async scraper in the process, keyed by their tokens
+schedulers = {}
+
+class RequestBuilder(InstagramAPI):
+    """
+    InstagramAPI client whose methods return the endpoint and the payload of their request
+    instead of sending it, so that the async scraper calls the same endpoints as UserScraper"""
+    def __init__(self) -> None:
+        super().__init__(None)
+
+    def request(self, method, data):
+        return method, data
+
+builder = RequestBuilder()
+
+def unwrap_response(endpoint: str, response: dict) -> dict:
+    """
+    Get Instagram's response out of a RocketAPI response, raising the same exceptions as
+    InstagramAPI
+
+    Parameters:
+    endpoint (str): RocketAPI endpoint that was called
+    response (dict): Response of RocketAPI"""
+    if response['status'] == 'done':
+        if response['response']['status_code'] == 200 and response['response']['content_type'] == 'application/json':
+            return response['response']['body']
+        if response['response']['status_code'] == 404:
+            raise NotFoundException("Instagram resource not found")
+        raise BadResponseException(f"Bad response from Instagram ({endpoint}: {response['response']['status_code']})")
+    raise BadResponseException(f"Bad response from RocketAPI ({endpoint})")
+
+# Thread changing and saving the loaded lists of every async scraper
+loaded_writer = ThreadPoolExecutor(max_workers=1)
+
+class AsyncTokenScheduler(TokenScheduler):
+    """
+    TokenScheduler for asyncio. Keeps the same bookkeeping for every token, but waits for a
+    token without blocking the event loop and sends the requests through one aiohttp session
+
+    Parameters:
+    tokens (list): RocketAPI tokens
+    calls_left (list): Number of calls left for each token, or None if it is unknown
+    rate (float): Maximum number of requests per second for each token
+    burst (int): Maximum number of requests a token can make at once after being idle
+    reserve (int): Number of calls to leave unused on each token
+    retries (int): Number of times to retry a call after a 429 (on another token right away) or 
+    a transient error (after a backoff)
+    timeout (tuple): Connect and read timeouts of the API requests, in seconds
+    policy (RetryPolicy): Backoff between retries of transient errors. Defaults to RetryPolicy()
+    breaker (CircuitBreaker): Circuit breaker of the RocketAPI host. Defaults to CircuitBreaker()
+    probe_interval (float): Number of seconds between two queries of the usage of a token whose
+    usage is unknown"""
+    def __init__(self, tokens: list, calls_left: list, rate=5, burst=10, reserve=5, retries=3, 
+                 timeout=(5, 30), policy=None, breaker=None, probe_interval=30) -> None:
+        if not aiohttp:
+            raise ImportError("aiohttp is required for the async scraper: pip install aiohttp")
+        super().__init__(tokens, calls_left, rate, burst, reserve, retries, timeout, policy, breaker, probe_interval)
+        self.timeout = timeout
+        self.client = None
+
+    async def acquire(self) -> dict:
+        """
+        Pick a token for the next call, waiting until one is available"""
+        while True:
+            if any(e['left'] is None for e in self.entries):
+                await asyncio.to_thread(self.probe)
+            entry, wait = self.try_acquire()
+            if entry:
+                return entry
+            await asyncio.sleep(wait)
+
+    async def request(self, token: str, endpoint: str, payload: dict) -> dict:
+        """
+        Send one request to RocketAPI
+
+        Parameters:
+        token (str): RocketAPI token
+        endpoint (str): RocketAPI endpoint, e.g. instagram/user/get_media
+        payload (dict): Payload of the request"""
+        if not self.client:
+            self.client = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]))
+        async with self.client.post(client.base_url + endpoint, json=payload, headers={
+            "Authorization": f"Token {token}",
+            "User-Agent": f"RocketAPI Python SDK/{builder.sdk_version}",
+        }) as r:
+            if r.status == 429:
+                retry_after = r.headers.get('Retry-After')
+                raise RateLimitedException(f"Rate limited by RocketAPI ({endpoint})",
+                                           float(retry_after) if retry_after and retry_after.isdigit() else None)
+            if r.status >= 500:
+                r.raise_for_status()
+            return unwrap_response(endpoint, await r.json(content_type=None))
+
+    async def call(self, method: str, *args, metrics=None, **kwargs):
+        """
+        Call an InstagramAPI method on the best available token
+
+        Parameters:
+        method (str): Name of the method to call
+        metrics (Metrics): Hook to report the call to"""
+        endpoint, payload = getattr(builder, method)(*args, **kwargs)
+        host = urlparse(client.base_url).hostname
+        for attempt in range(self.retries + 1):
+            self.breaker.check(host)
+            entry = await self.acquire()
+            start = time.perf_counter()
+            try:
+                result = await self.request(entry['token'], endpoint, payload)
+            except Exception as e:
+                self.release(entry, e)
+                # Rate limiting is a problem of the token, not of RocketAPI
+                self.breaker.record(host, isinstance(e, RateLimitedException) or not is_transient(e))
+                if metrics:
+                    metrics.api_call(method, mask_token(entry['token']), time.perf_counter() - start, False, type(e).__name__)
+                if isinstance(e, RateLimitedException) and attempt < self.retries:
+                    continue
+                if is_transient(e) and attempt < self.retries:
+                    await asyncio.sleep(self.policy.delay(attempt, e))
+                    continue
+                raise
+            self.release(entry)
+            self.breaker.record(host, True)
+            if metrics:
+                metrics.api_call(method, mask_token(entry['token']), time.perf_counter() - start, True)
+            return result
+
+    async def close(self) -> None:
+        """
+        Close the aiohttp session"""
+        if self.client:
+            await self.client.close()
+            self.client = None
+
+async def get_scheduler(tokens: list, cache_path=None, ttl=300) -> AsyncTokenScheduler:
+    """
+    Get the async scheduler shared by every async scraper in the process that uses the same
+    tokens, creating it on first use
+
+    Parameters:
+    tokens (list): RocketAPI tokens
+    cache_path (str): Path of the JSON file to cache the token usage in
+    ttl (int): Number of seconds the cached token usage stays valid"""
+    key = tuple(tokens)
+    if key not in schedulers:
+        # The token usage is queried once per process, so it is done in a thread
+        calls_left = await asyncio.to_thread(get_calls_left, tokens, cache_path, ttl)
+        schedulers.setdefault(key, AsyncTokenScheduler(tokens, calls_left))
+    return schedulers[key]
+
+async def close_schedulers() -> None:
+    """
+    Close the sessions of every shared async scheduler"""
+    for scheduler in schedulers.values():
+        await scheduler.close()
+
+class AsyncMediaDownloader():
+    """
+    asyncio counterpart of MediaDownloader. Downloads media on one keep-alive aiohttp session
+    with at most `workers` files in flight, and writes the chunks to disk in worker threads so
+    that the event loop keeps running
+
+    Parameters:
+    workers (int): Maximum number of files downloaded at the same time
+    headers (dict): Headers to send with every request. If not provided, sends a browser User-Agent
+    limit_per_host (int): Maximum number of connections per host. 0 means no limit
+    chunk_size (int): Size of the chunks written to disk, in bytes
+    timeout (tuple): Connect and read timeouts, in seconds. The read timeout applies to every 
+    chunk, not to the whole file
+    policy (RetryPolicy): Retries of transient errors. Defaults to RetryPolicy()
+    breaker (CircuitBreaker): Circuit breakers of the CDN hosts. Defaults to CircuitBreaker()"""
+    def __init__(self, workers=64, headers=None, limit_per_host=0, chunk_size=1024*1024, 
+                 timeout=(5, 30), policy=None, breaker=None) -> None:
+        if not aiohttp:
+            raise ImportError("aiohttp is required for the async scraper: pip install aiohttp")
+        self.workers = workers
+        self.headers = headers if headers else {'User-Agent': user_agent}
+        self.limit_per_host = limit_per_host
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.policy = policy if policy else RetryPolicy()
+        self.breaker = breaker if breaker else CircuitBreaker()
+        self.session = None
+        self.semaphore = None
+
+    def open(self) -> None:
+        """
+        Create the session. It has to be created inside the event loop, so this happens on the
+        first download"""
+        if not self.session:
+            self.semaphore = asyncio.Semaphore(self.workers)
+            connector = aiohttp.TCPConnector(limit=self.workers, limit_per_host=self.limit_per_host)
+            self.session = aiohttp.ClientSession(headers=self.headers, connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1]))
+
+    async def fetch(self, url: str, path: str, fallbacks=(), max_bytes=None) -> int:
+        """
+        Download a single file, retrying transient errors with the retry policy. Fails 
+        immediately with CircuitOpenException while the host's circuit breaker is open. Returns 
+        the size of the file
+
+        Parameters:
+        url (str): URL of the media
+        path (str): Path to save the media to
+        fallbacks (list): Smaller renditions to try if the file is bigger than max_bytes
+        max_bytes (int): Largest file size to download"""
+        for i, url in enumerate([url, *fallbacks]):
+            host = urlparse(url).hostname
+
+            async def attempt():
+                self.breaker.check(host)
+                try:
+                    size = await self.fetch_once(url, path, max_bytes)
+                except Exception as e:
+                    self.breaker.record(host, not is_transient(e))
+                    raise
+                self.breaker.record(host, True)
+                return size
+
+            try:
+                return await self.policy.call_async(attempt)
+            except MediaTooLargeException:
+                if i == len(fallbacks):
+                    raise
+
+    async def fetch_once(self, url: str, path: str, max_bytes=None) -> int:
+        """
+        Download a single file through a temporary file that is renamed into place once
+        complete. Returns the size of the file
+
+        Parameters:
+        url (str): URL of the media
+        path (str): Path to save the media to
+        max_bytes (int): Largest file size to download. Bigger files raise MediaTooLargeException"""
+        self.open()
+        async with self.semaphore:
+            async with self.session.get(url) as r:
+                r.raise_for_status()
+                if max_bytes and r.content_length and r.content_length > max_bytes:
+                    raise MediaTooLargeException(f"{url} is bigger than {max_bytes} bytes")
+                temp_path = temp_name(path, 'part', id(asyncio.current_task()))
+                size, buffer = 0, bytearray()
+                f = await asyncio.to_thread(open, temp_path, 'wb')
+                try:
+                    async for chunk in r.content.iter_chunked(self.chunk_size):
+                        buffer += chunk
+                        size += len(chunk)
+                        if max_bytes and size > max_bytes:
+                            raise MediaTooLargeException(f"{url} is bigger than {max_bytes} bytes")
+                        if len(buffer) >= self.chunk_size:
+                            await asyncio.to_thread(f.write, buffer)
+                            buffer.clear()
+                    await asyncio.to_thread(f.write, buffer)
+                    f.close()
+                    await asyncio.to_thread(os.replace, temp_path, path)
+                except BaseException:
+                    f.close()
+                    os.remove(temp_path)
+                    raise
+        return size
+
+    async def timed_fetch(self, url: str, path: str, fallbacks=(), max_bytes=None) -> tuple:
+        """
+        Download a single file like fetch. Returns the size of the file, the time it took and
+        the error, if any
+
+        Parameters:
+        url (str): URL of the media
+        path (str): Path to save the media to
+        fallbacks (list): Smaller renditions to try if the file is bigger than max_bytes
+        max_bytes (int): Largest file size to download"""
+        start = time.perf_counter()
+        try:
+            return await self.fetch(url, path, fallbacks, max_bytes), time.perf_counter() - start, None
+        except Exception as e:
+            return 0, time.perf_counter() - start, e
+
+    async def run(self, jobs: list):
+        """
+        Download a batch of jobs concurrently, yielding a result for each one as it completes
+
+        Parameters:
+        jobs (list): Dicts with at least 'url' and 'path' keys, and optionally 'fallbacks' and
+        'max_bytes' (see fetch). Each result is the job dict with 'ok' (bool), 'error' (str or
+        None), 'skipped' (True if the media was too large), 'bytes' and 'seconds' added"""
+        async def download(job):
+            size, seconds, error = await self.timed_fetch(job['url'], job['path'], job.get('fallbacks', ()), job.get('max_bytes'))
+            return {**job, 'ok': error is None, 'error': repr(error) if error else None,
+                    'skipped': isinstance(error, MediaTooLargeException), 'bytes': size, 'seconds': seconds}
+
+        for result in asyncio.as_completed([download(job) for job in jobs]):
+            yield await result
+
+    async def close(self) -> None:
+        """
+        Close the session"""
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+class AsyncUserScraper(UserScraper):
+    """
+    asyncio version of UserScraper. Has the same methods as coroutines, and the iter_* methods
+    as async generators. API pagination, media downloads and disk writes overlap in one event
+    loop, so one process can keep hundreds of requests in flight across many users. The user
+    is looked up when the scraper is awaited or entered:
+
+        async with AsyncUserScraper('instagram') as scraper:
+            await scraper.download_user_posts()
+
+    Parameters:
+    user (str): Username or user ID of the user to scrape
+    save (bool): Whether to save the data to disk
+    debug (bool): Whether to print debug messages
+    parent_path (str): Path to save the data to. If not provided, saves to current directory
+    workers (int): Number of media files to download at the same time
+    downloader (AsyncMediaDownloader): Download engine to use. If not provided, creates a new one
+    scheduler (AsyncTokenScheduler): Token scheduler to use. If not provided, uses the one
+    shared by every async scraper in the process
+    compression (str): Compression of the raw API snapshots: None, 'gzip' or 'zstd'
+    keep (int): Number of snapshots to keep for every raw API response. If not provided, keeps
+    every snapshot
+    metrics (Metrics): Hook receiving timings and counters of API calls, downloads and cache
+    lookups
+    blobs (bool): Whether to store media once in the content-addressed store shared by every
+    user under parent_path and hardlink it into the user's directory
+    quality (MediaQuality): Policy choosing which rendition of every image and video to
+    download. If not provided, downloads the largest one
+    index (str): Where to keep the SQLite index of the metadata: 'user', 'global' or None.
+    See UserScraper
+    offline (bool): Whether to build every result from the snapshots saved under raw/ without
+    any network call. See UserScraper
+    responses (ResponseCache): In-memory cache of API responses in front of get_data. If not
+    provided, uses the one shared by every scraper in the process"""
+    def __init__(self, user: str | int, save=True, debug=False, parent_path=None, workers=64,
+                 downloader=None, scheduler=None, compression=None, keep=None, metrics=None,
+                 blobs=False, quality=None, index='user', offline=False, responses=None) -> None:
+        self.owns_downloader = not downloader
+        super().__init__(user, save, debug, parent_path, workers, downloader if downloader else AsyncMediaDownloader(workers),
+                         scheduler, compression, keep, metrics, blobs, quality, index, offline, responses)
+
+    def setup(self, user: str | int) -> None:
+        """
+        Remember the user to look up in start
+
+        Parameters:
+        user (str): Username or user ID of the user to scrape"""
+        self.user = user
+
+    async def start(self):
+        """
+        Get the user's ID and username and set up their directory. Returns the scraper"""
+        if not self.scheduler and not self.offline:
+            self.scheduler = await get_scheduler(self.tokens, f'{self.parent_path}/.usage.json')
+
+        # Getting user ID and username
+        if type(self.user) == str and not self.user.isdigit():
+            self.username = self.user
+            self.setup_directories()
+            self.manifest = await asyncio.to_thread(Manifest, f'{self.parent_path}/{self.username}')
+            self.failures = FailureLog(f'{self.parent_path}/{self.username}/failures.jsonl')
+            self.user_id = await self.get_user_id(self.username)
+        else:
+            self.user_id = int(self.user)
+            self.username = await self.get_username(self.user_id)
+            self.setup_directories()
+            self.manifest = await asyncio.to_thread(Manifest, f'{self.parent_path}/{self.username}')
+            self.failures = FailureLog(f'{self.parent_path}/{self.username}/failures.jsonl')
+
+        # Additional setup
+        self.loaded = await asyncio.to_thread(self.load_loaded)
+        self.index = await asyncio.to_thread(self.open_index)
+        return self
+
+    def __await__(self):
+        return self.start().__await__()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """
+        Close the downloader if the scraper created it"""
+        if self.owns_downloader:
+            await self.downloader.close()
+
+    async def call_api(self, method: str, *args, **kwargs) -> dict:
+        """
+        Call an InstagramAPI method through the token scheduler
+
+        Parameters:
+        method (str): Name of the method to call"""
+        if self.offline:
+            raise CacheMissException(f"Can't call {method} in offline mode")
+        return await self.scheduler.call(method, *args, metrics=self.metrics, **kwargs)
+
+    async def get_data(self, filename: str, update: bool, method: str, *args, **kwargs) -> dict:
+        filename = 'raw/'+filename
+        if self.offline:
+            load = lambda: asyncio.to_thread(self.read_cache, filename, method)
+        else:
+            load = lambda: self.fetch_data(filename, update, method, *args, **kwargs)
+        data, loaded = await self.responses.aget(method, args, kwargs, load, update and not self.offline)
+
+        # The response was loaded by another call, possibly by another scraper
+        if not loaded:
+            self.metrics.cache(method, True)
+            if self.save and not self.offline and not await asyncio.to_thread(self.data_exists, filename):
+                await asyncio.to_thread(self.save_json, data, filename)
+        return data
+
+    async def fetch_data(self, filename: str, update: bool, method: str, *args, **kwargs) -> dict:
+        """
+        Load an API response from disk, or call the API and save the response
+
+        Parameters:
+        filename (str): Name of the snapshot, e.g. raw/user_info
+        update (bool): Whether to call the API even if the response is on disk
+        method (str): Name of the API method to call"""
+        if update or not await asyncio.to_thread(self.data_exists, filename):
+            if not update:
+                self.metrics.cache(method, False)
+            try:
+                data = await self.call_api(method, *args, **kwargs)
+            except Exception as e:
+                await asyncio.to_thread(self.record_failures, [{'kind': 'api', 'filename': filename, 'method': method, 'args': list(args), 'kwargs': kwargs, 'error': repr(e)}])
+                raise
+            if self.save:
+                await asyncio.to_thread(self.save_json, data, filename)
+        else:
+            self.metrics.cache(method, True)
+            data = await asyncio.to_thread(self.load_json, filename)
+        return data
+
+    async def paginate(self, name: str, update: bool, method: str, count: int, has_more, until=None):
+        """
+        Yield every page of a paginated API method, either from the API or from disk. Works like
+        UserScraper.paginate: an interrupted or closed crawl resumes after the last completed
+        page, and the pages that are already on disk are read concurrently
+
+        Parameters:
+        name (str): Name of the pages, e.g. 'followers/followers' for raw/followers/followers_N
+        update (bool): Whether to update the data if it already exists. If False, loads the data
+        from disk
+        method (str): Name of the API method to call
+        count (int): Number of items to request per page
+        has_more (function): Returns whether there is another page after the given page
+        until (function): Returns whether the crawl ends on purpose after the given page, e.g.
+        at a limit. If not provided, the crawl goes on until the last page"""
+        # Offline, the cached crawl is replayed as it is
+        update = update and not self.offline
+        until = until or (lambda data: False)
+
+        if not self.save:
+            # Nothing is saved to disk, so there is nothing to resume from
+            cursor, page = None, 0
+            while True:
+                data = await self.get_data(f'{name}_{page}', update, method, self.user_id, count, cursor)
+                yield data
+                if not has_more(data) or until(data): return
+                cursor, page = data['next_max_id'], page + 1
+
+        directory = os.path.dirname(f'raw/{name}')
+        self.add_directory(directory)
+        cursors = await asyncio.to_thread(CursorLog, f"{self.parent_path}/{self.username}/{directory}/cursors.jsonl")
+
+        # Starting a new crawl unless the previous one was interrupted
+        if update and (cursors.complete or cursors.stopped or not cursors.pages):
+            await asyncio.to_thread(cursors.start)
+
+        async def ends(data):
+            # Closing the generator (e.g. on an error) isn't recorded, so the crawl can resume
+            if not until(data):
+                return False
+            if update and not cursors.complete:
+                await asyncio.to_thread(cursors.stop)
+            return True
+
+        # Reading the pages completed in the latest crawl from disk concurrently
+        filenames = [f'raw/{name}_{page}' for page in range(cursors.pages)]
+        window = self.workers * 4
+        for start in range(0, len(filenames), window):
+            for data in await asyncio.gather(*[asyncio.to_thread(self.load_json, f) for f in filenames[start:start + window]]):
+                end = await ends(data)
+                yield data
+                if end: return
+        if cursors.complete:
+            return
+
+        # Offline, an unfinished crawl ends at the last page it completed
+        if self.offline:
+            return
+
+        # Getting the remaining pages from the API or from disk
+        page = cursors.pages
+        while True:
+            data = await self.get_data(f'{name}_{page}', update, method, self.user_id, count, cursors.cursors[page])
+            await asyncio.to_thread(cursors.add, data['next_max_id'] if has_more(data) else None)
+            end = await ends(data)
+            yield data
+            if cursors.complete or end: return
+            page += 1
+
+    async def get_user_id(self, username: str, update=False) -> int:
+        """
+        Get the user ID of a user by their username
+
+        Parameters:
+        username (str): Username of the user
+        update (bool): Whether to update the data if it already exists. If False, loads the data
+        from disk"""
+
+        if self.debug:
+            print(f"Getting user ID for {username}")
+
+        data = await self.get_data('basic_user_info', update, 'get_user_info', username)
+        self.is_private = data['data']['user']['is_private']
+        return int(data['data']['user']['id'])
+
+    async def get_username(self, user_id: int) -> str:
+        """
+        Get the username of a user by their user ID
+
+        Parameters:
+        user_id (int): User ID of the user"""
+
+        if self.debug:
+            print(f"Getting username for user with id {user_id}")
+
+        if self.offline:
+            return await asyncio.to_thread(self.find_username, user_id)
+
+        # Sharing the response with get_user_info through the response cache
+        data, _ = await self.responses.aget('get_user_info_by_id', (user_id,), {}, lambda: self.call_api('get_user_info_by_id', user_id))
+        self.username = data['user']['username']
+        self.is_private = data['user']['is_private']
+        return data['user']['username']
+
+    async def get_user_info(self, user_id: int, update=False) -> dict:
+        """
+        Get the user info of a user by their user ID
+
+        Parameters:
+        user_id (int): User ID of the user
+        update (bool): Whether to update the data if it already exists. If False, loads
+        the data from disk"""
+
+        if self.debug:
+            print(f"Getting user info for user {self.username}")
+
+        data = await self.get_data('user_info', update, 'get_user_info_by_id', user_id)
+        return data['user']
+
+    async def download_user_info(self, user_info=None, update=False) -> None:
+        """
+        Download user info to disk
+
+        Parameters:
+        user_info (dict): User info data. If not provided, gets the data from the API
+        update (bool): Whether to update the data if it already exists. If False, loads
+        the data from disk"""
+
+        if self.debug:
+            print(f"Downloading user info for user {self.username}")
+
+        # Getting user info from API if not provided
+        if not user_info:
+            user_info = await self.get_user_info(self.user_id, update=update)
+
+        if update: await asyncio.to_thread(self.save_json, self.user_info_data(user_info), 'user_info')
+
+        # Saving profile picture
+        urls = self.profile_pic_urls(user_info)
+        await self.download_media(urls[0], 'propic.jpg', fallbacks=urls[1:])
+
+    async def download_media(self, url: str, filename: str, media_id=None, fallbacks=(), blob_id=None) -> None:
+        """
+        Download media from a URL. With the blob store, media that is already stored is linked
+        without downloading it. Media bigger than the max_bytes of the quality policy is skipped
+
+        Parameters:
+        url (str): URL of the media
+        filename (str): Name of the file to save the media to
+        media_id (str): Instagram media ID
+        fallbacks (list): URLs of smaller renditions to try if the media is too big
+        blob_id (str): ID of the chosen rendition in the blob store (see MediaQuality.blob_id)"""
+        if self.offline:
+            return
+        path = f"{self.parent_path}/{self.username}/{filename}"
+        if self.blobs and blob_id is not None and self.blobs.get(blob_id, os.path.splitext(path)[1]):
+            await asyncio.to_thread(self.blobs.link, self.blobs.get(blob_id, os.path.splitext(path)[1]), path)
+            return
+
+        size, seconds, error = await self.downloader.timed_fetch(url, path, fallbacks, self.quality.max_bytes)
+        self.metrics.download(urlparse(url).hostname, size, seconds, error is None)
+        if isinstance(error, MediaTooLargeException):
+            return
+        if error:
+            await asyncio.to_thread(self.record_failures, [{'kind': 'media', 'key': None, 'id': media_id, 'blob_id': blob_id, 'url': url, 'fallbacks': list(fallbacks), 'filename': filename, 'error': repr(error)}])
+            raise error
+        if self.blobs:
+            await asyncio.to_thread(self.blobs.add, path, blob_id)
+
+    async def run_loaded(self, function, *args):
+        """
+        Run a function that changes or saves the loaded list on the thread shared by every async
+        scraper for it. Adding media can write the list to disk, and concurrent batches would
+        otherwise change it from several threads
+
+        Parameters:
+        function (function): Function to run"""
+        return await asyncio.get_running_loop().run_in_executor(loaded_writer, function, *args)
+
+    async def download_media_batch(self, jobs: list, key: str) -> list:
+        """
+        Download media concurrently, skipping media that was already loaded. Returns one result
+        per downloaded job, like UserScraper.download_media_batch
+
+        Parameters:
+        jobs (list): Jobs created with media_job
+        key (str): Loaded list the media belongs to ('posts', 'stories' or 'highlights')"""
+        pending = self.pending_jobs(jobs, key)
+
+        results = []
+        try:
+            # Linking the media that is already in the blob store
+            if self.blobs:
+                stored = [(job, self.find_blob(job)) for job in pending]
+                pending = [job for job, blob in stored if not blob]
+                for job, blob in stored:
+                    if blob:
+                        results.append(await self.run_loaded(self.link_blob, job, blob, key))
+
+            async for result in self.downloader.run(pending):
+                results.append(result)
+                self.metrics.download(urlparse(result['url']).hostname, result['bytes'], result['seconds'], result['ok'])
+                if not result['ok']:
+                    if self.debug:
+                        print(f"Failed to download {result['filename']}: {result['error']}")
+                    continue
+                if self.blobs:
+                    await asyncio.to_thread(self.blobs.add, result['path'], result.get('blob_id'))
+
+                # Adding the media to the loaded list
+                await self.run_loaded(self.loaded.add, key, result['id'])
+        finally:
+            await self.run_loaded(self.save_loaded)
+            await asyncio.to_thread(self.record_failures, self.media_failures(results, key))
+        return results
+
+    async def retry_failures(self) -> list:
+        """
+        Retry the API calls and media downloads recorded in failures.jsonl. See 
+        UserScraper.retry_failures"""
+        if self.offline:
+            raise CacheMissException("Can't retry failures in offline mode")
+        entries = await asyncio.to_thread(self.failures.take)
+
+        if self.debug:
+            print(f"Retrying {len(entries)} failure(s) for user {self.username}")
+
+        # Retrying the API calls and saving their responses
+        async def retry_api(entry):
+            try:
+                await self.get_data(entry['filename'][len('raw/'):], True, entry['method'], *entry['args'], **entry['kwargs'])
+                return {**entry, 'ok': True, 'error': None}
+            except Exception as e:
+                return {**entry, 'ok': False, 'error': repr(e)}
+        results = list(await asyncio.gather(*[retry_api(e) for e in entries if e['kind'] == 'api']))
+
+        # Retrying the downloads, grouped by loaded list
+        media = [e for e in entries if e['kind'] == 'media']
+        for key in dict.fromkeys(e['key'] for e in media):
+            jobs = [{'id': e['id'], 'blob_id': e.get('blob_id'), 'url': e['url'], 'fallbacks': e.get('fallbacks', []), 'filename': e['filename']} for e in media if e['key'] == key]
+            if key:
+                results += await self.download_media_batch(jobs, key)
+                continue
+            for job in jobs:
+                try:
+                    await self.download_media(job['url'], job['filename'], job['id'], job['fallbacks'], job['blob_id'])
+                    results.append({**job, 'ok': True, 'error': None})
+                except Exception as e:
+                    results.append({**job, 'ok': False, 'error': repr(e)})
+        return results
+
+    async def iter_user_posts(self, limit=None, update=False):
+        """
+        Get user posts page by page. Yields a list of posts for every page
+
+        Parameters:
+        limit (int): Maximum number of posts to get. If not provided, gets all posts
+        update (bool): Whether to update the data if it already exists. If False, loads
+        the data from disk"""
+
+        if self.debug:
+            print(f"Getting user posts for user {self.username}")
+
+        if not limit:
+            limit = 999_999_999_999
+
+        async with aclosing(self.paginate('posts/posts', update, 'get_user_media', 50, lambda data: data['more_available'], page_limit('items', limit))) as pages:
+            async for data in pages:
+                yield data['items']
+
+    async def get_user_posts(self, limit=None, update=False) -> list:
+        """
+        Get user posts
+
+        Parameters:
+        limit (int): Maximum number of posts to get. If not provided, gets all posts
+        update (bool): Whether to update the data if it already exists. If False, loads
+        the data from disk"""
+        return [post async for page in self.iter_user_posts(limit, update=update) for post in page]
+
+    async def download_user_posts(self, posts=None, limit=None, update=False) -> list:
+        """
+        Download user posts to disk. The media of every page is downloaded while the next page
+        is requested
+
+        Parameters:
+        posts (list): User posts data. If not provided, gets the data from the API
+        limit (int): Maximum number of posts to download. If not provided, downloads all posts
+        update (bool): Whether to update the data if it already exists. If False, loads
+        the data from disk"""
+
+        if self.debug:
+            print(f"Downloading user posts for user {self.username}")
+
+        if not limit:
+            limit = 999_999_999_999
+
+        # Getting user posts page by page if not provided
+        pages = aiter_list([posts]) if posts else self.iter_user_posts(limit, update=update)
+
+        batches, n = [], 0
+        async with aclosing(pages):
+            async for page in pages:
+                # Collecting the media of every post on the page
+                jobs, writes, records = [], [], []
+                for post in page:
+                    if n >= limit:
+                        break
+                    n += 1
+                    date = datetime.fromtimestamp(post['taken_at']).strftime('%Y-%m-%d %Hh%Mm%Ss')
+                    self.add_directory(f'posts/post_{date}')
+
+                    # Loading every image/video in the post
+                    images = post['carousel_media'] if 'carousel_media' in post else [post]
+                    jobs += [self.media_job(image, f'posts/post_{date}/{i}') for i, image in enumerate(images)]
+                    records.append({**self.post_data(post), 'path': f'posts/post_{date}'})
+
+                    # Saving additional data
+                    if update or not await asyncio.to_thread(self.data_exists, f'posts/post_{date}/data'):
+                        writes.append(asyncio.to_thread(self.save_json, self.post_data(post), f'posts/post_{date}/data'))
+                if self.index:
+                    writes.append(asyncio.to_thread(self.index.add_posts, self.username, records))
+                await asyncio.gather(*writes)
+
+                # Downloading every image/video on the page in the background. Like the pipeline of
+                # UserScraper, the number of pages downloading at the same time is bounded
+                running = [batch for batch in batches if not batch.done()]
+                if len(running) >= 2:
+                    await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                batches.append(asyncio.create_task(self.download_media_batch(jobs, 'posts')))
+                if n >= limit:
+                    break
+        return [result for batch in await asyncio.gather(*batches) for result in batch]
+
+    async def get_user_stories(self) -> list:
+        """
+        Get user stories"""
+
+        if self.debug:
+            print(f"Getting user stories for user {self.username}")
+
+        # Replaying the latest stories snapshot
+        if self.offline:
+            data = await asyncio.to_thread(self.read_cache, 'raw/stories', 'get_user_stories')
+            reel = data['reels'].get(str(self.user_id))
+            return reel['items'] if reel else []
+
+        # Getting stories data from the API
+        data = await self.call_api('get_user_stories', self.user_id)
+        await asyncio.to_thread(self.save_json, data, 'raw/stories')
+        return data['reels'][str(self.user_id)]['items']
+
+    async def download_user_stories(self, stories=None) -> list:
+        """
+        Download user stories to disk
+
+        Parameters:
+        stories (list): User stories data. If not provided, gets the data from the API"""
+
+        # Getting user stories if not provided
+        if not stories:
+            stories = await self.get_user_stories()
+
+        if self.debug:
+            print(f"Downloading user stories for user {self.username}")
+
+        jobs, writes = [], []
+        if self.index:
+            writes.append(asyncio.to_thread(self.index.add_stories, self.username, [{
+                **self.story_data(story),
+                'path': f"stories/story_{datetime.fromtimestamp(story['taken_at']).strftime('%Y-%m-%d %Hh%Mm%Ss')}"
+            } for story in stories]))
+        for story in stories:
+            # Skipping if the story was already loaded
+            if story['id'] in self.loaded['stories']:
+                continue
+
+            date = datetime.fromtimestamp(story['taken_at']).strftime('%Y-%m-%d %Hh%Mm%Ss')
+            writes.append(asyncio.to_thread(self.save_json, self.story_data(story), f'stories/story_{date}'))
+            jobs.append(self.media_job(story, f'stories/story_{date}'))
+        await asyncio.gather(*writes)
+
+        # Downloading every story
+        return await self.download_media_batch(jobs, 'stories')
+
+    async def get_user_highlights(self, update=False) -> list:
+        """
+        Get user highlights. The stories of every highlight are requested concurrently
+
+        Parameters:
+        update (bool): Whether to update the data if it already exists. If False,
+        loads the data from disk"""
+
+        if self.debug:
+            print(f"Getting user highlights for user {self.username}")
+
+        # Loading highlights data from the API or from disk
+        data = await self.get_data('highlights', update, 'get_user_highlights', self.user_id)
+        highlights = [{'title': h['node']['title'], 'id': h['node']['id']} for h in data['data']['user']['edge_highlight_reels']['edges']]
+
+        # Getting stories data for each highlight
+        stories = await asyncio.gather(*[self.get_data(f'highlights/{highlight["title"]}', update, 'get_highlight_stories', highlight['id'])
+                                         for highlight in highlights])
+        for highlight, data in zip(highlights, stories):
+            highlight['items'] = data['reels'][f'highlight:{highlight["id"]}']['items']
+        return highlights
+
+    async def download_user_highlights(self, highlights=None, update=False) -> list:
+        """
+        Download user highlights to disk
+
+        Parameters:
+        highlights (list): User highlights data. If not provided, gets the data from the API
+        update (bool): Whether to update the data if it already exists. If False,
+        loads the data from disk"""
+
+        # Getting user highlights if not provided
+        if not highlights:
+            highlights = await self.get_user_highlights(update=update)
+
+        if self.debug:
+            print(f"Downloading user highlights for user {self.username}")
+
+        # Collecting every story in every highlight
+        jobs, writes = [], []
+        for highlight in highlights:
+            self.add_directory(f'highlights/{highlight["title"]}')
+            if self.save and (update or not await asyncio.to_thread(self.data_exists, f'highlights/{highlight["title"]}/data')):
+                writes.append(asyncio.to_thread(self.save_json, self.highlight_data(highlight), f'highlights/{highlight["title"]}/data'))
+            records = []
+            for story in highlight['items']:
+                date = datetime.fromtimestamp(story['taken_at']).strftime('%Y-%m-%d %Hh%MMmSs')
+                jobs.append(self.media_job(story, f'highlights/{highlight["title"]}/story_{date}'))
+                records.append({**self.story_data(story), 'path': f'highlights/{highlight["title"]}/story_{date}'})
+            if self.index:
+                writes.append(asyncio.to_thread(self.index.add_stories, self.username, records, highlight['title']))
+        await asyncio.gather(*writes)
+
+        # Downloading every story
+        return await self.download_media_batch(jobs, 'highlights')
+
+    async def iter_users(self, kind: str, count: int, limit=None, update=False):
+        """
+        Get the followers or following of the user page by page. Yields a list of users for
+        every page
+
+        Parameters:
+        kind (str): 'followers' or 'following'
+        count (int): Number of users to request per page
+        limit (int): Maximum number of users to get. If not provided, gets all of them
+        update (bool): Whether to update the data if it already exists. If False,
+        loads the data from disk"""
+
+        if self.debug:
+            print(f"Getting user {kind} for user {self.username}")
+
+        if not limit:
+            limit = 999_999_999_999
+
+        async with aclosing(self.paginate(f'{kind}/{kind}', update, f'get_user_{kind}', count, lambda data: 'next_max_id' in data, page_limit('users', limit))) as pages:
+            async for data in pages:
+                yield data['users']
+
+    def iter_user_followers(self, limit=None, update=False):
+        """
+        Get user followers page by page. Yields a list of users for every page
+
+        Parameters:
+        limit (int): Maximum number of followers to get. If not provided, gets all followers
+        update (bool): Whether to update the data if it already exists. If False,
+        loads the data from disk"""
+        return self.iter_users('followers', 100, limit, update)
+
+    def iter_user_following(self, limit=None, update=False):
+        """
+        Get user following page by page. Yields a list of users for every page
+
+        Parameters:
+        limit (int): Maximum number of users to get. If not provided, gets all of them
+        update (bool): Whether to update the data if it already exists. If False,
+        loads the data from disk"""
+        return self.iter_users('following', 200, limit, update)
+
+    async def get_user_followers(self, limit=None, update=False) -> list:
+        """
+        Get user followers
+
+        Parameters:
+        limit (int): Maximum number of followers to get. If not provided, gets all followers
+        update (bool): Whether to update the data if it already exists. If False,
+        loads the data from disk"""
+        return [user async for page in self.iter_user_followers(limit, update=update) for user in page]
+
+    async def get_user_following(self, limit=None, update=False) -> list:
+        """
+        Get user following
+
+        Parameters:
+        limit (int): Maximum number of users to get. If not provided, gets all of them
+        update (bool): Whether to update the data if it already exists. If False,
+        loads the data from disk"""
+        return [user async for page in self.iter_user_following(limit, update=update) for user in page]
+
+    async def download_user_followers(self, followers=None, limit=None, update=False) -> int:
+        """
+        Download user followers to disk, page by page. Returns the number of followers
+
+        Parameters:
+        followers (list): User followers data. If not provided, gets the data from the API
+        limit (int): Maximum number of followers to download. If not provided, downloads all followers
+        update (bool): Whether to update the data if it already exists. If False,
+        loads the data from disk"""
+
+        if self.debug:
+            print(f"Downloading user followers for user {self.username}")
+
+        pages = aiter_list([followers]) if followers else self.iter_user_followers(limit, update=update)
+        write = self.save and (update or not await asyncio.to_thread(self.data_exists, 'followers/followers_full'))
+        return await self.save_users(pages, 'followers/followers', write, complete=not (followers or limit))
+
+    async def download_user_following(self, following=None, limit=None, update=False) -> int:
+        """
+        Download user following to disk, page by page. Returns the number of users followed
+
+        Parameters:
+        following (list): User following data. If not provided, gets the data from the API
+        limit (int): Maximum number of following to download. If not provided, downloads all following
+        update (bool): Whether to update the data if it already exists. If False,
+        loads the data from disk"""
+
+        if self.debug:
+            print(f"Downloading user following for user {self.username}")
+
+        pages = aiter_list([following]) if following else self.iter_user_following(limit, update=update)
+        write = self.save and (update or not await asyncio.to_thread(self.data_exists, 'following/following_full'))
+        return await self.save_users(pages, 'following/following', write, complete=not (following or limit))
+
+    @asynccontextmanager
+    async def open_jsonl(self, filename: str, aliases=()):
+        """
+        Open a new JSON Lines file for writing data incrementally, like UserScraper.open_jsonl.
+        The file is opened, published and added to the manifest on a worker thread
+
+        Parameters:
+        filename (str): Name of the file to save the data to
+        aliases (list): Other names to add the file to the manifest under"""
+        context = super().open_jsonl(filename, aliases)
+        f = await asyncio.to_thread(context.__enter__)
+        try:
+            yield f
+        except BaseException as e:
+            await asyncio.to_thread(context.__exit__, type(e), e, e.__traceback__)
+            raise
+        await asyncio.to_thread(context.__exit__, None, None, None)
+
+    async def save_users(self, pages, filename: str, write=True, complete=False) -> int:
+        """
+        Stream lists of users to a full and a short JSON Lines file, one user per line, and to
+        the metadata index. Returns the number of users
+
+        Parameters:
+        pages (async iterable): Lists of users
+        filename (str): Name of the files without the suffix, e.g. followers/followers
+        write (bool): Whether to write the files. If False, only counts and indexes the users
+        complete (bool): Whether the pages contain every user, in which case the users that
+        aren't in them are removed from the index and the full list is also saved as
+        [filename]_complete in the manifest"""
+        kind, updated = filename.split('/')[0], time.time()
+        count = 0
+        async with aclosing(pages):
+            if not write:
+                async for users in pages:
+                    if self.index:
+                        await asyncio.to_thread(self.index.add_users, self.username, kind, users, updated)
+                    count += len(users)
+            else:
+                aliases = [f'{filename}_complete'] if complete else []
+                async with self.open_jsonl(f'{filename}_full', aliases) as full, self.open_jsonl(f'{filename}_short') as short:
+                    async for users in pages:
+                        await asyncio.to_thread(full.write, ''.join(json.dumps(user) + '\n' for user in users))
+                        await asyncio.to_thread(short.write, ''.join(json.dumps(self.short_user(user)) + '\n' for user in users))
+                        if self.index:
+                            await asyncio.to_thread(self.index.add_users, self.username, kind, users, updated)
+                        count += len(users)
+
+        if self.index and complete:
+            await asyncio.to_thread(self.index.remove_users_before, self.username, kind, updated)
+        return count
+
+    async def sync_user_posts(self) -> list:
+        """
+        Download only the posts published since the previous sync. See UserScraper.sync_user_posts"""
+
+        if self.debug:
+            print(f"Syncing user posts for user {self.username}")
+
+        state = await asyncio.to_thread(self.load_sync_state)
+        newest = state['posts']['taken_at'] if state['posts'] else 0
+
+        # Paging through separate pages and cursors, so the pages of the latest crawl stay intact
+        # Pinned posts can be older than the newest post, so they don't end the sync
+        caught_up = lambda data: any(post['taken_at'] <= newest and not post.get('timeline_pinned_user_ids') for post in data['items'])
+        new = []
+        async with aclosing(self.paginate('posts/sync/posts', True, 'get_user_media', 50, lambda data: data['more_available'], caught_up)) as pages:
+            async for data in pages:
+                new += [post for post in data['items'] if post['taken_at'] > newest]
+        if not new:
+            return []
+
+        results = await self.download_user_posts(posts=new)
+        latest = max(new, key=lambda post: post['taken_at'])
+        state['posts'] = {'taken_at': latest['taken_at'], 'id': latest['id']}
+        await asyncio.to_thread(self.save_sync_state, state)
+        return results
+
+    async def sync_user_highlights(self) -> list:
+        """
+        Download only the highlight stories that weren't downloaded before, both in new
+        highlights and added to existing ones. See UserScraper.sync_user_highlights. The bulk
+        requests are sent concurrently"""
+
+        if self.debug:
+            print(f"Syncing user highlights for user {self.username}")
+
+        state = await asyncio.to_thread(self.load_sync_state)
+        data = await self.get_data('highlights', True, 'get_user_highlights', self.user_id)
+        highlights = self.due_highlights(data, state)
+
+        # Getting the stories of the due highlights in bulk
+        chunks = [highlights[start:start + highlights_per_request] for start in range(0, len(highlights), highlights_per_request)]
+        stories = await asyncio.gather(*[self.get_data(f'highlights/sync/stories_{i}', True, 'get_highlight_stories_bulk', [h['id'] for h in chunk])
+                                         for i, chunk in enumerate(chunks)])
+        for chunk, data_chunk in zip(chunks, stories):
+            for highlight in chunk:
+                highlight['items'] = data_chunk['reels'].get(f'highlight:{highlight["id"]}', {}).get('items', [])
+
+        changed = [h for h in highlights if any(item['id'] not in self.loaded['highlights'] for item in h['items'])]
+        results = await self.download_user_highlights(highlights=changed, update=True) if changed else []
+        state['highlights'] = {edge['node']['id']: edge['node'].get('latest_reel_media') for edge in data['data']['user']['edge_highlight_reels']['edges']}
+        await asyncio.to_thread(self.save_sync_state, state)
+        return results
+
+    async def sync_users(self, kind: str, full=False) -> dict:
+        """
+        Sync the followers or following of the user. See UserScraper.sync_users
+
+        Parameters:
+        kind (str): 'followers' or 'following'
+        full (bool): Whether to read every page to detect removed users"""
+
+        if self.debug:
+            print(f"Syncing user {kind} for user {self.username}")
+
+        self.add_directory(kind)
+        known = await asyncio.to_thread(SyncedIds, f'{self.parent_path}/{self.username}/{kind}/sync.jsonl')
+        added, seen, complete = [], set(), True
+
+        # Paging through separate pages and cursors, so the pages of the latest crawl stay intact
+        count = {'followers': 100, 'following': 200}[kind]
+        caught_up = lambda data: bool(known.ids) and not full and all(user['pk'] in known.ids for user in data['users'])
+        async with aclosing(self.paginate(f'{kind}/sync/{kind}', True, f'get_user_{kind}', count, lambda data: 'next_max_id' in data, caught_up)) as pages:
+            async for data in pages:
+                users = data['users']
+                added += [user for user in users if user['pk'] not in known.ids]
+                seen.update(user['pk'] for user in users)
+                if caught_up(data):
+                    complete = False
+
+        removed = [user_id for user_id in known.ids if user_id not in seen] if complete else []
+        await asyncio.to_thread(known.update, [user['pk'] for user in added], removed)
+        if self.index:
+            await asyncio.to_thread(self.index.add_users, self.username, kind, added, time.time())
+            await asyncio.to_thread(self.index.remove_users, self.username, kind, removed)
+        if self.save:
+            await asyncio.to_thread(self.save_json, {'added': added, 'removed': removed, 'complete': complete}, f'{kind}/{kind}_diff')
+        return {'added': added, 'removed': removed}
+
+    async def sync_user_followers(self, full=False) -> dict:
+        """
+        Sync the followers of the user, getting only the new ones. See sync_users
+
+        Parameters:
+        full (bool): Whether to read every page to detect removed followers"""
+        return await self.sync_users('followers', full)
+
+    async def sync_user_following(self, full=False) -> dict:
+        """
+        Sync the users followed by the user, getting only the new ones. See sync_users
+
+        Parameters:
+        full (bool): Whether to read every page to detect unfollowed users"""
+        return await self.sync_users('following', full)
+
+    async def rebuild_index(self) -> None:
+        """
+        Fill the metadata index from the data already on disk. See UserScraper.rebuild_index"""
+        await asyncio.to_thread(super().rebuild_index)
+
+    async def query_posts(self, *args, **kwargs) -> list:
+        """
+        Query the posts in the metadata index. See UserScraper.query_posts"""
+        return await asyncio.to_thread(super().query_posts, *args, **kwargs)
+
+    async def query_stories(self, *args, **kwargs) -> list:
+        """
+        Query the stories in the metadata index. See UserScraper.query_stories"""
+        return await asyncio.to_thread(super().query_stories, *args, **kwargs)
+
+    async def query_users(self, *args, **kwargs) -> list:
+        """
+        Query the followers or following in the metadata index. See UserScraper.query_users"""
+        return await asyncio.to_thread(super().query_users, *args, **kwargs)
+
+async def aiter_list(items: list):
+    """
+    Turn a list into an async generator
+
+    Parameters:
+    items (list): Items to yield"""
+    for item in items:
+        yield item
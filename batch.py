@@ -0,0 +1,160 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+import argparse
+import json
+import os
+import time
+from api import UserScraper
+from downloader import MediaDownloader, MediaQuality
+
+tasks = {
+    'info': lambda scraper, update, limit: scraper.download_user_info(update=update),
+    'posts': lambda scraper, update, limit: scraper.download_user_posts(limit=limit, update=update),
+    'followers': lambda scraper, update, limit: scraper.download_user_followers(limit=limit, update=update),
+    'following': lambda scraper, update, limit: scraper.download_user_following(limit=limit, update=update),
+    'stories': lambda scraper, update, limit: scraper.download_user_stories(),
+    'highlights': lambda scraper, update, limit: scraper.download_user_highlights(update=update),
+    'sync_posts': lambda scraper, update, limit: scraper.sync_user_posts(),
+    'sync_highlights': lambda scraper, update, limit: scraper.sync_user_highlights(),
+    'sync_followers': lambda scraper, update, limit: len(scraper.sync_user_followers(full=update)['added']),
+    'sync_following': lambda scraper, update, limit: len(scraper.sync_user_following(full=update)['added']),
+    'retry': lambda scraper, update, limit: scraper.retry_failures()
+}
+
+def read_users(path: str) -> list:
+    """
+    Read usernames or user IDs from a file, one per line. Empty lines and lines starting with #
+    are ignored
+
+    Parameters:
+    path (str): Path of the file"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+def crawl_user(user: str, jobs: list, update=False, limit=None, parent_path=None, downloader=None, blobs=False,
+               quality=None, index='user', offline=False) -> dict:
+    """
+    Run the given tasks for one user and report how they went
+
+    Parameters:
+    user (str): Username or user ID
+    jobs (list): Names of the tasks to run (see tasks)
+    update (bool): Whether to update the data if it already exists
+    limit (int): Maximum number of posts, followers or following to download
+    parent_path (str): Path to save the data to
+    downloader (MediaDownloader): Download engine shared by every user
+    blobs (bool): Whether to deduplicate media in the blob store shared by every user
+    quality (MediaQuality): Policy choosing which rendition of every media to download
+    index (str): Where to keep the metadata index: 'user', 'global' or None
+    offline (bool): Whether to replay the cached API responses without any network call"""
+    summary = {'user': user, 'ok': True, 'error': None, 'items': 0, 'failed': 0, 'tasks': {}}
+    start = time.monotonic()
+    try:
+        scraper = UserScraper(user, parent_path=parent_path, downloader=downloader, blobs=blobs, quality=quality, index=index,
+                              offline=offline)
+        for job in jobs:
+            if scraper.is_private and job != 'info':
+                summary['tasks'][job] = {'skipped': 'private'}
+                continue
+            task_start = time.monotonic()
+            result = tasks[job](scraper, update, limit)
+
+            # Download methods return one result per media file, follower methods the number of users
+            items = len(result) if isinstance(result, list) else result if isinstance(result, int) else 0
+            failed = sum(1 for r in result if not r['ok']) if isinstance(result, list) else 0
+            summary['tasks'][job] = {'seconds': round(time.monotonic() - task_start, 3), 'items': items, 'failed': failed}
+            summary['items'] += items
+            summary['failed'] += failed
+    except Exception as e:
+        summary['ok'] = False
+        summary['error'] = repr(e)
+    summary['seconds'] = round(time.monotonic() - start, 3)
+    summary['items_per_second'] = round(summary['items'] / summary['seconds'], 2) if summary['seconds'] else 0
+    return summary
+
+def crawl(users: list, jobs: list, workers=4, update=False, limit=None, parent_path=None,
+          download_workers=16, debug=False, blobs=False, quality=None, index='user', offline=False) -> dict:
+    """
+    Crawl many users on a pool of worker threads. Every worker shares the token scheduler and
+    the media download pool. Data is saved to the usual [parent_path]/[username]/ layout and a
+    summary is saved to [parent_path]/batch_[timestamp].json
+
+    Parameters:
+    users (list): Usernames or user IDs to crawl
+    jobs (list): Names of the tasks to run for every user (see tasks)
+    workers (int): Number of users crawled at the same time
+    update (bool): Whether to update the data if it already exists
+    limit (int): Maximum number of posts, followers or following to download per user
+    parent_path (str): Path to save the data to. If not provided, saves to current directory
+    download_workers (int): Number of media files downloaded at the same time across all users
+    debug (bool): Whether to print the progress
+    blobs (bool): Whether to store every media file once in [parent_path]/.blobs and hardlink it
+    into the users' directories
+    quality (MediaQuality): Policy choosing which rendition of every media to download. If not 
+    provided, downloads the largest one
+    index (str): Where to keep the metadata index: 'user' for one database per user, 'global' 
+    for [parent_path]/index.db shared by every user, or None
+    offline (bool): Whether to rebuild every result from the cached API responses under raw/ 
+    without any network call or token, e.g. to reindex already collected data"""
+    parent_path = parent_path if parent_path else "."
+    downloader = MediaDownloader(download_workers)
+    start = time.monotonic()
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(crawl_user, user, jobs, update, limit, parent_path, downloader, blobs, quality, index, offline)
+                       for user in users]
+            for future in as_completed(futures):
+                results.append(future.result())
+                if debug:
+                    r = results[-1]
+                    print(f"[{len(results)}/{len(users)}] {r['user']}: {'ok' if r['ok'] else r['error']} "
+                          f"({r['items']} items, {r['failed']} failed, {r['seconds']}s)")
+    finally:
+        downloader.close()
+
+    seconds = time.monotonic() - start
+    summary = {
+        'users': len(users),
+        'succeeded': sum(1 for r in results if r['ok']),
+        'failed': sum(1 for r in results if not r['ok']),
+        'items': sum(r['items'] for r in results),
+        'seconds': round(seconds, 3),
+        'users_per_second': round(len(users) / seconds, 3) if seconds else 0,
+        'items_per_second': round(sum(r['items'] for r in results) / seconds, 2) if seconds else 0,
+        'results': results
+    }
+    os.makedirs(parent_path, exist_ok=True)
+    with open(f"{parent_path}/batch_{datetime.now().strftime('%Y-%m-%d %Hh%Mm%Ss')}.json", 'w', encoding='utf-8') as f:
+        json.dump(summary, f)
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crawl many Instagram users at once')
+    parser.add_argument('users', help='File with one username or user ID per line')
+    parser.add_argument('--tasks', default='info,posts', help=f"Comma-separated tasks to run: {','.join(tasks)}")
+    parser.add_argument('--workers', type=int, default=4, help='Number of users crawled at the same time')
+    parser.add_argument('--download-workers', type=int, default=16, help='Number of media files downloaded at the same time')
+    parser.add_argument('--update', action='store_true', help='Update data that already exists')
+    parser.add_argument('--limit', type=int, default=None, help='Maximum number of posts, followers or following per user')
+    parser.add_argument('--parent-path', default=None, help='Path to save the data to')
+    parser.add_argument('--blobs', action='store_true', help='Download and store media shared by several users only once')
+    parser.add_argument('--max-width', type=int, default=None, help='Largest width of the images and videos to download')
+    parser.add_argument('--max-bytes', type=int, default=None, help='Largest size of the media files to download')
+    parser.add_argument('--thumbnails', action='store_true', help='Download only the smallest image of every media')
+    parser.add_argument('--skip-video', action='store_true', help='Download the cover image of videos instead of the video')
+    parser.add_argument('--index', default='user', choices=['user', 'global', 'none'], help='Where to keep the SQLite metadata index')
+    parser.add_argument('--offline', action='store_true', help='Replay the cached API responses without any network call')
+    args = parser.parse_args()
+
+    jobs = args.tasks.split(',')
+    for job in jobs:
+        if job not in tasks:
+            parser.error(f"Unknown task {job}")
+
+    summary = crawl(read_users(args.users), jobs, args.workers, args.update, args.limit,
+                    args.parent_path, args.download_workers, debug=True, blobs=args.blobs,
+                    quality=MediaQuality(args.max_width, args.max_bytes, args.thumbnails, args.skip_video),
+                    index=None if args.index == 'none' else args.index, offline=args.offline)
+    print(f"Done! {summary['succeeded']}/{summary['users']} users, {summary['items']} items in {summary['seconds']}s "
+          f"({summary['items_per_second']} items/s)")
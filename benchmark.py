@@ -0,0 +1,315 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class MockRocketAPIHandler(BaseHTTPRequestHandler):
+    """
+    Emulates the RocketAPI endpoints used by UserScraper and a CDN serving synthetic media"""
+    user_id = 1000
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def send_json(self, data: dict, status=200) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_body(self, body: dict) -> None:
+        """
+        Send an Instagram response wrapped the way RocketAPI wraps it"""
+        self.send_json({'status': 'done', 'response': {'status_code': 200, 'content_type': 'application/json', 'body': body}})
+
+    def media(self, n: int, user_id: int) -> dict:
+        """
+        Create a synthetic post or story. Every 5th one is a video and every 7th one a carousel"""
+        config = self.server.config
+        base = f'http://{self.headers["Host"]}/media'
+        item = {
+            'id': f'{n}_{user_id}',
+            'taken_at': 1_700_000_000 - n * 3600,
+            'like_count': n * 10,
+            'comment_count': n,
+            'caption': {'text': f'Post {n}'},
+            'image_versions2': {'candidates': [
+                {'width': 1080, 'height': 1080, 'url': f'{base}/{n}_1080.jpg'},
+                {'width': 640, 'height': 640, 'url': f'{base}/{n}_640.jpg'},
+                {'width': 150, 'height': 150, 'url': f'{base}/{n}_150.jpg'}
+            ]}
+        }
+        if n % 5 == 0:
+            item['video_versions'] = [{'width': 720, 'height': 1280, 'url': f'{base}/{n}.mp4'}]
+        if n % 7 == 0 and config['carousel']:
+            item['carousel_media'] = [{**item, 'id': f'{n}_{k}_{user_id}'} for k in range(3)]
+        return item
+
+    def page(self, total: int, data: dict, default: int):
+        """
+        Get the range of items of a page from the max_id cursor"""
+        start = int(data.get('max_id') or 0)
+        end = min(start + min(int(data.get('count') or default), 200), total)
+        return start, end, end < total
+
+    def do_GET(self) -> None:
+        config = self.server.config
+        if self.path.startswith('/usage'):
+            return self.send_json({'limit': 10 ** 9, 'requests': 0})
+        if self.path.startswith('/media/'):
+            time.sleep(config['media_latency'])
+            size = config['media_size'] * (4 if self.path.endswith('.mp4') else 1)
+            self.send_response(200)
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            chunk = b'\0' * 65536
+            for start in range(0, size, len(chunk)):
+                self.wfile.write(chunk[:size - start])
+            return
+        self.send_json({'detail': 'Not found'}, 404)
+
+    def do_POST(self) -> None:
+        config = self.server.config
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.stats['api_calls'] += 1
+        time.sleep(config['latency'])
+        if random.random() < config['error_rate']:
+            with self.server.lock:
+                self.server.stats['rate_limited'] += 1
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        method = self.path.strip('/')
+        user_id = self.user_id
+        if method == 'instagram/user/get_web_profile_info':
+            return self.send_body({'data': {'user': {'id': str(user_id), 'is_private': False}}})
+        if method == 'instagram/user/get_info_by_id':
+            return self.send_body({'user': {
+                'username': 'benchmark', 'pk': user_id, 'is_private': False, 'full_name': 'Benchmark',
+                'biography': '', 'follower_count': config['followers'], 'following_count': config['following'],
+                'media_count': config['posts'],
+                'hd_profile_pic_url_info': {'url': f'http://{self.headers["Host"]}/media/propic.jpg'}
+            }})
+        if method == 'instagram/user/get_media':
+            start, end, more = self.page(config['posts'], data, 12)
+            body = {'items': [self.media(n, user_id) for n in range(start, end)], 'more_available': more}
+            if more: body['next_max_id'] = str(end)
+            return self.send_body(body)
+        if method in ('instagram/user/get_followers', 'instagram/user/get_following'):
+            total = config['followers'] if method.endswith('followers') else config['following']
+            start, end, more = self.page(total, data, 12)
+            body = {'users': [{'pk': 10 ** 6 + n, 'username': f'user_{n}', 'full_name': f'User {n}',
+                               'is_private': n % 4 == 0, 'is_verified': False} for n in range(start, end)]}
+            if more: body['next_max_id'] = str(end)
+            return self.send_body(body)
+        if method == 'instagram/user/get_stories':
+            return self.send_body({'reels': {str(i): {'items': [self.media(10 ** 5 + n, i) for n in range(config['stories'])]}
+                                             for i in data['ids']}})
+        if method == 'instagram/user/get_highlights':
+            return self.send_body({'data': {'user': {'edge_highlight_reels': {'edges': [
+                {'node': {'title': f'Highlight {n}', 'id': str(2 * 10 ** 5 + n)}} for n in range(config['highlights'])
+            ]}}}})
+        if method == 'instagram/highlight/get_stories':
+            return self.send_body({'reels': {f'highlight:{i}': {'items': [self.media(3 * 10 ** 5 + n, user_id) for n in range(config['stories'])]}
+                                             for i in data['ids']}})
+        self.send_json({'detail': 'Not found'}, 404)
+
+def start_server(config: dict) -> ThreadingHTTPServer:
+    """
+    Start the mock RocketAPI and CDN server on a free local port in a background thread
+
+    Parameters:
+    config (dict): Server settings (see default_config)"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockRocketAPIHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.lock = threading.Lock()
+    server.stats = {'api_calls': 0, 'rate_limited': 0}
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+default_config = {
+    'posts': 300,
+    'followers': 20_000,
+    'following': 1_000,
+    'stories': 5,
+    'highlights': 5,
+    'carousel': True,
+    'media_size': 100_000,
+    'latency': 0.02,
+    'media_latency': 0.02,
+    'error_rate': 0.0,
+    'workers': 8
+}
+
+def peak_rss() -> float:
+    """
+    Get the peak resident memory of the process in MB"""
+    if not resource:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+
+def make_scraper(url: str, path: str, config: dict):
+    """
+    Create a scraper talking to the mock server"""
+    import client
+    client.base_url = url
+    from api import UserScraper
+    from scheduler import TokenScheduler
+    scheduler = TokenScheduler(['benchmark'], [10 ** 9], rate=10 ** 6, burst=10 ** 6)
+    return UserScraper('benchmark', parent_path=path, workers=config['workers'], scheduler=scheduler)
+
+def bench_posts(scraper) -> dict:
+    """
+    Download every post with its media"""
+    results = scraper.download_user_posts(update=True)
+    return {'items': len(results), 'bytes': sum(os.path.getsize(r['path']) for r in results if r['ok']),
+            'failed': sum(1 for r in results if not r['ok'])}
+
+def bench_followers(scraper) -> dict:
+    """
+    Crawl every follower from the API and save them"""
+    return {'items': scraper.download_user_followers(update=True)}
+
+def bench_followers_cached(scraper) -> dict:
+    """
+    Read every follower from the pages cached on disk"""
+    scraper.download_user_followers(update=True)
+    start = time.perf_counter()
+    count = sum(len(page) for page in scraper.iter_user_followers())
+    return {'items': count, 'seconds': time.perf_counter() - start}
+
+def bench_stories_highlights(scraper) -> dict:
+    """
+    Download the stories and every highlight"""
+    results = scraper.download_user_stories() + scraper.download_user_highlights(update=True)
+    return {'items': len(results), 'bytes': sum(os.path.getsize(r['path']) for r in results if r['ok']),
+            'failed': sum(1 for r in results if not r['ok'])}
+
+benchmarks = {
+    'posts': bench_posts,
+    'followers': bench_followers,
+    'followers_cached': bench_followers_cached,
+    'stories_highlights': bench_stories_highlights
+}
+
+def run_benchmark(name: str, url: str, config: dict, queue) -> None:
+    """
+    Run one benchmark in a fresh directory and put its result in the queue. Runs in its own
+    process so that the peak memory of every benchmark is measured separately"""
+    path = tempfile.mkdtemp(prefix='instagram-scraper-bench-')
+    try:
+        scraper = make_scraper(url, path, config)
+        start = time.perf_counter()
+        result = benchmarks[name](scraper)
+        result.setdefault('seconds', time.perf_counter() - start)
+        result.setdefault('bytes', 0)
+        result['items_per_second'] = result['items'] / result['seconds'] if result['seconds'] else 0
+        result['bytes_per_second'] = result['bytes'] / result['seconds'] if result['seconds'] else 0
+        result['peak_rss_mb'] = peak_rss()
+        queue.put(result)
+    except Exception as e:
+        queue.put({'error': repr(e)})
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def run(names=None, config=None) -> dict:
+    """
+    Run benchmarks against a local mock server. Returns the results by benchmark name
+
+    Parameters:
+    names (list): Names of the benchmarks to run. If not provided, runs all of them
+    config (dict): Settings overriding default_config"""
+    config = {**default_config, **(config if config else {})}
+    server = start_server(config)
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    try:
+        for name in names if names else benchmarks:
+            calls = dict(server.stats)
+            queue = context.Queue()
+            process = context.Process(target=run_benchmark, args=(name, server.url, config, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            result['api_calls'] = server.stats['api_calls'] - calls['api_calls']
+            result['rate_limited'] = server.stats['rate_limited'] - calls['rate_limited']
+            results[name] = result
+    finally:
+        server.shutdown()
+    return results
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Find the benchmarks that got slower than the baseline. Returns a message for every regression
+
+    Parameters:
+    results (dict): Results returned by run
+    baseline (dict): Results of a previous run
+    tolerance (float): Allowed slowdown, e.g. 0.2 for 20%"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline or 'error' in result or 'error' in baseline[name]:
+            continue
+        before, after = baseline[name]['items_per_second'], result['items_per_second']
+        if after < before * (1 - tolerance):
+            regressions.append(f"{name}: {after:.1f} items/s, was {before:.1f} items/s ({after / before - 1:+.0%})")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the scraper against a local mock RocketAPI server')
+    parser.add_argument('benchmarks', nargs='*', help=f"Benchmarks to run: {', '.join(benchmarks)}. Runs all if empty")
+    for key, value in default_config.items():
+        if isinstance(value, bool): continue
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    parser.add_argument('--no-carousel', action='store_true', help='Create posts without carousels')
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results to a JSON file saved with --output')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown compared to the baseline')
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error(f"Unknown benchmark {name}")
+    config = {key: getattr(args, key) for key in default_config if key != 'carousel'}
+    config['carousel'] = not args.no_carousel
+
+    results = run(args.benchmarks, config)
+    print(f"{'benchmark':<20}{'items':>10}{'seconds':>10}{'items/s':>12}{'MB/s':>10}{'peak MB':>10}{'calls':>8}{'429s':>6}")
+    for name, r in results.items():
+        if 'error' in r:
+            print(f"{name:<20}failed: {r['error']}")
+            continue
+        print(f"{name:<20}{r['items']:>10}{r['seconds']:>10.2f}{r['items_per_second']:>12.1f}"
+              f"{r['bytes_per_second'] / 1024 ** 2:>10.1f}{r['peak_rss_mb']:>10.1f}{r['api_calls']:>8}{r['rate_limited']:>6}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
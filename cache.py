@@ -0,0 +1,198 @@
+from collections import OrderedDict
+import asyncio
+import json
+import threading
+import time
+
+class ResponseCache():
+    """
+    In-memory LRU cache of API responses shared by every scraper in the process, keyed by API
+    method and arguments and placed in front of get_data. Responses expire after a TTL, and the
+    least recently used ones are evicted once the cache is full. Concurrent identical requests
+    are coalesced: the first one loads the response from disk or from the API and the others
+    wait for it. Cached responses are shared between scrapers, so they must not be modified
+
+    Parameters:
+    maxsize (int): Maximum number of responses kept. 0 disables the cache
+    ttl (float): Number of seconds a response stays valid
+    methods (tuple): API methods whose responses are cached. If None, caches every method.
+    Paginated methods are left out by default, since their pages are big and rarely requested
+    twice"""
+    def __init__(self, maxsize=1024, ttl=300, methods=('get_user_info', 'get_user_info_by_id', 'get_user_highlights', 'get_highlight_stories')) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.methods = methods
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Requests being loaded, by threads and by event loops
+        self.calls = {}
+        self.tasks = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def key(self, method: str, args: tuple, kwargs: dict) -> str:
+        """
+        Get the key of a request
+
+        Parameters:
+        method (str): Name of the API method
+        args (tuple): Positional arguments of the call
+        kwargs (dict): Keyword arguments of the call"""
+        return json.dumps([method, list(args), kwargs], sort_keys=True, default=str)
+
+    def enabled(self, method: str) -> bool:
+        """
+        Check if the responses of a method are cached
+
+        Parameters:
+        method (str): Name of the API method"""
+        return self.maxsize > 0 and (self.methods is None or method in self.methods)
+
+    def lookup(self, key: str) -> tuple:
+        """
+        Find a valid response. Must be called with the lock held. Returns whether it was found
+        and the response
+
+        Parameters:
+        key (str): Key of the request"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        if time.monotonic() - entry[0] >= self.ttl:
+            del self.entries[key]
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def store(self, key: str, value) -> None:
+        """
+        Add a response, evicting the least recently used ones if the cache is full
+
+        Parameters:
+        key (str): Key of the request
+        value: Response"""
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def get(self, method: str, args: tuple, kwargs: dict, load, refresh=False) -> tuple:
+        """
+        Get a response from the cache, or load it if it isn't cached. If the same request is
+        already being loaded by another thread, waits for it instead. Returns the response and
+        whether it was loaded by this call
+
+        Parameters:
+        method (str): Name of the API method
+        args (tuple): Positional arguments of the call
+        kwargs (dict): Keyword arguments of the call
+        load (function): Loads the response
+        refresh (bool): Whether to load a fresh response even if one is cached. Only waits for
+        other refreshes of the same request, and caches the new response"""
+        if not self.enabled(method):
+            return load(), True
+        key = self.key(method, args, kwargs)
+        with self.lock:
+            found, value = (False, None) if refresh else self.lookup(key)
+            if found:
+                return value, False
+            call = self.calls.get((refresh, key))
+            owner = call is None
+            if owner:
+                call = self.calls[(refresh, key)] = {'done': threading.Event(), 'value': None, 'error': None}
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        # Waiting for the thread loading the same request
+        if not owner:
+            call['done'].wait()
+            if call['error']:
+                raise call['error']
+            return call['value'], False
+
+        try:
+            call['value'] = load()
+            self.store(key, call['value'])
+            return call['value'], True
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[(refresh, key)]
+            call['done'].set()
+
+    async def aget(self, method: str, args: tuple, kwargs: dict, load, refresh=False) -> tuple:
+        """
+        asyncio version of get: concurrent identical requests of the same event loop wait for
+        the first one
+
+        Parameters:
+        method (str): Name of the API method
+        args (tuple): Positional arguments of the call
+        kwargs (dict): Keyword arguments of the call
+        load (function): Coroutine function loading the response
+        refresh (bool): Whether to load a fresh response even if one is cached"""
+        if not self.enabled(method):
+            return await load(), True
+        key = self.key(method, args, kwargs)
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            found, value = (False, None) if refresh else self.lookup(key)
+            if found:
+                return value, False
+            future = self.tasks.get((loop, refresh, key))
+            owner = future is None
+            if owner:
+                future = self.tasks[(loop, refresh, key)] = loop.create_future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        # Waiting for the task loading the same request. If it was cancelled, loading it here
+        if not owner:
+            try:
+                return await asyncio.shield(future), False
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+            return await load(), True
+
+        try:
+            value = await load()
+            self.store(key, value)
+            future.set_result(value)
+            return value, True
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Marking the error as retrieved in case no other task waits for it
+            future.exception()
+            raise
+        finally:
+            with self.lock:
+                del self.tasks[(loop, refresh, key)]
+
+    def clear(self) -> None:
+        """
+        Forget every cached response"""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """
+        Get the number of cached responses, of hits, of misses and of requests that waited for
+        an identical request"""
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+# Cache shared by every scraper in the process
+responses = ResponseCache()
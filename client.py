@@ -0,0 +1,60 @@
+import os
+import dotenv
+import requests
+from rocketapi import InstagramAPI
+from rocketapi.rocketapi import RocketAPI
+
+dotenv.load_dotenv()
+
+# Base URL of RocketAPI. Can be changed to point the scraper at another server, e.g. the 
+# mock server of benchmark.py
+base_url = os.getenv('rocketapi_url', 'https://v1.rocketapi.io/')
+
+class RateLimitedException(Exception):
+    """
+    Raised when RocketAPI answers with HTTP 429 Too Many Requests
+
+    Parameters:
+    message (str): Error message
+    retry_after (float): Seconds to wait before retrying, if the server sent a Retry-After header"""
+    def __init__(self, message: str, retry_after=None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class SessionRocketAPI(RocketAPI):
+    """
+    RocketAPI client that sends its requests through a shared session and reports rate limiting"""
+    session = None
+
+    def request(self, method, data):
+        r = (self.session if self.session else requests).post(
+            url=self.base_url + method,
+            json=data,
+            headers={
+                "Authorization": f"Token {self.token}",
+                "User-Agent": f"RocketAPI Python SDK/{self.sdk_version}",
+            },
+            timeout=self.max_timeout,
+        )
+        if r.status_code == 429:
+            retry_after = r.headers.get('Retry-After')
+            raise RateLimitedException(f"Rate limited by RocketAPI ({method})",
+                                       float(retry_after) if retry_after and retry_after.isdigit() else None)
+        if r.status_code >= 500:
+            r.raise_for_status()
+        return r.json()
+
+class ScraperAPI(InstagramAPI, SessionRocketAPI):
+    """
+    Instagram API client used by the scraper
+
+    Parameters:
+    token (str): RocketAPI token
+    session (requests.Session): Session to send the requests through. If not provided, every
+    request opens a new connection
+    timeout (tuple): Connect and read timeouts, in seconds"""
+    def __init__(self, token: str, session=None, timeout=(5, 30)) -> None:
+        super().__init__(token)
+        self.base_url = base_url
+        self.session = session
+        self.max_timeout = timeout
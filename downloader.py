@@ -0,0 +1,227 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from resilience import RetryPolicy, CircuitBreaker, is_transient
+from storage import temp_name
+
+user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
+
+class MediaTooLargeException(Exception):
+    """
+    Raised when every rendition of a media file is bigger than the max_bytes of the quality policy"""
+    pass
+
+class MediaQuality():
+    """
+    Policy choosing which rendition of every image and video gets downloaded. By default, the 
+    first (largest) rendition is downloaded
+
+    Parameters:
+    max_width (int): Largest width to download. The largest rendition that fits is chosen, or 
+    the smallest one if none fits
+    max_bytes (int): Largest file size to download. Bigger renditions are abandoned as soon as 
+    their size is known and the next smaller one is tried. Media without a small enough 
+    rendition is skipped
+    thumbnail (bool): Whether to download only the smallest image of every media. Videos are 
+    replaced by their cover image
+    skip_video (bool): Whether to download the cover image of videos instead of the video"""
+    def __init__(self, max_width=None, max_bytes=None, thumbnail=False, skip_video=False) -> None:
+        self.max_width = max_width
+        self.max_bytes = max_bytes
+        self.thumbnail = thumbnail
+        self.skip_video = skip_video
+
+    def order(self, renditions: list) -> list:
+        """
+        Order the renditions of a media file by preference. Only the first one is used, unless 
+        max_bytes is set, in which case the others are tried if it's too big
+
+        Parameters:
+        renditions (list): Dicts with 'url' and 'width' keys"""
+        by_width = sorted(renditions, key=lambda r: r.get('width', 0), reverse=True)
+        if self.thumbnail:
+            return by_width[::-1]
+        if self.max_width:
+            fitting = [r for r in by_width if r.get('width', 0) <= self.max_width]
+            return fitting if fitting else by_width[-1:]
+        return by_width if self.max_bytes else renditions[:1]
+
+    def renditions(self, item: dict) -> tuple:
+        """
+        Choose the renditions to download for an image or a video. Returns the file extension 
+        and the renditions to try, in order
+
+        Parameters:
+        item (dict): Image or video data from the API"""
+        if 'video_versions' in item and not (self.thumbnail or self.skip_video):
+            return '.mp4', self.order(item['video_versions'])
+        return '.jpg', self.order(item['image_versions2']['candidates'])
+
+    def select(self, item: dict) -> tuple:
+        """
+        Choose the renditions to download for an image or a video. Returns the file extension 
+        and the URLs to try, in order
+
+        Parameters:
+        item (dict): Image or video data from the API"""
+        extension, renditions = self.renditions(item)
+        return extension, [r['url'] for r in renditions]
+
+    def blob_id(self, item: dict) -> str:
+        """
+        Get the ID of the media chosen for an image or a video in the blob store: the media ID, 
+        the width of the preferred rendition and max_bytes if it is set, so that media 
+        downloaded with another policy (e.g. a thumbnail) isn't reused
+
+        Parameters:
+        item (dict): Image or video data from the API"""
+        _, renditions = self.renditions(item)
+        blob_id = f"{item['id']}_{renditions[0].get('width', 0)}"
+        return f'{blob_id}_{self.max_bytes}' if self.max_bytes else blob_id
+
+class MediaDownloader():
+    """
+    Bounded-concurrency engine that downloads media files on a pool of worker threads. All 
+    workers share one keep-alive session, so the TLS handshake is paid once per CDN host
+
+    Parameters:
+    workers (int): Maximum number of files downloaded at the same time
+    headers (dict): Headers to send with every request. If not provided, sends a browser User-Agent
+    pool_connections (int): Number of hosts to keep connection pools for
+    pool_maxsize (int): Maximum number of kept-alive connections per host. Defaults to workers
+    chunk_size (int): Size of the chunks written to disk, in bytes
+    timeout (tuple): Connect and read timeouts, in seconds. The read timeout applies to every 
+    chunk, not to the whole file
+    policy (RetryPolicy): Retries of transient errors. Defaults to RetryPolicy()
+    breaker (CircuitBreaker): Circuit breakers of the CDN hosts. Defaults to CircuitBreaker()"""
+    def __init__(self, workers=8, headers=None, pool_connections=10, pool_maxsize=None, 
+                 chunk_size=1024*1024, timeout=(5, 30), policy=None, breaker=None) -> None:
+        self.workers = workers
+        self.headers = headers if headers else {'User-Agent': user_agent}
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.policy = policy if policy else RetryPolicy()
+        self.breaker = breaker if breaker else CircuitBreaker()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        # Pooled session shared by every worker
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize if pool_maxsize else workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def fetch(self, url: str, path: str, fallbacks=(), max_bytes=None) -> int:
+        """
+        Download a single file, retrying transient errors with the retry policy. Fails 
+        immediately with CircuitOpenException while the host's circuit breaker is open. Returns 
+        the size of the file
+
+        Parameters:
+        url (str): URL of the media
+        path (str): Path to save the media to
+        fallbacks (list): Smaller renditions to try if the file is bigger than max_bytes
+        max_bytes (int): Largest file size to download"""
+        for i, url in enumerate([url, *fallbacks]):
+            host = urlparse(url).hostname
+
+            def attempt():
+                self.breaker.check(host)
+                try:
+                    size = self.fetch_once(url, path, max_bytes)
+                except Exception as e:
+                    self.breaker.record(host, not is_transient(e))
+                    raise
+                self.breaker.record(host, True)
+                return size
+
+            try:
+                return self.policy.call(attempt)
+            except MediaTooLargeException:
+                if i == len(fallbacks):
+                    raise
+
+    def fetch_once(self, url: str, path: str, max_bytes=None) -> int:
+        """
+        Download a single file. The response is streamed to a temporary file in chunks and 
+        renamed into place once complete, so memory use doesn't depend on the file size and 
+        a partial download never shows up under the final name. Returns the size of the file
+
+        Parameters:
+        url (str): URL of the media
+        path (str): Path to save the media to
+        max_bytes (int): Largest file size to download. Bigger files raise MediaTooLargeException"""
+        with self.session.get(url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            length = r.headers.get('Content-Length')
+            if max_bytes and length and length.isdigit() and int(length) > max_bytes:
+                raise MediaTooLargeException(f"{url} is bigger than {max_bytes} bytes")
+            temp_path = temp_name(path, 'part')
+            size = 0
+            try:
+                with open(temp_path, 'wb') as f:
+                    for chunk in r.iter_content(self.chunk_size):
+                        f.write(chunk)
+                        size += len(chunk)
+                        if max_bytes and size > max_bytes:
+                            raise MediaTooLargeException(f"{url} is bigger than {max_bytes} bytes")
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        return size
+
+    def timed_fetch(self, url: str, path: str, fallbacks=(), max_bytes=None) -> tuple:
+        """
+        Download a single file like fetch. Returns the size of the file and the time it took, 
+        even if the download failed
+
+        Parameters:
+        url (str): URL of the media
+        path (str): Path to save the media to
+        fallbacks (list): Smaller renditions to try if the file is bigger than max_bytes
+        max_bytes (int): Largest file size to download"""
+        start = time.perf_counter()
+        try:
+            return self.fetch(url, path, fallbacks, max_bytes), time.perf_counter() - start, None
+        except Exception as e:
+            return 0, time.perf_counter() - start, e
+
+    def download(self, job: dict) -> dict:
+        """
+        Download a job. Never raises: returns the job dict with 'ok' (bool), 'error' (str or 
+        None), 'skipped' (True if the media was too large), 'bytes' and 'seconds' added
+
+        Parameters:
+        job (dict): Job with at least 'url' and 'path' keys, and optionally 'fallbacks' and 
+        'max_bytes' (see fetch)"""
+        size, seconds, error = self.timed_fetch(job['url'], job['path'], job.get('fallbacks', ()), job.get('max_bytes'))
+        return {**job, 'ok': error is None, 'error': repr(error) if error else None, 
+                'skipped': isinstance(error, MediaTooLargeException), 'bytes': size, 'seconds': seconds}
+
+    def submit(self, job: dict):
+        """
+        Queue a job on the worker threads. Returns a future of its result (see download)
+
+        Parameters:
+        job (dict): Job to download"""
+        return self.executor.submit(self.download, job)
+
+    def run(self, jobs: list):
+        """
+        Download every job concurrently. Yields one result per job (see download) as soon as it 
+        finishes
+
+        Parameters:
+        jobs (list): Jobs to download"""
+        for future in as_completed([self.submit(job) for job in jobs]):
+            yield future.result()
+
+    def close(self) -> None:
+        """
+        Stop the worker threads once the queued downloads are done and close the session"""
+        self.executor.shutdown(wait=True)
+        self.session.close()
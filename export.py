@@ -0,0 +1,225 @@
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import re
+from storage import Manifest, open_snapshot, temp_name
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Columns of every table. Every row has the username of the scraped user
+if pyarrow:
+    schemas = {
+        'posts': pyarrow.schema([
+            ('username', pyarrow.string()), ('id', pyarrow.string()), ('taken_at', pyarrow.timestamp('s')),
+            ('like_count', pyarrow.int64()), ('comment_count', pyarrow.int64()), ('reshare_count', pyarrow.int64()),
+            ('media_count', pyarrow.int32()), ('media_type', pyarrow.string()), ('caption', pyarrow.string()),
+            ('path', pyarrow.string())]),
+        'stories': pyarrow.schema([
+            ('username', pyarrow.string()), ('id', pyarrow.string()), ('taken_at', pyarrow.timestamp('s')),
+            ('media_type', pyarrow.string()), ('path', pyarrow.string())]),
+        'highlights': pyarrow.schema([
+            ('username', pyarrow.string()), ('highlight_id', pyarrow.string()), ('title', pyarrow.string()),
+            ('id', pyarrow.string()), ('taken_at', pyarrow.timestamp('s')), ('media_type', pyarrow.string())]),
+        'followers': pyarrow.schema([
+            ('username', pyarrow.string()), ('id', pyarrow.int64()), ('name', pyarrow.string()),
+            ('full_name', pyarrow.string()), ('is_private', pyarrow.bool_()), ('is_verified', pyarrow.bool_())]),
+    }
+    schemas['following'] = schemas['followers']
+
+# File extension of every format
+formats = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+class Exporter():
+    """
+    Converts the data of scraped users into typed columnar files for analytics: one Parquet or
+    Arrow IPC file per table (posts, stories, highlights, followers and following) with the
+    rows of every user. The latest snapshot of every post, story and highlight, and the latest
+    complete followers and following lists, are found through the users' manifests and read in
+    parallel. Rows are written in batches, so memory use doesn't depend on the size of the
+    data. Every file is written to a temporary path and renamed into place once complete.
+    Needs pyarrow
+
+    Parameters:
+    path (str): Directory of one user, or parent path of many users
+    output (str): Directory to write the files to. If not provided, uses [path]/export
+    format (str): 'parquet' or 'arrow'
+    tables (list): Tables to export. If not provided, exports every table
+    batch_size (int): Number of rows written at once
+    workers (int): Number of snapshots read at the same time
+    debug (bool): Whether to print the progress"""
+    def __init__(self, path: str, output=None, format='parquet', tables=None, batch_size=50_000, workers=8, debug=False) -> None:
+        if not pyarrow:
+            raise ImportError("pyarrow is required to export data: pip install pyarrow")
+        if format not in formats:
+            raise ValueError(f"Unknown format {format}. Use one of {list(formats)}")
+        tables = tables if tables else list(schemas)
+        for table in tables:
+            if table not in schemas:
+                raise ValueError(f"Unknown table {table}. Use some of {list(schemas)}")
+
+        self.path = path
+        self.output = output if output else f'{path}/export'
+        self.format = format
+        self.tables = tables
+        self.batch_size = batch_size
+        self.workers = workers
+        self.debug = debug
+
+    def users(self) -> list:
+        """
+        Get the directories of the users to export: the path itself if it is a user's
+        directory, otherwise every directory in it with a manifest"""
+        if os.path.exists(f'{self.path}/manifest.jsonl'):
+            return [self.path]
+        return sorted(entry.path for entry in os.scandir(self.path)
+                      if entry.is_dir() and os.path.exists(f'{entry.path}/manifest.jsonl'))
+
+    def load(self, root: str, file: str) -> dict:
+        """
+        Load a JSON snapshot of a user
+
+        Parameters:
+        root (str): Directory of the user
+        file (str): Path of the snapshot, relative to the user's directory"""
+        with open_snapshot(f'{root}/{file}', 'r') as f:
+            return json.load(f)
+
+    def latest(self, root: str, manifest: Manifest, pattern: str):
+        """
+        Yield the name and the content of the latest snapshot of every name matching a pattern,
+        reading them in parallel
+
+        Parameters:
+        root (str): Directory of the user
+        manifest (Manifest): Manifest of the user
+        pattern (str): Regular expression the names must match"""
+        files = [(name, manifest.latest(name)) for name in sorted(manifest.snapshots) if re.fullmatch(pattern, name)]
+        files = [(name, file) for name, file in files if file]
+        window = self.workers * 4
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for start in range(0, len(files), window):
+                chunk = files[start:start + window]
+                yield from zip([name for name, _ in chunk], executor.map(lambda f: self.load(root, f[1]), chunk))
+
+    def read_users(self, root: str, manifest: Manifest, kind: str):
+        """
+        Yield every user of the latest complete followers or following list, streaming JSON
+        Lines files line by line. Lists cut short by a limit are skipped. Lists saved by older
+        versions as one JSON object don't record whether they are complete, and are only used
+        if they are the latest list
+
+        Parameters:
+        root (str): Directory of the user
+        manifest (Manifest): Manifest of the user
+        kind (str): 'followers' or 'following'"""
+        file = manifest.latest(f'{kind}/{kind}_complete')
+        if not file:
+            latest = manifest.latest(f'{kind}/{kind}_full')
+            file = latest if latest and not latest.endswith('.jsonl') else None
+        if not file:
+            return
+        if file.endswith('.jsonl'):
+            with open(f'{root}/{file}', 'r', encoding='utf-8') as f:
+                for line in f:
+                    yield json.loads(line)
+        else:
+            yield from self.load(root, file)['users']
+
+    def rows(self, table: str, root: str):
+        """
+        Yield the rows of a table for one user
+
+        Parameters:
+        table (str): Name of the table
+        root (str): Directory of the user"""
+        username = os.path.basename(os.path.normpath(root))
+        manifest = Manifest(root)
+
+        if table == 'posts':
+            for name, post in self.latest(root, manifest, r'posts/post_[^/]+/data'):
+                yield {**post, 'username': username, 'path': os.path.dirname(name)}
+        elif table == 'stories':
+            for name, story in self.latest(root, manifest, r'stories/story_[^/]+'):
+                yield {**story, 'username': username, 'path': name}
+        elif table == 'highlights':
+            for _, highlight in self.latest(root, manifest, r'highlights/[^/]+/data'):
+                for item in highlight['items']:
+                    yield {**item, 'username': username, 'highlight_id': highlight['id'], 'title': highlight['title']}
+        else:
+            for user in self.read_users(root, manifest, table):
+                yield {
+                    'username': username, 'id': int(user['pk']), 'name': user['username'], 'full_name': user.get('full_name'),
+                    'is_private': user.get('is_private'), 'is_verified': user.get('is_verified')
+                }
+
+    def export_table(self, table: str, users: list) -> int:
+        """
+        Write one table with the rows of every user. Returns the number of rows
+
+        Parameters:
+        table (str): Name of the table
+        users (list): Directories of the users"""
+        schema = schemas[table]
+        path = f'{self.output}/{table}{formats[self.format]}'
+        temp_path = temp_name(path)
+        if self.format == 'parquet':
+            writer = pyarrow.parquet.ParquetWriter(temp_path, schema, compression='zstd')
+            sink = None
+        else:
+            sink = pyarrow.OSFile(temp_path, 'wb')
+            writer = pyarrow.ipc.new_file(sink, schema)
+
+        count, batch = 0, []
+        try:
+            for root in users:
+                for row in self.rows(table, root):
+                    batch.append(row)
+                    if len(batch) >= self.batch_size:
+                        writer.write_batch(pyarrow.RecordBatch.from_pylist(batch, schema))
+                        count += len(batch)
+                        batch = []
+            if batch:
+                writer.write_batch(pyarrow.RecordBatch.from_pylist(batch, schema))
+                count += len(batch)
+            writer.close()
+            if sink:
+                sink.close()
+        except BaseException:
+            writer.close()
+            if sink:
+                sink.close()
+            os.remove(temp_path)
+            raise
+        os.replace(temp_path, path)
+        return count
+
+    def run(self) -> dict:
+        """
+        Export every table. Returns the number of rows of every table"""
+        users = self.users()
+        os.makedirs(self.output, exist_ok=True)
+        counts = {}
+        for table in self.tables:
+            counts[table] = self.export_table(table, users)
+            if self.debug:
+                print(f"{table}: {counts[table]} rows from {len(users)} user(s)")
+        return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export scraped Instagram data to Parquet or Arrow files')
+    parser.add_argument('path', help="Directory of a user, or parent path of many users")
+    parser.add_argument('--output', default=None, help='Directory to write the files to (default: [path]/export)')
+    parser.add_argument('--format', default='parquet', choices=list(formats), help='File format')
+    parser.add_argument('--tables', default=None, help='Comma-separated tables to export: posts,stories,highlights,followers,following')
+    parser.add_argument('--batch-size', type=int, default=50_000, help='Number of rows written at once')
+    args = parser.parse_args()
+
+    exporter = Exporter(args.path, args.output, args.format, args.tables.split(',') if args.tables else None, args.batch_size, debug=True)
+    counts = exporter.run()
+    print(f"Done! {sum(counts.values())} rows written to {exporter.output}")
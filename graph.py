@@ -0,0 +1,449 @@
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+from api import UserScraper, tokens
+from downloader import MediaDownloader
+from metrics import Metrics, MetricsGroup
+from scheduler import get_scheduler
+
+# States of the users in the frontier
+DISCOVERED, SCOUTED, CRAWLING, DONE, SKIPPED, FAILED = range(6)
+
+class BudgetExhaustedException(Exception):
+    """
+    Raised when a graph crawl has made as many API calls as its budget allows"""
+    pass
+
+class CallCounter(Metrics):
+    """
+    Counts the API calls made, including failed and retried ones"""
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def api_call(self, method, token, seconds, ok, error=None) -> None:
+        with self.lock:
+            self.calls += 1
+
+class EmptyManifest():
+    """
+    Manifest of a scraper that saves nothing to disk: no snapshot is ever found"""
+    def __init__(self) -> None:
+        self.snapshots = {}
+
+    def add(self, name: str, file: str) -> None:
+        pass
+
+    def latest(self, name: str) -> None:
+        return None
+
+class EmptyLoaded(dict):
+    """
+    Loaded media of a scraper that saves nothing to disk: kept in memory only"""
+    def __init__(self) -> None:
+        super().__init__(posts=set(), stories=set(), highlights=set())
+
+    def add(self, key: str, media_id: str) -> None:
+        self.setdefault(key, set()).add(media_id)
+
+    def flush(self) -> None:
+        pass
+
+class EmptyFailureLog():
+    """
+    Failure log of a scraper that saves nothing to disk: failures aren't recorded"""
+    def add(self, entries: list) -> None:
+        pass
+
+    def take(self) -> list:
+        return []
+
+class NodeScraper(UserScraper):
+    """
+    UserScraper for one user of a graph crawl. The user's ID and username are already known,
+    and only the followers and following are paginated, so nothing is requested to set it up
+    and nothing is saved to disk
+
+    Parameters:
+    user_id (int): User ID of the user
+    username (str): Username of the user
+    scheduler (TokenScheduler): Token scheduler of the crawl
+    downloader (MediaDownloader): Download engine of the crawl. Not used, but avoids creating one
+    per user
+    metrics (Metrics): Hook receiving the API calls"""
+    def __init__(self, user_id: int, username: str, scheduler, downloader, metrics) -> None:
+        self.known_username = username
+        super().__init__(user_id, save=False, downloader=downloader, scheduler=scheduler, metrics=metrics, index=None)
+
+    def setup(self, user: int) -> None:
+        self.user_id = int(user)
+        self.username = self.known_username
+
+        # Nothing is read from or written to the user's directory
+        self.manifest = EmptyManifest()
+        self.loaded = EmptyLoaded()
+        self.failures = EmptyFailureLog()
+        self.index = None
+
+class GraphCrawler():
+    """
+    Crawls the follower/following graph breadth first from a set of seed users, up to a given
+    depth. The crawl state is kept in [parent_path]/[name]/frontier.db, so an interrupted crawl
+    resumes where it stopped:
+
+    - The frontier and the visited set are one SQLite table keyed by user ID, so every user is
+      crawled once, however many times they are discovered
+    - Discovered users are scouted in batches (one user info call each) to get their follower
+      count, and the scouted users of the shallowest depth are crawled by follower count
+    - Edges are appended to [kind].edges as pairs of little-endian int64 user IDs: (user,
+      follower) for followers and (user, followed user) for following
+
+    Parameters:
+    seeds (list): Usernames or user IDs to start from
+    kinds (list): Edges to follow: 'followers', 'following' or both
+    depth (int): Number of hops from the seeds. 1 crawls the seeds only, 2 also crawls the users
+    discovered from them, and so on
+    budget (int): Maximum number of API calls to make in this run. A user is only crawled if
+    the calls it needs (estimated from its follower and following counts) fit in what is left
+    of the budget, so users are never left half crawled. If not provided, crawls until the
+    frontier is empty
+    parent_path (str): Path to save the crawl to. If not provided, saves to current directory
+    name (str): Name of the crawl's directory
+    workers (int): Number of users crawled at the same time
+    scout (int): Number of discovered users scouted at once
+    max_followers (int): Users with more followers than this are skipped
+    largest_first (bool): Whether to crawl the users with the most followers first. If False,
+    crawls the users with the fewest followers first, which covers more users per API call
+    scheduler (TokenScheduler): Token scheduler to use. If not provided, uses the one shared by
+    every scraper in the process
+    metrics (Metrics): Hook receiving timings and counters of the API calls
+    debug (bool): Whether to print the progress"""
+    schema = '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY, username TEXT, depth INTEGER, state INTEGER, seen INTEGER,
+            followers INTEGER, following INTEGER, is_private INTEGER);
+        CREATE INDEX IF NOT EXISTS users_discovered ON users (state, depth, seen);
+        CREATE INDEX IF NOT EXISTS users_scouted ON users (state, depth, followers);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+    '''
+
+    def __init__(self, seeds: list, kinds=('followers',), depth=1, budget=None, parent_path=None, name='graph',
+                 workers=4, scout=50, max_followers=None, largest_first=True, scheduler=None, metrics=None,
+                 debug=False) -> None:
+        for kind in kinds:
+            if kind not in ('followers', 'following'):
+                raise ValueError(f"Unknown kind {kind}. Use 'followers' or 'following'")
+        self.seeds = seeds
+        self.kinds = list(kinds)
+        self.depth = depth
+        self.budget = budget
+        self.parent_path = parent_path if parent_path else "."
+        self.path = f'{self.parent_path}/{name}'
+        self.workers = workers
+        self.scout = scout
+        self.max_followers = max_followers
+        self.largest_first = largest_first
+        self.debug = debug
+        self.scheduler = scheduler if scheduler else get_scheduler(tokens, f'{self.parent_path}/.usage.json')
+        self.counter = CallCounter()
+        self.metrics = MetricsGroup([self.counter, metrics]) if metrics else self.counter
+        self.downloader = MediaDownloader(1)
+        self.reserved = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(self.path, exist_ok=True)
+        self.connection = sqlite3.connect(f'{self.path}/frontier.db', timeout=60, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.executescript(self.schema)
+        self.recover()
+
+    def recover(self) -> None:
+        """
+        Undo what an interrupted crawl left unfinished: edges appended after the last completed
+        user are truncated away, and users that were being crawled or failed are crawled again"""
+        with self.lock, self.connection:
+            sizes = dict(self.connection.execute('SELECT key, value FROM meta').fetchall())
+            for kind in self.kinds:
+                path = f'{self.path}/{kind}.edges'
+                if os.path.exists(path) and os.path.getsize(path) != sizes.get(f'{kind}_size', 0):
+                    with open(path, 'r+b') as f:
+                        f.truncate(sizes.get(f'{kind}_size', 0))
+            self.connection.execute('UPDATE users SET state = ? WHERE state = ?', (SCOUTED, CRAWLING))
+            self.connection.execute('UPDATE users SET state = ? WHERE state = ?', (DISCOVERED, FAILED))
+
+    def calls_left(self) -> float:
+        """
+        Get the number of API calls left in the budget of this run, without the calls reserved 
+        by the users being crawled"""
+        return self.budget - self.counter.calls - self.reserved if self.budget is not None else float('inf')
+
+    def cost(self, user: dict) -> int:
+        """
+        Estimate the number of API calls needed to crawl a user, from their follower and 
+        following counts
+
+        Parameters:
+        user (dict): Row of the user in the frontier"""
+        return sum(user[kind] // 100 + 1 for kind in self.kinds)
+
+    def check_budget(self) -> None:
+        """
+        Raise BudgetExhaustedException if the budget is used up"""
+        if self.calls_left() <= 0:
+            raise BudgetExhaustedException(f"Made {self.counter.calls} API calls out of a budget of {self.budget}")
+
+    def add_seeds(self) -> None:
+        """
+        Add the seed users to the frontier. Usernames that aren't in the frontier yet are
+        resolved to user IDs"""
+        rows = []
+        for seed in self.seeds:
+            if type(seed) == str and not seed.isdigit():
+                with self.lock:
+                    known = self.connection.execute('SELECT id FROM users WHERE username = ?', (seed,)).fetchone()
+                if known:
+                    rows.append((known['id'], seed))
+                    continue
+                self.check_budget()
+                data = self.scheduler.call('get_user_info', seed, metrics=self.metrics)
+                rows.append((int(data['data']['user']['id']), seed))
+            else:
+                rows.append((int(seed), None))
+
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT INTO users (id, username, depth, state, seen) VALUES (?, ?, 0, ?, 0) '
+                                        'ON CONFLICT(id) DO UPDATE SET depth = 0', [(i, username, DISCOVERED) for i, username in rows])
+
+    def discover(self, users: list, depth: int) -> None:
+        """
+        Add users found in a follower or following list to the frontier. Users that are
+        already in it are counted as seen once more
+
+        Parameters:
+        users (list): User data from the API
+        depth (int): Number of hops from the seeds"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT INTO users (id, username, depth, state, seen, is_private) VALUES (?, ?, ?, ?, 1, ?) '
+                'ON CONFLICT(id) DO UPDATE SET seen = seen + 1, depth = min(depth, excluded.depth)',
+                [(int(u['pk']), u['username'], depth, SKIPPED if u.get('is_private') else DISCOVERED, u.get('is_private'))
+                 for u in users])
+
+    def scout_user(self, user_id: int) -> tuple:
+        """
+        Get the username, follower count and following count of a user. Returns the values to
+        update the user's row with
+
+        Parameters:
+        user_id (int): User ID of the user"""
+        try:
+            user = self.scheduler.call('get_user_info_by_id', user_id, metrics=self.metrics)['user']
+        except Exception as e:
+            if self.debug:
+                print(f"Scouting user {user_id} failed: {e!r}")
+            return FAILED, None, None, None, None, user_id
+
+        skip = user['is_private'] or (self.max_followers and user['follower_count'] > self.max_followers)
+        return SKIPPED if skip else SCOUTED, user['username'], user['follower_count'], user['following_count'], user['is_private'], user_id
+
+    def next_user(self, executor: ThreadPoolExecutor) -> dict | None:
+        """
+        Claim the next user to crawl, scouting a batch of discovered users first if needed, and 
+        reserve the calls it needs. Returns None if the frontier is empty. Raises 
+        BudgetExhaustedException if the next user doesn't fit in the budget
+
+        Parameters:
+        executor (ThreadPoolExecutor): Pool to scout the users on"""
+        order = 'DESC' if self.largest_first else 'ASC'
+        while True:
+            with self.lock:
+                frontier = self.connection.execute('SELECT min(depth) FROM users WHERE state IN (?, ?) AND depth < ?',
+                                                   (DISCOVERED, SCOUTED, self.depth)).fetchone()[0]
+                if frontier is None:
+                    return None
+                row = self.connection.execute(f'SELECT * FROM users WHERE state = ? AND depth = ? ORDER BY followers {order} LIMIT 1',
+                                              (SCOUTED, frontier)).fetchone()
+                if row:
+                    user = {**row, 'cost': self.cost(row)}
+                    if user['cost'] > self.calls_left():
+                        raise BudgetExhaustedException(f"{user['username']} needs about {user['cost']} API calls, "
+                                                       f"{max(0, self.calls_left())} are left in the budget")
+                    self.reserved += user['cost'] if self.budget is not None else 0
+                    with self.connection:
+                        self.connection.execute('UPDATE users SET state = ? WHERE id = ?', (CRAWLING, row['id']))
+                    return user
+                size = int(min(self.scout, self.calls_left()))
+                if size < 1:
+                    raise BudgetExhaustedException("No API calls left in the budget to scout users")
+                batch = [r['id'] for r in self.connection.execute('SELECT id FROM users WHERE state = ? AND depth = ? ORDER BY seen DESC LIMIT ?',
+                                                                  (DISCOVERED, frontier, size))]
+
+            # Scouting the users seen the most at the shallowest depth
+            if self.debug:
+                print(f"Scouting {len(batch)} users at depth {frontier}")
+            scouted = list(executor.map(self.scout_user, batch))
+            with self.lock, self.connection:
+                self.connection.executemany('UPDATE users SET state = ?, username = coalesce(?, username), followers = ?, following = ?, '
+                                            'is_private = ? WHERE id = ?', scouted)
+
+    def crawl_user(self, user: dict) -> int:
+        """
+        Get the followers and/or following of a user, add them to the frontier and append the
+        edges once every page was read. Returns the number of edges
+
+        Parameters:
+        user (dict): Row of the user in the frontier"""
+        scraper = NodeScraper(user['id'], user['username'], self.scheduler, self.downloader, self.metrics)
+        edges = {}
+        for kind in self.kinds:
+            edges[kind] = array('q')
+            for users in getattr(scraper, f'iter_user_{kind}')(update=True):
+                for u in users:
+                    edges[kind].append(user['id'])
+                    edges[kind].append(int(u['pk']))
+                self.discover(users, user['depth'] + 1)
+
+        # Appending the edges and marking the user as done at once
+        with self.lock:
+            sizes = []
+            for kind, pairs in edges.items():
+                if sys.byteorder == 'big':
+                    pairs.byteswap()
+                with open(f'{self.path}/{kind}.edges', 'ab') as f:
+                    pairs.tofile(f)
+                    sizes.append((f'{kind}_size', f.tell()))
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', sizes)
+                self.connection.execute('UPDATE users SET state = ? WHERE id = ?', (DONE, user['id']))
+        return sum(len(pairs) // 2 for pairs in edges.values())
+
+    def run(self) -> dict:
+        """
+        Crawl until the frontier is empty or the next user doesn't fit in the budget. Returns a 
+        summary of the run"""
+        summary = {'crawled': 0, 'failed': 0, 'edges': 0, 'calls': 0, 'exhausted': False}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, ThreadPoolExecutor(max_workers=self.workers) as scouts:
+            try:
+                self.add_seeds()
+            except BudgetExhaustedException:
+                running, summary['exhausted'] = None, True
+
+            while running is not None:
+                # Keeping every worker busy while the budget allows it
+                try:
+                    while len(running) < self.workers:
+                        user = self.next_user(scouts)
+                        if not user:
+                            break
+                        running[executor.submit(self.crawl_user, user)] = user
+                except BudgetExhaustedException as e:
+                    # The users being crawled may have needed fewer calls than reserved
+                    if not running:
+                        summary['exhausted'] = True
+                        if self.debug:
+                            print(e)
+                        break
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    user = running.pop(future)
+                    with self.lock:
+                        self.reserved -= user['cost'] if self.budget is not None else 0
+                    if future.exception() is None:
+                        summary['crawled'] += 1
+                        summary['edges'] += future.result()
+                        if self.debug:
+                            print(f"Crawled {user['username']} (depth {user['depth']}, {user['followers']} followers)")
+                        continue
+                    summary['failed'] += 1
+                    if self.debug:
+                        print(f"Crawling {user['username']} failed: {future.exception()!r}")
+                    with self.lock, self.connection:
+                        self.connection.execute('UPDATE users SET state = ? WHERE id = ?', (FAILED, user['id']))
+        summary['calls'] = self.counter.calls
+        return summary
+
+    def stats(self) -> dict:
+        """
+        Get the number of users in every state and the number of edges of every kind"""
+        names = {DISCOVERED: 'discovered', SCOUTED: 'scouted', CRAWLING: 'crawling', DONE: 'done', SKIPPED: 'skipped', FAILED: 'failed'}
+        with self.lock:
+            counts = dict(self.connection.execute('SELECT state, count(*) FROM users GROUP BY state').fetchall())
+        stats = {name: counts.get(state, 0) for state, name in names.items()}
+        for kind in self.kinds:
+            path = f'{self.path}/{kind}.edges'
+            stats[f'{kind}_edges'] = os.path.getsize(path) // 16 if os.path.exists(path) else 0
+        return stats
+
+    def edges(self, kind='followers', chunk=1_000_000):
+        """
+        Read the edges of a kind. Yields arrays of user IDs, alternating between the crawled
+        user and the follower or followed user
+
+        Parameters:
+        kind (str): 'followers' or 'following'
+        chunk (int): Maximum number of edges per array"""
+        return read_edges(f'{self.path}/{kind}.edges', chunk)
+
+    def close(self) -> None:
+        """
+        Close the frontier and the download engine"""
+        self.connection.close()
+        self.downloader.close()
+
+def read_edges(path: str, chunk=1_000_000):
+    """
+    Read an edge file written by GraphCrawler. Yields arrays of user IDs, alternating between
+    the crawled user and the follower or followed user
+
+    Parameters:
+    path (str): Path of the edge file
+    chunk (int): Maximum number of edges per array"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        while True:
+            pairs = array('q')
+            try:
+                pairs.fromfile(f, chunk * 2)
+            except EOFError:
+                pass
+            if not pairs:
+                return
+            if sys.byteorder == 'big':
+                pairs.byteswap()
+            yield pairs
+
+if __name__ == '__main__':
+    from batch import read_users
+
+    parser = argparse.ArgumentParser(description='Crawl the follower/following graph of Instagram users')
+    parser.add_argument('seeds', help='File with one username or user ID per line')
+    parser.add_argument('--kinds', default='followers', help='Comma-separated edges to follow: followers,following')
+    parser.add_argument('--depth', type=int, default=1, help='Number of hops from the seeds')
+    parser.add_argument('--budget', type=int, default=None, help='Maximum number of API calls in this run')
+    parser.add_argument('--workers', type=int, default=4, help='Number of users crawled at the same time')
+    parser.add_argument('--max-followers', type=int, default=None, help='Skip users with more followers')
+    parser.add_argument('--smallest-first', action='store_true', help='Crawl the users with the fewest followers first')
+    parser.add_argument('--parent-path', default=None, help='Path to save the crawl to')
+    parser.add_argument('--name', default='graph', help="Name of the crawl's directory")
+    args = parser.parse_args()
+
+    crawler = GraphCrawler(read_users(args.seeds), args.kinds.split(','), args.depth, args.budget, args.parent_path, args.name,
+                           args.workers, max_followers=args.max_followers, largest_first=not args.smallest_first, debug=True)
+    try:
+        summary = crawler.run()
+        print(f"Done! {summary['crawled']} users, {summary['edges']} edges, {summary['calls']} API calls"
+              f"{' (budget used up)' if summary['exhausted'] else ''}")
+        print(crawler.stats())
+    finally:
+        crawler.close()
@@ -0,0 +1,141 @@
+import json
+import threading
+import time
+
+def mask_token(token: str) -> str:
+    """
+    Shorten a token so that it can be shown in metrics without leaking it
+
+    Parameters:
+    token (str): RocketAPI token"""
+    return f'...{token[-4:]}'
+
+class Metrics():
+    """
+    Hook receiving timings and counters from the scraper. Subclass it and override the methods
+    you need. The base class ignores every event"""
+    def api_call(self, method: str, token: str, seconds: float, ok: bool, error=None) -> None:
+        """
+        Called after every API call
+
+        Parameters:
+        method (str): Name of the API method, e.g. get_user_followers
+        token (str): Masked token the call was made with
+        seconds (float): Duration of the call
+        ok (bool): Whether the call succeeded
+        error (str): Name of the exception if the call failed"""
+        pass
+
+    def download(self, host: str, size: int, seconds: float, ok: bool) -> None:
+        """
+        Called after every media download
+
+        Parameters:
+        host (str): Host the media was downloaded from
+        size (int): Number of bytes downloaded
+        seconds (float): Duration of the download
+        ok (bool): Whether the download succeeded"""
+        pass
+
+    def cache(self, method: str, hit: bool) -> None:
+        """
+        Called every time get_data looks for cached data
+
+        Parameters:
+        method (str): Name of the API method
+        hit (bool): Whether the data was loaded from disk"""
+        pass
+
+class MetricsGroup(Metrics):
+    """
+    Sends every event to several hooks
+
+    Parameters:
+    hooks (list): Metrics hooks"""
+    def __init__(self, hooks: list) -> None:
+        self.hooks = hooks
+
+    def api_call(self, *args, **kwargs) -> None:
+        for hook in self.hooks: hook.api_call(*args, **kwargs)
+
+    def download(self, *args, **kwargs) -> None:
+        for hook in self.hooks: hook.download(*args, **kwargs)
+
+    def cache(self, *args, **kwargs) -> None:
+        for hook in self.hooks: hook.cache(*args, **kwargs)
+
+class MetricsCollector(Metrics):
+    """
+    Aggregates events into counters that can be exported in the Prometheus text format"""
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def increment(self, name: str, labels: dict, value=1) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def api_call(self, method, token, seconds, ok, error=None) -> None:
+        status = 'ok' if ok else error if error else 'error'
+        self.increment('scraper_api_calls_total', {'method': method, 'token': token, 'status': status})
+        self.increment('scraper_api_call_seconds_total', {'method': method}, seconds)
+
+    def download(self, host, size, seconds, ok) -> None:
+        self.increment('scraper_downloads_total', {'host': host, 'status': 'ok' if ok else 'error'})
+        self.increment('scraper_download_bytes_total', {'host': host}, size)
+        self.increment('scraper_download_seconds_total', {'host': host}, seconds)
+
+    def cache(self, method, hit) -> None:
+        self.increment('scraper_cache_requests_total', {'method': method, 'result': 'hit' if hit else 'miss'})
+
+    def snapshot(self) -> list:
+        """
+        Get every counter as a list of dicts with 'name', 'labels' and 'value' keys"""
+        with self.lock:
+            return [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+
+    def to_prometheus(self, scheduler=None) -> str:
+        """
+        Export the counters in the Prometheus text format
+
+        Parameters:
+        scheduler (TokenScheduler): If provided, also exports the calls left on every token"""
+        lines, typed = [], set()
+        for counter in self.snapshot():
+            if counter['name'] not in typed:
+                lines.append(f"# TYPE {counter['name']} counter")
+                typed.add(counter['name'])
+            labels = ','.join(f'{k}="{v}"' for k, v in counter['labels'].items())
+            lines.append(f"{counter['name']}{{{labels}}} {counter['value']}")
+        if scheduler:
+            lines.append('# TYPE scraper_token_calls_left gauge')
+            for token, left in scheduler.calls_left().items():
+                lines.append(f'scraper_token_calls_left{{token="{mask_token(token)}"}} {left if left is not None else "NaN"}')
+        return '\n'.join(lines) + '\n'
+
+class JsonLinesExporter(Metrics):
+    """
+    Appends every event to a JSON Lines file
+
+    Parameters:
+    path (str): Path of the file"""
+    def __init__(self, path: str) -> None:
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8', buffering=1)
+
+    def write(self, event: str, data: dict) -> None:
+        with self.lock:
+            self.file.write(json.dumps({'time': time.time(), 'event': event, **data}) + '\n')
+
+    def api_call(self, method, token, seconds, ok, error=None) -> None:
+        self.write('api_call', {'method': method, 'token': token, 'seconds': seconds, 'ok': ok, 'error': error})
+
+    def download(self, host, size, seconds, ok) -> None:
+        self.write('download', {'host': host, 'bytes': size, 'seconds': seconds, 'ok': ok})
+
+    def cache(self, method, hit) -> None:
+        self.write('cache', {'method': method, 'hit': hit})
+
+    def close(self) -> None:
+        self.file.close()
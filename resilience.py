@@ -0,0 +1,187 @@
+import asyncio
+import random
+import re
+import threading
+import time
+import requests
+from rocketapi.exceptions import BadResponseException
+from client import RateLimitedException
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+class CircuitOpenException(Exception):
+    """
+    Raised instead of making a request to a host whose circuit breaker is open"""
+    pass
+
+def status_code(error: Exception) -> int | None:
+    """
+    Get the HTTP status code of an error, if it has one
+
+    Parameters:
+    error (Exception): Error raised by a request"""
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code
+    if aiohttp and isinstance(error, aiohttp.ClientResponseError):
+        return error.status
+    return None
+
+def instagram_status(error: Exception) -> int | None:
+    """
+    Get the status code Instagram answered with, if RocketAPI reached Instagram and relayed a
+    bad response. Bad responses from RocketAPI itself have none
+
+    Parameters:
+    error (Exception): Error raised by a request"""
+    if not isinstance(error, BadResponseException):
+        return None
+    match = re.fullmatch(r'Bad response from Instagram \(.*: (\d+)\)', str(error))
+    return int(match.group(1)) if match else None
+
+def retry_after(error: Exception) -> float | None:
+    """
+    Get the number of seconds to wait that the server asked for in a Retry-After header, if any
+
+    Parameters:
+    error (Exception): Error raised by a request"""
+    if isinstance(error, RateLimitedException):
+        return error.retry_after
+    headers = None
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        headers = error.response.headers
+    elif aiohttp and isinstance(error, aiohttp.ClientResponseError):
+        headers = error.headers
+    value = headers.get('Retry-After') if headers else None
+    return float(value) if value and value.isdigit() else None
+
+def is_transient(error: Exception) -> bool:
+    """
+    Check if an error is worth retrying: connection errors, timeouts, rate limiting, 5xx
+    responses and bad responses from RocketAPI. Bad responses from Instagram are only retried
+    for 429 and 5xx: a 4xx (e.g. a missing user) would fail again
+
+    Parameters:
+    error (Exception): Error raised by a request"""
+    if isinstance(error, BadResponseException):
+        status = instagram_status(error)
+        return status is None or status == 429 or status >= 500
+    if isinstance(error, (RateLimitedException, ConnectionError, TimeoutError,
+                          requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    if aiohttp and isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        return True
+    status = status_code(error)
+    return status is not None and (status == 429 or status >= 500)
+
+class RetryPolicy():
+    """
+    Retries transient errors with exponential backoff and full jitter, so that workers that
+    failed at the same time don't retry at the same time. A Retry-After sent by the server is
+    always respected
+
+    Parameters:
+    retries (int): Number of retries after the first attempt
+    base (float): Maximum delay before the first retry, in seconds. Doubles with every retry
+    cap (float): Maximum delay between two attempts, in seconds"""
+    def __init__(self, retries=4, base=0.5, cap=60) -> None:
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt: int, error=None) -> float:
+        """
+        Get the number of seconds to wait before the next attempt
+
+        Parameters:
+        attempt (int): Number of the attempt that failed, starting at 0
+        error (Exception): Error raised by the attempt"""
+        wait = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        after = retry_after(error) if error else None
+        return max(wait, after) if after else wait
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call a function, retrying it on transient errors
+
+        Parameters:
+        func (function): Function to call"""
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or not is_transient(e):
+                    raise
+                time.sleep(self.delay(attempt, e))
+
+    async def call_async(self, func, *args, **kwargs):
+        """
+        Await a coroutine function, retrying it on transient errors
+
+        Parameters:
+        func (function): Coroutine function to call"""
+        for attempt in range(self.retries + 1):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or not is_transient(e):
+                    raise
+                await asyncio.sleep(self.delay(attempt, e))
+
+class CircuitBreaker():
+    """
+    Circuit breakers for every host. After `threshold` transient failures in a row, the host's
+    circuit opens and requests to it fail immediately with CircuitOpenException for `cooldown`
+    seconds. Then a single trial request is let through: if it succeeds the circuit closes,
+    otherwise it opens again
+
+    Parameters:
+    threshold (int): Number of failures in a row that open the circuit
+    cooldown (float): Number of seconds the circuit stays open"""
+    def __init__(self, threshold=5, cooldown=30) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def check(self, host: str) -> None:
+        """
+        Raise CircuitOpenException if requests to a host shouldn't be made right now
+
+        Parameters:
+        host (str): Host of the request"""
+        with self.lock:
+            state = self.hosts.get(host)
+            if not state or state['opened'] is None:
+                return
+            left = self.cooldown - (time.monotonic() - state['opened'])
+            if left > 0 or state['trial']:
+                raise CircuitOpenException(f"Too many failures on {host}, retrying in {max(0, round(left))}s")
+            state['trial'] = True
+
+    def record(self, host: str, ok: bool) -> None:
+        """
+        Record the outcome of a request
+
+        Parameters:
+        host (str): Host of the request
+        ok (bool): Whether the host answered properly. Errors that aren't the host's fault
+        (e.g. a 404) count as ok"""
+        with self.lock:
+            state = self.hosts.setdefault(host, {'failures': 0, 'opened': None, 'trial': False})
+            state['trial'] = False
+            if ok:
+                state['failures'] = 0
+                state['opened'] = None
+            else:
+                state['failures'] += 1
+                if state['failures'] >= self.threshold:
+                    state['opened'] = time.monotonic()
+
+    def open_hosts(self) -> dict:
+        """
+        Get the hosts whose circuit is open, with the number of failures in a row"""
+        with self.lock:
+            return {host: state['failures'] for host, state in self.hosts.items() if state['opened'] is not None}
@@ -0,0 +1,247 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import threading
+import time
+import requests
+from client import ScraperAPI, RateLimitedException
+from metrics import mask_token
+from resilience import RetryPolicy, CircuitBreaker, is_transient
+from storage import temp_name
+from urllib.parse import urlparse
+import client
+
+# Schedulers shared by every scraper in the process, keyed by their tokens
+schedulers = {}
+schedulers_lock = threading.Lock()
+
+class NoTokensLeftException(Exception):
+    """
+    Raised when every token has used up its calls"""
+    pass
+
+class TokenScheduler():
+    """
+    Spreads API calls over a pool of RocketAPI tokens. Keeps track of the calls left on every
+    token, picks the token with the most calls left per request in flight, limits the request
+    rate of every token with a token bucket and backs a token off after it gets rate limited.
+    Tokens whose usage couldn't be read are left out, and their usage is queried again every
+    probe_interval seconds
+
+    Parameters:
+    tokens (list): RocketAPI tokens
+    calls_left (list): Number of calls left for each token, or None if it is unknown
+    rate (float): Maximum number of requests per second for each token
+    burst (int): Maximum number of requests a token can make at once after being idle
+    reserve (int): Number of calls to leave unused on each token
+    retries (int): Number of times to retry a call after a 429 (on another token right away) or 
+    a transient error (after a backoff)
+    timeout (tuple): Connect and read timeouts of the API requests, in seconds
+    policy (RetryPolicy): Backoff between retries of transient errors. Defaults to RetryPolicy()
+    breaker (CircuitBreaker): Circuit breaker of the RocketAPI host. Defaults to CircuitBreaker()
+    probe_interval (float): Number of seconds between two queries of the usage of a token whose
+    usage is unknown"""
+    def __init__(self, tokens: list, calls_left: list, rate=5, burst=10, reserve=5, retries=3, 
+                 timeout=(5, 30), policy=None, breaker=None, probe_interval=30) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.retries = retries
+        self.policy = policy if policy else RetryPolicy()
+        self.breaker = breaker if breaker else CircuitBreaker()
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+
+        # One pooled session for every token
+        self.session = requests.Session()
+        now = time.monotonic()
+        self.entries = [{
+            'token': token,
+            'api': ScraperAPI(token, self.session, timeout),
+            'left': left,
+            'bucket': burst,
+            'refilled': now,
+            'in_flight': 0,
+            'backoff_until': 0,
+            'strikes': 0,
+            'calls': 0,
+            'probe_at': now + probe_interval
+        } for token, left in zip(tokens, calls_left)]
+
+    def try_acquire(self) -> tuple:
+        """
+        Pick a token for the next call without waiting. Returns the token and None, or None and 
+        the number of seconds until a token becomes available"""
+        with self.lock:
+            now = time.monotonic()
+            usable = [e for e in self.entries if e['left'] is not None and e['left'] > self.reserve]
+            if not usable:
+                unknown = [e for e in self.entries if e['left'] is None]
+                if not unknown:
+                    raise NoTokensLeftException("Every token has used up its calls. Replace them.")
+                # Waiting until the usage of a token is queried again
+                return None, max(0, min(e['probe_at'] for e in unknown) - now)
+
+            # Refilling the token buckets
+            for entry in usable:
+                entry['bucket'] = min(self.burst, entry['bucket'] + (now - entry['refilled']) * self.rate)
+                entry['refilled'] = now
+
+            ready = [e for e in usable if e['backoff_until'] <= now and e['bucket'] >= 1]
+            if ready:
+                entry = max(ready, key=lambda e: (e['left'] - self.reserve) / (1 + e['in_flight']))
+                entry['bucket'] -= 1
+                entry['in_flight'] += 1
+                entry['left'] -= 1
+                entry['calls'] += 1
+                return entry, None
+
+            # Time until the first token becomes available
+            return None, min(max(e['backoff_until'] - now, (1 - e['bucket']) / self.rate) for e in usable)
+
+    def probe(self) -> None:
+        """
+        Query the usage of the tokens whose usage is unknown again, once probe_interval has 
+        passed since the last query"""
+        with self.lock:
+            now = time.monotonic()
+            due = [e for e in self.entries if e['left'] is None and e['probe_at'] <= now]
+            for entry in due:
+                entry['probe_at'] = now + self.probe_interval
+        for entry in due:
+            left = get_token_usage(entry['token'])
+            if left is not None:
+                with self.lock:
+                    entry['left'] = left
+
+    def acquire(self) -> dict:
+        """
+        Pick a token for the next call, waiting until one is available"""
+        while True:
+            self.probe()
+            entry, wait = self.try_acquire()
+            if entry:
+                return entry
+            time.sleep(wait)
+
+    def release(self, entry: dict, error=None) -> None:
+        """
+        Return a token after a call
+
+        Parameters:
+        entry (dict): Token returned by acquire
+        error (Exception): Error raised by the call, if any"""
+        with self.lock:
+            entry['in_flight'] -= 1
+            if isinstance(error, RateLimitedException):
+                entry['strikes'] += 1
+                entry['backoff_until'] = time.monotonic() + (error.retry_after if error.retry_after else min(60, 2 ** entry['strikes']))
+            elif error is None:
+                entry['strikes'] = 0
+
+    def call(self, method: str, *args, metrics=None, **kwargs):
+        """
+        Call an InstagramAPI method on the best available token
+
+        Parameters:
+        method (str): Name of the method to call
+        metrics (Metrics): Hook to report the call to"""
+        host = urlparse(client.base_url).hostname
+        for attempt in range(self.retries + 1):
+            self.breaker.check(host)
+            entry = self.acquire()
+            start = time.perf_counter()
+            try:
+                result = getattr(entry['api'], method)(*args, **kwargs)
+            except Exception as e:
+                self.release(entry, e)
+                # Rate limiting is a problem of the token, not of RocketAPI
+                self.breaker.record(host, isinstance(e, RateLimitedException) or not is_transient(e))
+                if metrics:
+                    metrics.api_call(method, mask_token(entry['token']), time.perf_counter() - start, False, type(e).__name__)
+                if isinstance(e, RateLimitedException) and attempt < self.retries:
+                    continue
+                if is_transient(e) and attempt < self.retries:
+                    time.sleep(self.policy.delay(attempt, e))
+                    continue
+                raise
+            self.release(entry)
+            self.breaker.record(host, True)
+            if metrics:
+                metrics.api_call(method, mask_token(entry['token']), time.perf_counter() - start, True)
+            return result
+
+    def calls_left(self) -> dict:
+        """
+        Get the number of calls left for each token, as tracked locally. None if it is unknown"""
+        with self.lock:
+            return {entry['token']: entry['left'] for entry in self.entries}
+
+def get_token_usage(token: str) -> int | None:
+    """
+    Get the number of calls left for a token from RocketAPI, or None if the usage can't be 
+    read
+
+    Parameters:
+    token (str): RocketAPI token"""
+    try:
+        r = requests.get(f'{client.base_url}usage', headers={"Content-Type": "application/json", "Authorization": f"Token {token}"}, timeout=(5, 30))
+        usage = r.json()
+        calls_left = usage['limit'] - usage['requests']
+    except Exception as e:
+        print(f"Couldn't get the usage of token {mask_token(token)}: {e!r}")
+        return None
+    if calls_left < 5:
+        print(f"Token {token} has {calls_left} call(s) left. Replace it.")
+    return calls_left
+
+def get_calls_left(tokens: list, cache_path=None, ttl=300) -> list:
+    """
+    Get the number of calls left for each token. Tokens are queried concurrently, and the 
+    results are cached on disk so that processes started shortly after each other don't query 
+    them again. Tokens whose usage can't be read get None and aren't cached
+
+    Parameters:
+    tokens (list): RocketAPI tokens
+    cache_path (str): Path of the JSON file to cache the results in. If not provided, nothing 
+    is cached
+    ttl (int): Number of seconds the cached results stay valid"""
+    keys = [hashlib.sha256(token.encode()).hexdigest() for token in tokens]
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    now = time.time()
+
+    # Querying the tokens that aren't cached
+    missing = [token for token, key in zip(tokens, keys) if key not in cache or now - cache[key]['time'] > ttl]
+    if missing:
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            usage = dict(zip(missing, executor.map(get_token_usage, missing)))
+        for token, key in zip(tokens, keys):
+            if usage.get(token) is not None:
+                cache[key] = {'left': usage[token], 'time': now}
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+            temp_path = temp_name(cache_path)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f)
+            os.replace(temp_path, cache_path)
+
+    return [cache[key]['left'] if key in cache else None for key in keys]
+
+def get_scheduler(tokens: list, cache_path=None, ttl=300) -> TokenScheduler:
+    """
+    Get the scheduler shared by every scraper in the process that uses the same tokens, 
+    creating it on first use
+
+    Parameters:
+    tokens (list): RocketAPI tokens
+    cache_path (str): Path of the JSON file to cache the token usage in
+    ttl (int): Number of seconds the cached token usage stays valid"""
+    with schedulers_lock:
+        key = tuple(tokens)
+        if key not in schedulers:
+            schedulers[key] = TokenScheduler(tokens, get_calls_left(tokens, cache_path, ttl))
+        return schedulers[key]
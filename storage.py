@@ -0,0 +1,743 @@
+import gzip
+import hashlib
+import io
+import itertools
+import os
+import re
+import json
+import shutil
+import socket
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File extension of the snapshots for every compression
+extensions = {None: '.json', 'gzip': '.json.gz', 'zstd': '.json.zst'}
+
+# Locks of the directories, shared by every object of the process that uses the same directory
+file_locks = {}
+file_locks_lock = threading.Lock()
+
+class FileLock():
+    """
+    Advisory lock held by one thread of one process at a time, for writing to files shared by 
+    several workers or hosts. Uses a POSIX record lock on a lock file, which also works across 
+    hosts on NFS, and a reentrant thread lock within the process. Without fcntl (e.g. on 
+    Windows), only the threads of the process are excluded. Use directory_lock to get one, since
+    closing any file descriptor of the lock file releases the process's lock
+
+    Parameters:
+    path (str): Path of the lock file"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.depth += 1
+        if self.depth == 1 and fcntl:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, 'a')
+                fcntl.lockf(self.file, fcntl.LOCK_EX)
+            except BaseException:
+                if self.file:
+                    self.file.close()
+                    self.file = None
+                self.depth -= 1
+                self.lock.release()
+                raise
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.depth -= 1
+        if self.depth == 0 and self.file:
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
+def directory_lock(directory: str) -> FileLock:
+    """
+    Get the lock of a directory (its .lock file), shared by every object of the process
+
+    Parameters:
+    directory (str): Path of the directory"""
+    path = os.path.abspath(f'{directory}/.lock')
+    with file_locks_lock:
+        if path not in file_locks:
+            file_locks[path] = FileLock(path)
+        return file_locks[path]
+
+def temp_name(path: str, suffix='tmp', tag=None) -> str:
+    """
+    Get a temporary path next to a file that no other thread, process or host writes to
+
+    Parameters:
+    path (str): Path of the final file
+    suffix (str): Extension of the temporary file
+    tag: Identifier of the writer within the process. If not provided, uses the thread's"""
+    tag = tag if tag is not None else threading.get_ident()
+    return f'{path}.{socket.gethostname()}-{os.getpid()}-{tag}.{suffix}'
+
+def publish(temp_path: str, path: str) -> str:
+    """
+    Give a finished temporary file its final name without ever replacing an existing file, so 
+    that writers in other processes or on other hosts can't overwrite each other's files. If 
+    the name is taken, -1, -2, ... is added before the extension. Returns the final path
+
+    Parameters:
+    temp_path (str): Path of the temporary file
+    path (str): Wanted path"""
+    index = path.rfind('.json')
+    base, extension = (path[:index], path[index:]) if index != -1 else os.path.splitext(path)
+    try:
+        for n in itertools.count():
+            candidate = f'{base}-{n}{extension}' if n else path
+            try:
+                os.link(temp_path, candidate)
+                return candidate
+            except FileExistsError:
+                continue
+            except OSError:
+                pass
+
+            # Without hardlinks, claiming the name first
+            try:
+                os.close(os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+            os.replace(temp_path, candidate)
+            return candidate
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def open_snapshot(path: str, mode: str, name=None):
+    """
+    Open a JSON snapshot for reading or writing text, compressing or decompressing it based 
+    on its extension
+
+    Parameters:
+    path (str): Path of the snapshot
+    mode (str): 'r' or 'w'
+    name (str): Path to take the extension from, e.g. the final path when writing to a 
+    temporary file. If not provided, uses the path"""
+    name = name if name else path
+    if name.endswith('.gz'):
+        return gzip.open(path, f'{mode}t', encoding='utf-8')
+    if name.endswith('.zst'):
+        if not zstandard:
+            raise ImportError("zstandard is required for zstd snapshots: pip install zstandard")
+        f = open(path, f'{mode}b')
+        if mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def read_log(path: str) -> list:
+    """
+    Read every entry of a JSON Lines log. A partially written last line left by a crash is 
+    truncated away so that new entries can be appended safely
+    
+    Parameters:
+    path (str): Path of the log file"""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb+') as f:
+        content = f.read()
+        end = content.rfind(b'\n') + 1
+        if end != len(content):
+            f.truncate(end)
+    return [json.loads(line) for line in content[:end].decode('utf-8').splitlines()]
+
+class LoadedIndex():
+    """
+    Set-backed record of the media that was already downloaded. New IDs are buffered in memory
+    and appended to a JSON Lines log in batches, so recording an ID is O(1) and a crash loses at
+    most one unflushed batch
+
+    Parameters:
+    path (str): Path of the log file
+    keys (tuple): Kinds of media tracked by the index
+    flush_every (int): Number of new IDs to buffer before writing them to disk"""
+    def __init__(self, path: str, keys=('posts', 'stories', 'highlights'), flush_every=50) -> None:
+        self.path = path
+        self.flush_every = flush_every
+        self.ids = {key: set() for key in keys}
+        self.pending = []
+        self.buffer = threading.Lock()
+        self.lock = directory_lock(os.path.dirname(path))
+        self.load()
+
+    def __getitem__(self, key: str) -> set:
+        return self.ids[key]
+
+    def load(self) -> None:
+        """
+        Load every ID from the log"""
+        with self.lock:
+            entries = read_log(self.path)
+        for key, media_id in entries:
+            self.ids.setdefault(key, set()).add(media_id)
+
+    def migrate(self, path: str) -> None:
+        """
+        Import a legacy loaded.json file and rename it to loaded.json.bak. Runs under the 
+        directory lock, so only one of several workers opening the same user imports it
+
+        Parameters:
+        path (str): Path of the loaded.json file"""
+        with self.lock:
+            # Another worker may have migrated it since it was checked, so its IDs are in the log
+            if not os.path.exists(path):
+                self.load()
+                return
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for key, ids in data.items():
+                for media_id in ids:
+                    self.add(key, media_id)
+            self.flush()
+            os.replace(path, f'{path}.bak')
+
+    def add(self, key: str, media_id: str) -> None:
+        """
+        Record a downloaded media ID
+
+        Parameters:
+        key (str): Kind of the media ('posts', 'stories' or 'highlights')
+        media_id (str): ID of the media"""
+        with self.buffer:
+            ids = self.ids.setdefault(key, set())
+            if media_id in ids:
+                return
+            ids.add(media_id)
+            self.pending.append([key, media_id])
+            full = len(self.pending) >= self.flush_every
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Append the buffered IDs to the log and sync it to disk. IDs added while the log is 
+        written are kept for the next flush"""
+        with self.buffer:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in pending))
+            f.flush()
+            os.fsync(f.fileno())
+
+class CursorLog():
+    """
+    Append-only log of the pagination cursors of the latest crawl of a paginated endpoint. Each
+    line holds a completed page number and the cursor of the page after it, so an interrupted
+    crawl can resume after the last completed page. A "stopped" line marks a crawl that was 
+    ended on purpose (e.g. because a limit was reached) rather than interrupted
+
+    Parameters:
+    path (str): Path of the log file"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.cursors = [None]
+        self.complete = False
+        self.stopped = False
+        self.lock = directory_lock(os.path.dirname(path))
+        self.load()
+
+    @property
+    def pages(self) -> int:
+        """
+        Number of pages completed in the latest crawl"""
+        return len(self.cursors) if self.complete else len(self.cursors) - 1
+
+    def load(self) -> None:
+        """
+        Load the cursor chain of the latest crawl from disk"""
+        with self.lock:
+            entries = read_log(self.path)
+        for entry in entries:
+            if entry == 'stopped':
+                self.stopped = True
+                continue
+            page, cursor = entry
+            if page != len(self.cursors) - 1 or self.complete:
+                break
+            self.stopped = False
+            if cursor is None: self.complete = True
+            else: self.cursors.append(cursor)
+
+    def start(self) -> None:
+        """
+        Forget the previous crawl and start a new cursor chain"""
+        self.cursors = [None]
+        self.complete = False
+        self.stopped = False
+        with self.lock:
+            open(self.path, 'w', encoding='utf-8').close()
+
+    def add(self, cursor: str | None) -> None:
+        """
+        Record that the next page was completed
+
+        Parameters:
+        cursor (str): Cursor of the page after it, or None if it was the last page"""
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps([self.pages, cursor]) + '\n')
+        self.stopped = False
+        if cursor is None: self.complete = True
+        else: self.cursors.append(cursor)
+
+    def stop(self) -> None:
+        """
+        Record that the crawl was ended on purpose before the last page"""
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps('stopped') + '\n')
+        self.stopped = True
+
+class Manifest():
+    """
+    Index of the JSON snapshots saved for a user, mapping every logical name (e.g. 
+    raw/followers/followers_12) to its snapshot files, oldest first. Saved as an append-only log, 
+    so finding the latest snapshot doesn't require listing directories. If the log doesn't exist 
+    yet, it is built once by scanning the user's directory. Removed snapshots are recorded with a
+    third "removed" field. Writes hold the user's directory lock, and entries appended by other
+    processes are picked up before every write and lookup
+
+    Parameters:
+    root (str): Directory of the user"""
+    snapshot_pattern = re.compile(r'(.*)_(\d{4}-\d\d-\d\d \d\dh\d\dm\d\ds(?:-\d+)?)\.json(l|\.gz|\.zst)?')
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.path = f'{root}/manifest.jsonl'
+        self.snapshots = {}
+        self.offset = 0
+        self.lock = directory_lock(root)
+        with self.lock:
+            if os.path.exists(self.path):
+                for entry in read_log(self.path):
+                    self.apply(entry)
+                self.offset = os.path.getsize(self.path)
+            elif os.path.exists(root):
+                self.rebuild()
+
+    def rebuild(self) -> None:
+        """
+        Rebuild the manifest by scanning every snapshot in the user's directory"""
+        found = []
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                path = os.path.relpath(os.path.join(directory, file), self.root).replace(os.sep, '/')
+                match = self.snapshot_pattern.fullmatch(path)
+                if match:
+                    found.append((match.group(1), match.group(2), path))
+                elif path.endswith('.json'):
+                    # Snapshots saved without a timestamp by older versions
+                    found.append((path[:-len('.json')], '', path))
+        found.sort()
+
+        with self.lock:
+            self.snapshots = {}
+            for name, _, file in found:
+                self.snapshots.setdefault(name, []).append(file)
+            temp_path = temp_name(self.path)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(''.join(json.dumps([name, file]) + '\n' for name, _, file in found))
+            os.replace(temp_path, self.path)
+            self.offset = os.path.getsize(self.path)
+
+    def refresh(self) -> None:
+        """
+        Apply the entries appended to the log since it was last read, e.g. by other processes"""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == self.offset:
+            return
+        with self.lock:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                content = f.read()
+            end = content.rfind(b'\n') + 1
+            for line in content[:end].decode('utf-8').splitlines():
+                self.apply(json.loads(line))
+            self.offset += end
+
+    def apply(self, entry: list) -> None:
+        """
+        Apply an entry of the log
+
+        Parameters:
+        entry (list): Name and file, and "removed" if the snapshot was removed"""
+        files = self.snapshots.setdefault(entry[0], [])
+        if len(entry) == 3:
+            if entry[1] in files: files.remove(entry[1])
+        elif entry[1] not in files:
+            files.append(entry[1])
+
+    def append(self, entries: list) -> None:
+        """
+        Append entries to the log. Must be called with the lock held, after refresh
+
+        Parameters:
+        entries (list): Entries to append"""
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+            self.offset = f.tell()
+
+    def add(self, name: str, file: str) -> None:
+        """
+        Record a new snapshot
+
+        Parameters:
+        name (str): Logical name of the data, e.g. raw/followers/followers_12
+        file (str): Path of the snapshot file, relative to the user's directory"""
+        with self.lock:
+            self.refresh()
+            self.append([[name, file]])
+            self.snapshots.setdefault(name, []).append(file)
+
+    def latest(self, name: str) -> str | None:
+        """
+        Get the path of the latest snapshot of a name, relative to the user's directory
+
+        Parameters:
+        name (str): Logical name of the data"""
+        self.refresh()
+        files = self.snapshots.get(name)
+        return files[-1] if files else None
+
+    def prune(self, name: str, keep: int) -> list:
+        """
+        Forget every snapshot of a name except the most recent ones. Returns the paths of the 
+        forgotten snapshots, relative to the user's directory, so they can be deleted
+
+        Parameters:
+        name (str): Logical name of the data
+        keep (int): Number of snapshots to keep"""
+        with self.lock:
+            self.refresh()
+            files = self.snapshots.get(name, [])
+            removed = files[:-keep] if len(files) > keep else []
+            if not removed:
+                return []
+            self.snapshots[name] = files[len(removed):]
+            self.append([[name, file, 'removed'] for file in removed])
+            return removed
+
+class SyncedIds():
+    """
+    Set of user IDs seen by the previous syncs, persisted as an append-only log of additions and
+    removals
+
+    Parameters:
+    path (str): Path of the log file"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.ids = set()
+        self.lock = directory_lock(os.path.dirname(path))
+        with self.lock:
+            entries = read_log(path)
+        for user_id, present in entries:
+            if present: self.ids.add(user_id)
+            else: self.ids.discard(user_id)
+
+    def update(self, added: list, removed: list) -> None:
+        """
+        Record added and removed IDs
+
+        Parameters:
+        added (list): IDs that were added
+        removed (list): IDs that were removed"""
+        entries = [[user_id, True] for user_id in added] + [[user_id, False] for user_id in removed]
+        if not entries:
+            return
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        self.ids.update(added)
+        self.ids.difference_update(removed)
+
+class BlobStore():
+    """
+    Content-addressed store of media files shared by every user saved under the same parent path.
+    Every blob is stored once under the SHA-256 of its content and indexed by media ID and 
+    rendition (see MediaQuality.blob_id), and the 
+    files in the users' directories are hardlinks to it. Media that shows up several times (a 
+    story that is also in a highlight, a repost crawled under several users, the same media in 
+    another snapshot) is downloaded and stored only once
+
+    Parameters:
+    root (str): Directory of the store, usually [parent_path]/.blobs"""
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def id_path(self, blob_id: str, extension: str) -> str:
+        """
+        Get the path of the blob indexed by an ID
+
+        Parameters:
+        blob_id (str): Instagram media ID and rendition, from MediaQuality.blob_id
+        extension (str): Extension of the media, e.g. .jpg"""
+        shard = hashlib.sha256(str(blob_id).encode()).hexdigest()[:2]
+        return f'{self.root}/ids/{shard}/{blob_id}{extension}'
+
+    def get(self, blob_id: str, extension: str) -> str | None:
+        """
+        Get the path of the blob of an ID, or None if it wasn't stored yet
+
+        Parameters:
+        blob_id (str): Instagram media ID and rendition, from MediaQuality.blob_id
+        extension (str): Extension of the media, e.g. .jpg"""
+        path = self.id_path(blob_id, extension)
+        return path if os.path.exists(path) else None
+
+    def link(self, blob: str, path: str) -> None:
+        """
+        Make a path point to a blob. Uses a hardlink, or a copy if the file system doesn't 
+        support hardlinks to the store. An existing file at the path is replaced
+
+        Parameters:
+        blob (str): Path of the blob
+        path (str): Path to link"""
+        if os.path.exists(path) and os.path.samefile(blob, path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = temp_name(path, 'link')
+        try:
+            os.link(blob, temp_path)
+        except OSError:
+            shutil.copyfile(blob, temp_path)
+        os.replace(temp_path, path)
+
+        # Renaming onto a link to the same file does nothing, which happens if another thread 
+        # linked the path in the meantime
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    def add(self, path: str, blob_id=None) -> str:
+        """
+        Move a downloaded file into the store and replace it with a link to its blob. If a blob 
+        with the same content already exists, the file is deduplicated against it. Returns the 
+        path of the blob
+
+        Parameters:
+        path (str): Path of the downloaded file
+        blob_id (str): ID to index the blob by (see MediaQuality.blob_id), if known"""
+        extension = os.path.splitext(path)[1]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+
+        # Keeping a single copy of the content
+        blob = f'{self.root}/sha256/{digest[:2]}/{digest}{extension}'
+        if os.path.exists(blob):
+            self.link(blob, path)
+        else:
+            self.link(path, blob)
+        if blob_id is not None:
+            self.link(blob, self.id_path(blob_id, extension))
+        return blob
+
+class FailureLog():
+    """
+    Append-only log of the API calls and media downloads that still failed after every retry, 
+    so that they can be retried later instead of aborting the run
+
+    Parameters:
+    path (str): Path of the log file"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = directory_lock(os.path.dirname(path))
+
+    def add(self, entries: list) -> None:
+        """
+        Record failures
+
+        Parameters:
+        entries (list): Dicts describing the failed calls or downloads"""
+        if not entries:
+            return
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+
+    def read(self) -> list:
+        """
+        Get every recorded failure"""
+        with self.lock:
+            return read_log(self.path)
+
+    def clear(self) -> None:
+        """
+        Forget every recorded failure"""
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def take(self) -> list:
+        """
+        Get every recorded failure and forget them, so that another process doesn't retry 
+        them too"""
+        with self.lock:
+            entries = self.read()
+            self.clear()
+            return entries
+
+class MetadataIndex():
+    """
+    SQLite index of the metadata of posts, stories and followers/following, kept up to date 
+    while they are downloaded, so that they can be queried without parsing every JSON file. 
+    Every row has the username of the scraped user, so one database can be shared by every 
+    user under a parent path. A post or story saved under several users (e.g. a collab post) 
+    has one row per user
+
+    Parameters:
+    path (str): Path of the database"""
+    schema = '''
+        CREATE TABLE IF NOT EXISTS posts (
+            username TEXT, id TEXT, taken_at INTEGER, like_count INTEGER, comment_count INTEGER,
+            media_type TEXT, media_count INTEGER, caption TEXT, path TEXT, PRIMARY KEY (username, id));
+        CREATE INDEX IF NOT EXISTS posts_user ON posts (username, taken_at);
+        CREATE TABLE IF NOT EXISTS stories (
+            username TEXT, id TEXT, highlight TEXT, taken_at INTEGER, media_type TEXT, path TEXT,
+            PRIMARY KEY (username, id, highlight));
+        CREATE INDEX IF NOT EXISTS stories_user ON stories (username, taken_at);
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT, kind TEXT, id INTEGER, name TEXT, full_name TEXT, is_private INTEGER, 
+            is_verified INTEGER, updated REAL, PRIMARY KEY (username, kind, id));
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.executescript(self.schema)
+
+            # Databases created by older versions key posts and stories without the username
+            if not self.connection.execute("SELECT pk FROM pragma_table_info('posts') WHERE name = 'username'").fetchone()[0]:
+                self.migrate()
+
+    def migrate(self) -> None:
+        """
+        Add the username to the primary keys of the posts and stories tables of a database 
+        created by an older version, keeping their rows. Must be called with the lock held"""
+        self.connection.executescript('''
+            BEGIN IMMEDIATE;
+            DROP INDEX IF EXISTS posts_user;
+            DROP INDEX IF EXISTS stories_user;
+            ALTER TABLE posts RENAME TO old_posts;
+            ALTER TABLE stories RENAME TO old_stories;
+        ''' + self.schema + '''
+            INSERT OR REPLACE INTO posts SELECT * FROM old_posts;
+            INSERT OR REPLACE INTO stories SELECT * FROM old_stories;
+            DROP TABLE old_posts;
+            DROP TABLE old_stories;
+            COMMIT;
+        ''')
+
+    def write(self, sql: str, rows: list) -> None:
+        """
+        Run a statement for every row in one transaction
+
+        Parameters:
+        sql (str): SQL statement
+        rows (list): Parameters of every execution"""
+        if not rows:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany(sql, rows)
+
+    def add_posts(self, username: str, posts: list) -> None:
+        """
+        Add or update posts
+
+        Parameters:
+        username (str): Username of the scraped user
+        posts (list): Post data (see UserScraper.post_data) with the 'path' of the post's directory"""
+        self.write('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [(
+            username, p['id'], p['taken_at'], p['like_count'], p['comment_count'], p['media_type'],
+            p['media_count'], p['caption'], p['path']
+        ) for p in posts])
+
+    def add_stories(self, username: str, stories: list, highlight='') -> None:
+        """
+        Add or update stories
+
+        Parameters:
+        username (str): Username of the scraped user
+        stories (list): Story data (see UserScraper.story_data) with the 'path' of the media 
+        file without its extension
+        highlight (str): Title of the highlight the stories belong to, or '' for stories"""
+        self.write('INSERT OR REPLACE INTO stories VALUES (?, ?, ?, ?, ?, ?)', [(
+            username, s['id'], highlight, s['taken_at'], s['media_type'], s['path']
+        ) for s in stories])
+
+    def add_users(self, username: str, kind: str, users: list, updated: float) -> None:
+        """
+        Add or update followers or followed users
+
+        Parameters:
+        username (str): Username of the scraped user
+        kind (str): 'followers' or 'following'
+        users (list): User data from the API
+        updated (float): Timestamp of the crawl that saw the users"""
+        self.write('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [(
+            username, kind, int(u['pk']), u['username'], u.get('full_name'), u.get('is_private'), 
+            u.get('is_verified'), updated
+        ) for u in users])
+
+    def remove_users(self, username: str, kind: str, ids: list) -> None:
+        """
+        Remove followers or followed users
+
+        Parameters:
+        username (str): Username of the scraped user
+        kind (str): 'followers' or 'following'
+        ids (list): IDs of the users to remove"""
+        self.write('DELETE FROM users WHERE username = ? AND kind = ? AND id = ?', [(username, kind, int(i)) for i in ids])
+
+    def remove_users_before(self, username: str, kind: str, updated: float) -> None:
+        """
+        Remove the followers or followed users that weren't seen by a complete crawl
+
+        Parameters:
+        username (str): Username of the scraped user
+        kind (str): 'followers' or 'following'
+        updated (float): Timestamp of the crawl"""
+        self.write('DELETE FROM users WHERE username = ? AND kind = ? AND updated < ?', [(username, kind, updated)])
+
+    def query(self, sql: str, params=()) -> list:
+        """
+        Run a query and get the rows as dicts
+
+        Parameters:
+        sql (str): SQL query
+        params (tuple): Parameters of the query"""
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(sql, params)]
+
+    def close(self) -> None:
+        """
+        Close the database"""
+        self.connection.close()
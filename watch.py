@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import threading
+import time
+from api import UserScraper, tokens
+from downloader import MediaDownloader
+from metrics import Metrics
+from scheduler import get_scheduler
+from storage import temp_name
+
+class Watcher():
+    """
+    Long-running watcher capturing the stories and new highlights of many accounts before they
+    expire. Every account has its own polling interval for stories and for highlights: it is
+    halved when something new is found and grows by half when nothing changed, so accounts that
+    post often are polled more often. The stories of up to 4 accounts are requested in one API
+    call, and accounts that are due soon are pulled forward to fill the call. Only new items are
+    downloaded, using the loaded list of every account. Every account shares one token
+    scheduler and one download pool, and the schedule is saved to [parent_path]/watch.json so
+    that a restarted watcher keeps it
+
+    Parameters:
+    users (list): Usernames or user IDs to watch
+    parent_path (str): Path to save the data to. If not provided, saves to current directory
+    story_interval (tuple): Shortest and longest time between two story checks of an account, in
+    seconds. The longest should stay well under 24 hours so stories don't expire unseen
+    highlight_interval (tuple): Shortest and longest time between two highlight checks of an
+    account, in seconds
+    highlights (bool): Whether to watch for new highlights too
+    workers (int): Number of media files downloaded at the same time, for every account
+    scheduler (TokenScheduler): Token scheduler to use. If not provided, uses the one shared by
+    every scraper in the process
+    metrics (Metrics): Hook receiving timings and counters of API calls, downloads and cache
+    lookups
+    blobs (bool): Whether to store media once in the blob store shared by every account
+    quality (MediaQuality): Policy choosing which rendition of every media to download
+    index (str): Where to keep the metadata index: 'user', 'global' or None
+    debug (bool): Whether to print the progress"""
+    def __init__(self, users: list, parent_path=None, story_interval=(15*60, 6*3600), highlight_interval=(6*3600, 7*24*3600),
+                 highlights=True, workers=16, scheduler=None, metrics=None, blobs=False, quality=None, index='global',
+                 debug=False) -> None:
+        self.users = [str(user) for user in users]
+        self.parent_path = parent_path if parent_path else "."
+        self.intervals = {'stories': story_interval, 'highlights': highlight_interval}
+        self.kinds = ['stories', 'highlights'] if highlights else ['stories']
+        self.scheduler = scheduler if scheduler else get_scheduler(tokens, f'{self.parent_path}/.usage.json')
+        self.metrics = metrics if metrics else Metrics()
+        self.blobs = blobs
+        self.quality = quality
+        self.index = index
+        self.debug = debug
+        self.downloader = MediaDownloader(workers)
+        self.scrapers = {}
+        self.stopped = threading.Event()
+
+        # Loading the schedule of the previous runs
+        self.path = f'{self.parent_path}/watch.json'
+        self.state = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+        for user in self.users:
+            for kind in self.kinds:
+                self.state.setdefault(user, {}).setdefault(kind, {'interval': self.intervals[kind][0], 'next': 0})
+
+    def save_state(self) -> None:
+        """
+        Save the schedule of every account"""
+        os.makedirs(self.parent_path, exist_ok=True)
+        temp_path = temp_name(self.path)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.path)
+
+    def get_scraper(self, user: str) -> UserScraper:
+        """
+        Get the scraper of an account, creating it on first use
+
+        Parameters:
+        user (str): Username or user ID"""
+        if user not in self.scrapers:
+            self.scrapers[user] = UserScraper(user, parent_path=self.parent_path, downloader=self.downloader, scheduler=self.scheduler,
+                                              metrics=self.metrics, blobs=self.blobs, quality=self.quality, index=self.index)
+        return self.scrapers[user]
+
+    def reschedule(self, user: str, kind: str, found=None) -> None:
+        """
+        Schedule the next check of an account
+
+        Parameters:
+        user (str): Username or user ID
+        kind (str): 'stories' or 'highlights'
+        found (bool): Whether the check found something new. None if it failed, which keeps the
+        interval"""
+        shortest, longest = self.intervals[kind]
+        state = self.state[user][kind]
+        if found is not None:
+            state['interval'] = max(shortest, state['interval'] / 2) if found else min(longest, state['interval'] * 1.5)
+        state['next'] = time.time() + state['interval']
+
+    def due(self, kind: str) -> list:
+        """
+        Get the accounts whose check is due. For stories, accounts due within a quarter of their
+        interval are added to fill the last call of 4 accounts
+
+        Parameters:
+        kind (str): 'stories' or 'highlights'"""
+        now = time.time()
+        due = [user for user in self.users if self.state[user][kind]['next'] <= now]
+        if kind == 'stories' and len(due) % 4:
+            chosen = set(due)
+            soon = sorted((user for user in self.users if user not in chosen and
+                           self.state[user][kind]['next'] - now <= self.state[user][kind]['interval'] / 4),
+                          key=lambda user: self.state[user][kind]['next'])
+            due += soon[:4 - len(due) % 4]
+        return due
+
+    def check_stories(self, users: list) -> None:
+        """
+        Request the stories of up to 4 accounts in one call and download the new ones
+
+        Parameters:
+        users (list): Usernames or user IDs"""
+        scrapers = {}
+        for user in users:
+            try:
+                scrapers[user] = self.get_scraper(user)
+            except Exception as e:
+                if self.debug:
+                    print(f"Setting up {user} failed: {e!r}")
+                self.reschedule(user, 'stories')
+
+        # Private accounts don't show their stories
+        for user in [user for user, scraper in scrapers.items() if scraper.is_private]:
+            self.reschedule(user, 'stories', False)
+            del scrapers[user]
+        if not scrapers:
+            return
+
+        try:
+            data = self.scheduler.call('get_user_stories_bulk', [scraper.user_id for scraper in scrapers.values()], metrics=self.metrics)
+        except Exception as e:
+            if self.debug:
+                print(f"Getting the stories of {', '.join(scrapers)} failed: {e!r}")
+            for user in scrapers:
+                self.reschedule(user, 'stories')
+            return
+
+        for user, scraper in scrapers.items():
+            reel = data['reels'].get(str(scraper.user_id))
+            stories = reel['items'] if reel else []
+            new = [story for story in stories if story['id'] not in scraper.loaded['stories']]
+            if new:
+                scraper.save_json({'reels': {str(scraper.user_id): reel}}, 'raw/stories')
+                results = scraper.download_user_stories(stories=stories)
+                if self.debug:
+                    print(f"{scraper.username}: {len(new)} new stories, {sum(1 for r in results if not r['ok'])} failed")
+            self.reschedule(user, 'stories', bool(new))
+
+    def check_highlights(self, user: str) -> None:
+        """
+        Download the highlight stories an account added since the previous check, in new and
+        existing highlights
+
+        Parameters:
+        user (str): Username or user ID"""
+        try:
+            scraper = self.get_scraper(user)
+            results = [] if scraper.is_private else scraper.sync_user_highlights()
+        except Exception as e:
+            if self.debug:
+                print(f"Checking the highlights of {user} failed: {e!r}")
+            self.reschedule(user, 'highlights')
+            return
+        if results and self.debug:
+            print(f"{scraper.username}: {len(results)} new highlight stories")
+        self.reschedule(user, 'highlights', bool(results))
+
+    def poll(self) -> float:
+        """
+        Run every check that is due. Returns the number of seconds until the next one"""
+        due = self.due('stories')
+        for i in range(0, len(due), 4):
+            self.check_stories(due[i:i + 4])
+        if 'highlights' in self.kinds:
+            for user in self.due('highlights'):
+                self.check_highlights(user)
+        self.save_state()
+        return max(0, min(self.state[user][kind]['next'] for user in self.users for kind in self.kinds) - time.time())
+
+    def run(self, duration=None) -> None:
+        """
+        Poll until stop is called or for a given time
+
+        Parameters:
+        duration (float): Number of seconds to watch for. If not provided, watches until stop is
+        called"""
+        end = time.time() + duration if duration else None
+        while not self.stopped.is_set():
+            wait = self.poll()
+            if end:
+                if time.time() >= end:
+                    break
+                wait = min(wait, end - time.time())
+            if self.debug:
+                print(f"Next check in {round(wait)}s")
+            self.stopped.wait(wait)
+
+    def stop(self) -> None:
+        """
+        Stop the watcher after the current checks"""
+        self.stopped.set()
+
+    def close(self) -> None:
+        """
+        Save the schedule and close the download pool and the scrapers' files"""
+        self.save_state()
+        for scraper in self.scrapers.values():
+            scraper.save_loaded()
+        self.downloader.close()
+
+if __name__ == '__main__':
+    from batch import read_users
+
+    parser = argparse.ArgumentParser(description='Capture the stories and new highlights of many Instagram accounts')
+    parser.add_argument('users', help='File with one username or user ID per line')
+    parser.add_argument('--parent-path', default=None, help='Path to save the data to')
+    parser.add_argument('--min-interval', type=int, default=15*60, help='Shortest time between two story checks of an account, in seconds')
+    parser.add_argument('--max-interval', type=int, default=6*3600, help='Longest time between two story checks of an account, in seconds')
+    parser.add_argument('--no-highlights', action='store_true', help="Don't watch for new highlights")
+    parser.add_argument('--duration', type=int, default=None, help='Number of seconds to watch for (default: until interrupted)')
+    parser.add_argument('--blobs', action='store_true', help='Store media shared by several accounts only once')
+    args = parser.parse_args()
+
+    watcher = Watcher(read_users(args.users), args.parent_path, (args.min_interval, args.max_interval),
+                      highlights=not args.no_highlights, blobs=args.blobs, debug=True)
+    try:
+        watcher.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()